@@ -1,19 +1,28 @@
 import streamlit as st
 import pandas as pd
 import time
-import gspread
 import json
 import re
 import pytz
 import uuid
 import numpy as np
 import gc
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from gspread_dataframe import set_with_dataframe, get_as_dataframe
 from gspread.exceptions import APIError
-from datetime import datetime, timedelta
+from datetime import datetime
 from google.oauth2 import service_account
 from collections import defaultdict, Counter
 from st_copy_to_clipboard import st_copy_to_clipboard
+from kinkin_core import (authorize, ClientRegistry, get_client_stats, is_quota_error, get_bot_assigner, hash_bot_for_block,
+                         SourceFreshness, source_fingerprint, STATUS_UNCHANGED, SourceCache, source_key, make_source_loader,
+                         normalize_row_key, locate_overwrite_rows, TargetRowIndex,
+                         WRITE_MODE_INPLACE, is_inplace_mode, write_rows_in_place, FrameRows,
+                         WRITE_MODE_DIFF, is_diff_mode, ensure_hash_column, write_rows_diff, hash_rows, SYS_COL_HASH, apply_target_write, WRITE_STREAM_ROWS,
+                         SchemaCache, apply_schema, protect_text_codes, LogSink, header_row, META_CACHE,
+                         apply_compiled_filter, ENGINES, ENGINE_PANDAS, ENGINE_POLARS, resolve_engine, pl,
+                         pl_frame_from_values, pl_apply_filter)
 
 # ==========================================
 # 1. CẤU HÌNH HỆ THỐNG
@@ -70,7 +79,6 @@ SYS_COL_TIME = "Thời điểm ghi"
 
 DEFAULT_BLOCK_NAME = "Block_Mac_Dinh"
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-LOG_BUFFER_SIZE = 5; LOG_FLUSH_INTERVAL = 10 
 
 # ==========================================
 # 2. AUTHENTICATION & BOT ENGINE
@@ -103,25 +111,46 @@ def get_bot_credentials_from_secrets(target_email):
             except: pass
     return None
 
+def open_history_sheet(): return get_sh_with_retry(get_master_creds(), st.secrets["gcp_service_account"]["history_sheet_id"])
+
 def assign_bot_to_block(block_name):
+    # [NEW] Gán bot theo tải lịch sử + giữ cố định (sys_bot_assign), dùng chung logic với auto_job
     valid_bots = [b for b in MY_BOT_LIST if b.strip() and "@" in b]
     if not valid_bots: return "No_Bot_Configured"
-    hash_val = sum(ord(c) for c in block_name)
-    return valid_bots[hash_val % len(valid_bots)]
+    try: return get_bot_assigner(valid_bots).assign(block_name, open_history_sheet)
+    except: return hash_bot_for_block(block_name, valid_bots)
+
+def plan_bot_rebalance(blocks):
+    # [NEW] Đề xuất chuyển block cũ giữa các bot cho đều tải (chưa ghi gì)
+    valid_bots = [b for b in MY_BOT_LIST if b.strip() and "@" in b]
+    return get_bot_assigner(valid_bots).plan_rebalance(open_history_sheet, blocks) if len(valid_bots) > 1 else []
+
+def apply_bot_rebalance(moves):
+    valid_bots = [b for b in MY_BOT_LIST if b.strip() and "@" in b]
+    return get_bot_assigner(valid_bots).apply_moves(moves, open_history_sheet) if valid_bots else 0
+
+def inherit_bot_for_block(new_block, old_block):
+    valid_bots = [b for b in MY_BOT_LIST if b.strip() and "@" in b]
+    if valid_bots: get_bot_assigner(valid_bots).inherit(new_block, old_block, open_history_sheet)
 
 # --- STANDARD UTILS ---
 def safe_api_call(func, *args, **kwargs):
+    # [NEW] 429/quota đã được rate limiter của bot xử lý (chờ theo Retry-After) -> ở đây chỉ retry lỗi tạm thời khác
     for i in range(5):
         try: return func(*args, **kwargs)
         except Exception as e:
-            if "429" in str(e) or "quota" in str(e).lower(): time.sleep((2**i)+3)
+            if is_quota_error(e): return None
             elif i==4: raise e
             else: time.sleep(2)
     return None
 
 def safe_get_as_dataframe(wks, **kwargs): return safe_api_call(get_as_dataframe, wks, **kwargs)
 def safe_set_with_dataframe(wks, df, **kwargs): return safe_api_call(set_with_dataframe, wks, df, **kwargs)
-def get_sh_with_retry(creds, sid): gc = gspread.authorize(creds); return safe_api_call(gc.open_by_key, sid)
+# [NEW] Sổ client gspread theo service account (1 session keep-alive / bot), sống cùng tiến trình server
+@st.cache_resource
+def get_client_registry(): return ClientRegistry()
+def get_client(creds): return authorize(creds, get_client_registry())
+def get_sh_with_retry(creds, sid): gc = get_client(creds); return safe_api_call(gc.open_by_key, sid)
 
 def extract_id(url):
     if not isinstance(url, str): return None
@@ -137,21 +166,18 @@ def ensure_sheet_headers(wks, required_columns):
     except: pass
 
 # --- LOGGING ---
-def init_log_buffer():
-    if 'log_buffer' not in st.session_state: st.session_state['log_buffer'] = []
-    if 'last_log_flush' not in st.session_state: st.session_state['last_log_flush'] = time.time()
-def flush_logs(creds, force=False):
-    buf = st.session_state.get('log_buffer', [])
-    if (force or len(buf)>=LOG_BUFFER_SIZE) and buf:
-        try:
-            sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-            try: wks = sh.worksheet(SHEET_ACTIVITY_NAME)
-            except: wks = sh.add_worksheet(SHEET_ACTIVITY_NAME, 1000, 4)
-            safe_api_call(wks.append_rows, buf); st.session_state['log_buffer'] = []
-        except: pass
+# [NEW] Log ghi nền qua LogSink (kinkin_core): hàng đợi + 1 luồng ghi gom theo tab, 1 sink / tiến trình server
+LOG_TAB_HEADERS = {SHEET_LOG_NAME: ["Thời gian", "Vùng lấy", "Tháng", "User", "Link Nguồn", "Link Đích", "Sheet Đích", "Sheet Nguồn", "Kết Quả", "Số Dòng", "Range", "Block"]}
+@st.cache_resource
+def get_log_sink():
+    creds = get_master_creds(); history_id = st.secrets["gcp_service_account"]["history_sheet_id"]
+    return LogSink(lambda: get_sh_with_retry(creds, history_id), LOG_TAB_HEADERS, call=safe_api_call,
+                   on_error=lambda tab, n, e: print(f"⚠️ Bỏ {n} dòng log tab {tab}: {e}"))
+def flush_logs(creds=None, force=False):
+    # Sink tự ghi theo lô / theo thời gian; force -> báo ghi ngay (không chờ)
+    if force: get_log_sink().flush(wait=False)
 def log_user_action_buffered(creds, user_id, action, status="", force_flush=False):
-    init_log_buffer()
-    st.session_state['log_buffer'].append([datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime("%d/%m/%Y %H:%M:%S"), user_id, action, status])
+    get_log_sink().log(SHEET_ACTIVITY_NAME, [datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime("%d/%m/%Y %H:%M:%S"), user_id, action, status])
     flush_logs(creds, force=force_flush)
 
 def detect_df_changes(df_old, df_new):
@@ -242,7 +268,7 @@ def show_guide_popup():
     | Tên Cột | Giải thích bình dân | Ví dụ điền |
     | :--- | :--- | :--- |
     | **Trạng thái** | Phải chọn **"Chưa chốt..."** thì dòng này mới được chạy. Nếu chọn "Đã chốt", Tool sẽ bỏ qua. | `Chưa chốt...` |
-    | **Cách ghi** | • **Ghi Đè:** Xóa cái cũ (của link nguồn này) đi, viết cái mới vào.<br>• **Ghi Nối Tiếp:** Cái cũ giữ nguyên, viết thêm cái mới xuống dưới đáy. | `Ghi Đè` |
+    | **Cách ghi** | • **Ghi Đè:** Xóa cái cũ (của link nguồn này) đi, viết cái mới vào.<br>• **Ghi Nối Tiếp:** Cái cũ giữ nguyên, viết thêm cái mới xuống dưới đáy.<br>• **Ghi Đè Tại Chỗ:** Viết cái mới đè lên đúng chỗ cái cũ (không dời dòng, công thức tham chiếu vẫn đúng), chỉ thêm/bớt số dòng chênh lệch.<br>• **Đồng Bộ Thay Đổi:** Như Tại Chỗ nhưng chỉ viết lại những dòng thật sự thay đổi (so bằng cột ẩn `Row_Hash`), dòng không đổi giữ nguyên cả Thời điểm ghi. | `Ghi Đè` |
     | **Vùng lấy** | Bạn muốn lấy dữ liệu từ cột nào đến cột nào? | `A:Z` (Lấy hết bảng)<br>`A:E` (Chỉ lấy cột A đến E) |
     | **Link nguồn** | Địa chỉ web của file chứa dữ liệu gốc. | `https://docs.google...` |
     | **Tên sheet** | Tên cái tab nhỏ bên dưới file Excel/Sheet mà bạn muốn lấy. | `Sheet1` hoặc `Data_Thang_3` |
@@ -351,6 +377,7 @@ def save_scheduler_config(df_sched, creds, user_id, type_run, v1, v2):
 
 def fetch_activity_logs(creds, limit=50):
     try:
+        get_log_sink().flush()  # Log còn trong hàng đợi -> ghi xong rồi mới đọc
         sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
         wks = sh.worksheet(SHEET_ACTIVITY_NAME)
         df = safe_get_as_dataframe(wks, evaluate_formulas=True, dtype=str)
@@ -359,145 +386,61 @@ def fetch_activity_logs(creds, limit=50):
 
 def write_detailed_log(creds, log_data_list):
     if not log_data_list: return
-    try:
-        sh = get_sh_with_retry(creds, st.secrets["gcp_service_account"]["history_sheet_id"])
-        try: wks = sh.worksheet(SHEET_LOG_NAME)
-        except: 
-            wks = sh.add_worksheet(SHEET_LOG_NAME, rows=1000, cols=15)
-            wks.append_row(["Thời gian", "Vùng lấy", "Tháng", "User", "Link Nguồn", "Link Đích", "Sheet Đích", "Sheet Nguồn", "Kết Quả", "Số Dòng", "Range", "Block"])
-
-        cleaned = [[str(x) for x in row] for row in log_data_list]
-        safe_api_call(wks.append_rows, cleaned)
-    except: pass
+    # [NEW] Chỉ bỏ vào hàng đợi log, luồng nền ghi gộp (tab chưa có -> tạo kèm dòng tiêu đề LOG_TAB_HEADERS)
+    get_log_sink().log_rows(SHEET_LOG_NAME, [[str(x) for x in row] for row in log_data_list])
 
 # ==========================================
 # 4. CORE ETL
 # ==========================================
-# --- [NEW] HÀM XỬ LÝ NGÀY ĐỘNG ---
-def parse_dynamic_date(val_str):
-    """Biến đổi TODAY-1, YESTERDAY thành ngày cụ thể"""
-    if not isinstance(val_str, str): return val_str
-
-    # Chuẩn hóa chuỗi (xóa khoảng trắng, dấu nháy)
-    val_upper = val_str.strip().upper().replace(" ", "").replace("'", "").replace('"', "")
-
-    # Lấy ngày hôm nay (0h sáng) theo giờ VN
-    tz = pytz.timezone('Asia/Ho_Chi_Minh')
-    now = datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
-
-    # Xử lý TODAY
-    if "TODAY" in val_upper:
-        calc_part = val_upper.replace("TODAY()", "").replace("TODAY", "")
-        if not calc_part: return now # Là TODAY
-        try:
-            days = int(calc_part) # Python hiểu -1 là trừ 1 ngày
-            return now + timedelta(days=days)
-        except: pass
-
-    # Xử lý YESTERDAY
-    if val_upper == "YESTERDAY": return now - timedelta(days=1)
-
-    return val_str # Trả về nguyên gốc nếu không phải biến động
-
+# --- [NEW] BỘ LỌC: biên dịch 1 lần (cache theo chuỗi lọc), gộp mọi điều kiện thành 1 mask (kinkin_core) ---
 def apply_smart_filter_v90(df, filter_str, debug_container=None):
-    if not filter_str or str(filter_str).strip().lower() in ['nan', 'none', 'null', '']: return df, None
-    conditions = str(filter_str).split(';')
-    current_df = df.copy()
-    if debug_container: debug_container.markdown(f"**🔍 Lọc: {len(current_df)} dòng gốc**")
+    return apply_compiled_filter(df, filter_str, strict=True, debug_container=debug_container)
 
-    for cond in conditions:
-        fs = cond.strip()
-        if not fs: continue 
-        op_list = [" contains ", "==", "!=", ">=", "<=", ">", "<", "="]
-        op = next((o for o in op_list if o in fs), None)
-        if not op: return None, f"Lỗi cú pháp: '{fs}'"
-
-        parts = fs.split(op, 1)
-        col_raw = parts[0].strip().replace("`", "").replace("'", "").replace('"', "")
-        val_raw = parts[1].strip()
-
-        # [MỚI] Xử lý ngày động (VD: TODAY-1) trước khi lọc
-        val_resolved = parse_dynamic_date(val_raw)
-
-        # Làm sạch giá trị chuỗi (bỏ dấu nháy bao quanh)
-        val_clean = val_raw[1:-1] if (isinstance(val_raw, str) and (val_raw.startswith("'") or val_raw.startswith('"'))) else val_raw
-
-        real_col = next((c for c in current_df.columns if str(c).lower() == col_raw.lower()), None)
-        if not real_col: return None, f"Không tìm thấy cột '{col_raw}'"
+def normalize_month(month_raw):
+    """01/2026 thay vì 1/2026 (nếu tháng chỉ có 1 chữ số thì thêm số 0 đằng trước)"""
+    month_raw = str(month_raw).strip()
+    parts = month_raw.split("/")
+    if len(parts) == 2 and len(parts[0]) == 1 and parts[0].isdigit(): return f"0{parts[0]}/{parts[1]}"
+    return month_raw
 
+def fetch_frame_polars(unique_headers, body_rows, target_headers, data_range_str, raw_filter, include_header, status_container=None):
+    """
+    [NEW] Engine Polars cho fetch_data_v4: đổi tên theo header đích, cắt vùng cột, lọc, thêm dòng header.
+    Trả về (DataFrame pandas toàn chuỗi y hệt engine pandas, lỗi). (None, None) = tên cột bị trùng / vùng không còn cột
+    nào -> để pandas xử lý (pandas giữ đủ số dòng, chỉ có cột hệ thống).
+    """
+    names = list(unique_headers); keep = list(range(len(names)))
+    if target_headers:
+        min_cols = min(len(names), len(target_headers))
+        names = ([target_headers[i] for i in range(min_cols)] + names[min_cols:])[:len(target_headers)]
+        keep = keep[:len(target_headers)]
+    if data_range_str != "Lấy hết" and ":" in data_range_str:
         try:
-            series = current_df[real_col]
-            if op == " contains ": 
-                current_df = current_df[series.astype(str).str.contains(val_clean, case=False, na=False)]
-            else:
-                # Logic so sánh
-                is_dt = False
-                v_dt = None
-
-                # Check 1: Nếu giá trị so sánh là datetime (do hàm parse_dynamic_date trả về)
-                if isinstance(val_resolved, datetime):
-                    is_dt = True
-                    # Bỏ múi giờ để so sánh với dữ liệu trong Sheet (thường không có múi giờ)
-                    v_dt = pd.to_datetime(val_resolved).tz_localize(None)
-                else:
-                    # Check 2: Thử parse string thường
-                    try: 
-                        s_dt = pd.to_datetime(series, dayfirst=True, errors='coerce')
-                        v_dt_try = pd.to_datetime(val_clean, dayfirst=True)
-                        if s_dt.notna().any() and pd.notna(v_dt_try): 
-                            is_dt = True
-                            v_dt = v_dt_try
-                    except: pass
-
-                is_num = False
-                if not is_dt:
-                    try: s_num = pd.to_numeric(series, errors='coerce'); v_num = float(val_clean); is_num = True
-                    except: pass
-
-                if is_dt:
-                    # Chuyển cột series sang datetime
-                    s_dt = pd.to_datetime(series, dayfirst=True, errors='coerce')
-                    if op==">": current_df=current_df[s_dt>v_dt]
-                    elif op=="<": current_df=current_df[s_dt<v_dt]
-                    elif op==">=": current_df=current_df[s_dt>=v_dt]
-                    elif op=="<=": current_df=current_df[s_dt<=v_dt]
-                    elif op in ["=","=="]: current_df=current_df[s_dt==v_dt]
-                    elif op=="!=": current_df=current_df[s_dt!=v_dt]
-                elif is_num:
-                    if op==">": current_df=current_df[s_num>v_num]
-                    elif op=="<": current_df=current_df[s_num<v_num]
-                    elif op==">=": current_df=current_df[s_num>=v_num]
-                    elif op=="<=": current_df=current_df[s_num<=v_num]
-                    elif op in ["=","=="]: current_df=current_df[s_num==v_num]
-                    elif op=="!=": current_df=current_df[s_num!=v_num]
-                else:
-                    s_str = series.astype(str).str.strip()
-                    val_str_cmp = str(val_clean)
-                    if op==">": current_df=current_df[s_str>val_str_cmp]
-                    elif op=="<": current_df=current_df[s_str<val_str_cmp]
-                    elif op==">=": current_df=current_df[s_str>=val_str_cmp]
-                    elif op=="<=": current_df=current_df[s_str<=val_str_cmp]
-                    elif op in ["=","=="]: current_df=current_df[s_str==val_str_cmp]
-                    elif op=="!=": current_df=current_df[s_str!=val_str_cmp]
-
-            if debug_container: debug_container.caption(f"👉 Lọc '{val_clean}' ({op}) -> Còn {len(current_df)}")
-        except Exception as e: return None, f"Lỗi '{fs}': {e}"
-    return current_df, None
-def fetch_data_v4(row_config, bot_creds, target_headers=None, status_container=None):
+            s, e = data_range_str.split(":")
+            s_idx = col_name_to_index(s.strip()); e_idx = col_name_to_index(e.strip())
+            if s_idx >= 0: keep = keep[s_idx : e_idx + 1]
+        except: pass
+    names = [names[i] for i in keep]
+    # [FIX] Tiêu đề vẫn trùng sau khi đánh số (vd a, a, a_1) -> Polars không nhận cột trùng, để pandas xử lý
+    if not keep or len(set(names)) != len(names) or len(set(unique_headers)) != len(unique_headers): return None, None
+
+    df_pl = pl_frame_from_values(unique_headers, body_rows).select([pl.nth(i) for i in keep])
+    df_pl = df_pl.rename(dict(zip(df_pl.columns, names)))
+    if raw_filter:
+        df_pl, err = pl_apply_filter(df_pl, raw_filter, strict=True, debug_container=status_container)
+        if err: return None, err
+
+    empty_vals = ['nan', 'None', '<NA>', 'null']
+    df_pl = df_pl.with_columns([pl.when(pl.col(c).is_in(empty_vals)).then(pl.lit("")).otherwise(pl.col(c)).alias(c) for c in df_pl.columns])
+    rows = [list(r) for r in df_pl.iter_rows()]
+    if include_header: rows.insert(0, ["" if str(c) in empty_vals else str(c) for c in df_pl.columns])
+    return pd.DataFrame(rows, columns=df_pl.columns, dtype=object), None
+
+def fetch_data_v4(row_config, bot_creds, target_headers=None, status_container=None, source_cache=None, engine=ENGINE_PANDAS):
     link_src = str(row_config.get(COL_SRC_LINK, '')).strip()
     source_label = str(row_config.get(COL_SRC_SHEET, '')).strip()
     # [FIX] Chuẩn hóa Tháng: Luôn đảm bảo dạng 01/2026 (2 chữ số cho tháng)
-    month_raw = str(row_config.get(COL_MONTH, '')).strip()
-    month_val = month_raw
-    if "/" in month_raw:
-        try:
-            parts = month_raw.split("/")
-            if len(parts) == 2:
-                m_part, y_part = parts
-                # Nếu tháng chỉ có 1 chữ số (vd: 1, 2..9) -> Thêm số 0 đằng trước
-                if len(m_part) == 1 and m_part.isdigit():
-                    month_val = f"0{m_part}/{y_part}"
-        except: pass
+    month_val = normalize_month(row_config.get(COL_MONTH, ''))
     raw_range = str(row_config.get(COL_DATA_RANGE, '')).strip()
     data_range_str = "Lấy hết" if raw_range.lower() in ['nan', 'none', 'null', '', 'lấy hết'] else raw_range
     raw_filter = str(row_config.get(COL_FILTER, '')).strip()
@@ -511,17 +454,40 @@ def fetch_data_v4(row_config, bot_creds, target_headers=None, status_container=N
     if not sheet_id: return None, sheet_id, "Link lỗi"
 
     try:
-        sh_source = get_sh_with_retry(bot_creds, sheet_id)
-        wks_source = sh_source.worksheet(source_label) if source_label else sh_source.sheet1
-        data = safe_api_call(wks_source.get_all_values)
-        if not data: return pd.DataFrame(), sheet_id, "Sheet trắng"
-
-        header_row = data[0]; body_rows = data[1:]
+        # [NEW] Nhiều dòng cấu hình cùng 1 nguồn -> chỉ tải 1 lần; các tab/vùng khác cùng file tải gộp 1 lệnh batchGet
+        key = source_key(sheet_id, source_label, raw_range)
+        gc_src = get_client(bot_creds)
+        load_source = make_source_loader(source_cache, key, lambda: gc_src.open_by_key(sheet_id), safe_api_call)
+        loaded = source_cache.get(key, load_source) if source_cache is not None else load_source()
+        if not loaded or not loaded[1]: return pd.DataFrame(), sheet_id, "Sheet trắng"
+        header_full, data, col_offset = loaded
+
+        body_rows = data[1:]
+        if col_offset is not None:
+            # Đã cắt sẵn vùng cột: đặt tên cột theo dòng 1 đầy đủ + header đích lệch theo cột bắt đầu (giống cắt tại chỗ)
+            width = len(data[0])
+            header_row = header_full + [""] * (col_offset + width - len(header_full))
+            if target_headers:
+                target_headers = target_headers[col_offset:]
+                if not target_headers: width = 0; body_rows = [[] for _ in body_rows]
+            data_range_str = "Lấy hết"
+        else: header_row = data[0]
         unique_headers = []
         seen = {}
         for col in header_row:
             if col in seen: seen[col] += 1; unique_headers.append(f"{col}_{seen[col]}")
             else: seen[col] = 0; unique_headers.append(col)
+        if col_offset is not None: unique_headers = unique_headers[col_offset : col_offset + width]
+
+        if resolve_engine(engine) == ENGINE_POLARS:
+            df_final, err = fetch_frame_polars(unique_headers, body_rows, target_headers, data_range_str, raw_filter, include_header, status_container)
+            if err: return None, sheet_id, f"⚠️ {err}"
+            if df_final is not None:
+                df_final[SYS_COL_LINK] = link_src.strip()
+                df_final[SYS_COL_SHEET] = source_label.strip()
+                df_final[SYS_COL_MONTH] = month_val.strip()
+                df_final[SYS_COL_TIME] = datetime.now().strftime("%d/%m/%Y")
+                return df_final, sheet_id, "Thành công"
 
         df_working = pd.DataFrame(body_rows, columns=unique_headers)
 
@@ -558,89 +524,29 @@ def fetch_data_v4(row_config, bot_creds, target_headers=None, status_container=N
         return df_final, sheet_id, "Thành công"
     except Exception as e: return None, sheet_id, f"Lỗi tải: {str(e)}"
 
-def get_rows_to_delete_dynamic(wks, keys_to_delete, log_container):
+def get_rows_to_delete_dynamic(wks, keys_to_delete, log_container, row_index=None):
     """
     V110.1: Quét toàn bộ sheet (Deep Scan) để tìm dòng cần xóa.
     Khắc phục lỗi dừng quét khi gặp header lặp lại hoặc dòng trống giữa chừng.
+    [NEW] Chỉ đọc 10 dòng đầu (tìm tiêu đề) + 3 cột khóa Src_Link/Src_Sheet/Month, không tải cả sheet.
+    [NEW] Có chỉ mục vị trí dòng (tab ẩn _kinkin_index) thì chỉ kiểm tra đúng các dòng đó; lệch -> quét lại & dựng lại chỉ mục.
     """
     try:
-        # 1. Lấy toàn bộ dữ liệu thô (List of Lists) - Cách nhanh nhất
-        all_values = safe_api_call(wks.get_all_values)
-        if not all_values or len(all_values) < 2: return []
-
-        # 2. Tìm dòng tiêu đề CHÍNH (thường là dòng 1) để xác định vị trí cột
-        # Chúng ta chỉ tìm tiêu đề ở 10 dòng đầu tiên để tránh nhầm lẫn
-        header_row_idx = -1
-        headers = []
-
-        for i in range(min(10, len(all_values))):
-            row_lower = [str(c).strip().lower() for c in all_values[i]]
-            if SYS_COL_LINK.lower() in row_lower and SYS_COL_SHEET.lower() in row_lower:
-                header_row_idx = i
-                headers = row_lower
-                break
-
-        if header_row_idx == -1:
+        # Lấy giá trị và làm sạch (strip)
+        # Dòng Header lặp lại (do copy paste cũ) có giá trị "Src_Link"... -> Không khớp Key (URL) -> Không bị xóa
+        match = lambda vals: tuple(str(v).strip() for v in vals) in keys_to_delete
+        index_keys = set(normalize_row_key(*k) for k in keys_to_delete)
+        rows_to_delete = safe_api_call(locate_overwrite_rows, wks, [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH], index_keys, match, row_index)
+        if rows_to_delete is None:
             if log_container: log_container.warning("⚠️ Không tìm thấy dòng tiêu đề hệ thống (Src_Link...). Không thể xóa.")
             return []
-
-        # 3. Xác định chỉ số cột (Index)
-        try:
-            idx_link = headers.index(SYS_COL_LINK.lower())
-            idx_sheet = headers.index(SYS_COL_SHEET.lower())
-            idx_month = headers.index(SYS_COL_MONTH.lower())
-        except ValueError:
-            return []
-
-        rows_to_delete = []
-
-        # 4. QUÉT TOÀN BỘ (Deep Scan) từ ngay sau dòng header chính
-        # Không dùng break, quét đến tận dòng cuối cùng
-        total_rows = len(all_values)
-
-        for i in range(header_row_idx + 1, total_rows):
-            row = all_values[i]
-
-            # Xử lý an toàn nếu dòng dữ liệu bị thiếu cột (ngắn hơn header)
-            if len(row) <= max(idx_link, idx_sheet, idx_month):
-                continue # Bỏ qua dòng lỗi format
-
-            # Lấy giá trị và làm sạch (strip)
-            val_link = str(row[idx_link]).strip()
-            val_sheet = str(row[idx_sheet]).strip()
-            val_month = str(row[idx_month]).strip()
-
-            # Kiểm tra: Nếu dòng này là một dòng Header lặp lại (do copy paste cũ)
-            # Thì nó sẽ có giá trị là "Src_Link", "Src_Sheet"... -> Không khớp Key (URL) -> Không bị xóa
-            # Nếu bạn muốn xóa luôn cả dòng header thừa đó, hãy báo tôi.
-            # Hiện tại logic là: Chỉ xóa dòng có DỮ LIỆU trùng khớp.
-
-            if (val_link, val_sheet, val_month) in keys_to_delete:
-                rows_to_delete.append(i + 1) # +1 vì gspread dùng index bắt đầu từ 1
-
         return rows_to_delete
 
     except Exception as e:
         print(f"Lỗi Deep Scan: {e}")
         return []
 
-def batch_delete_rows(sh, sheet_id, row_indices, log_container=None):
-    if not row_indices: return
-    row_indices.sort(reverse=True) 
-    ranges = []
-    if len(row_indices) > 0:
-        start = row_indices[0]; end = start
-        for r in row_indices[1:]:
-            if r == start - 1: start = r
-            else: ranges.append((start, end)); start = r; end = r
-        ranges.append((start, end))
-    requests = [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": s-1, "endIndex": e}}} for s, e in ranges]
-    for i in range(0, len(requests), 100):
-        if log_container: log_container.write(f"✂️ Xóa batch {i//100 + 1}...")
-        safe_api_call(sh.batch_update, {'requests': requests[i:i+100]})
-        time.sleep(1)
-
-def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, bot_creds, log_container):
+def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, bot_creds, log_container, schema_cache=None):
     result_map = {}; debug_data = [] 
     try:
         target_id = extract_id(target_link)
@@ -652,10 +558,13 @@ def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, bot_creds,
         all_titles = [s.title for s in safe_api_call(sh.worksheets)]
         if real_sheet_name in all_titles: wks = sh.worksheet(real_sheet_name)
         else: wks = sh.add_worksheet(title=real_sheet_name, rows=1000, cols=20)
+        # [NEW] Chỉ mục (nguồn, tab, tháng) -> đoạn dòng ở tab đích, cập nhật sau mỗi lần xóa / ghi
+        try: row_index = TargetRowIndex(sh, real_sheet_name)
+        except: row_index = None
 
         # 2. Xử lý Header
         # Xử lý Header
-        existing_headers = safe_api_call(wks.row_values, 1)
+        existing_headers = header_row(wks, safe_api_call); header_change = None
         if not existing_headers:
             # Sheet trắng -> Tạo header mới từ dữ liệu đầu tiên
             if not tasks_list: return True, "No Data", {}, []
@@ -663,114 +572,128 @@ def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, bot_creds,
             final_headers = first_df.columns.tolist()
             wks.update(range_name="A1", values=[final_headers])
             existing_headers = final_headers
+            if row_index: row_index.reset()
         else:
             # Sheet đã có -> Bổ sung cột hệ thống nếu thiếu
             updated = existing_headers.copy(); added = False
             for col in [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]:
                 if col not in updated: updated.append(col); added = True
+            # [NEW] Dòng tiêu đề mới được ghi chung 1 lệnh batchUpdate với phần xóa dòng cũ (apply_target_write)
             if added: 
-                wks.update(range_name="A1", values=[updated])
+                header_change = updated
                 existing_headers = updated
 
+        # [NEW] Ghi Đè Tại Chỗ: khối cũ liền nhau -> ghi đè đúng chỗ (1 lệnh ghi), không thì làm như Ghi Đè thường
+        # [NEW] Đồng Bộ Thay Đổi: như Tại Chỗ nhưng chỉ chèn / xóa / ghi các dòng có hash (cột ẩn Row_Hash) khác
+        inplace_done = {}; remaining_tasks = []
+        need_hash = any(is_diff_mode(t[3]) for t in tasks_list)  # [FIX] Đồng Bộ quay về nối vẫn phải điền Row_Hash
+        for df, src_link, row_idx, w_mode in tasks_list:
+            if df.empty or not (is_inplace_mode(w_mode) or is_diff_mode(w_mode)): remaining_tasks.append((df, src_link, row_idx, w_mode)); continue
+            if header_change: apply_target_write(sh, wks, [], (), header_change, safe_api_call); header_change = None
+            raw_link = str(df[SYS_COL_LINK].iloc[0]).strip(); l_id = extract_id(raw_link) or raw_link
+            s_key = str(df[SYS_COL_SHEET].iloc[0]).strip(); m_key = str(df[SYS_COL_MONTH].iloc[0]).strip()
+            apply_schema(df, l_id, s_key, schema_cache); protect_text_codes(df)
+            log_container.write(f"🔍 [{w_mode}] Đang tìm khối dữ liệu cũ...")
+            rows_old = get_rows_to_delete_dynamic(wks, {(raw_link, s_key, m_key), (l_id, s_key, m_key)}, log_container, row_index)
+            row_key = normalize_row_key(raw_link, s_key, m_key)
+            sys_cols_ip = [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]
+            if is_diff_mode(w_mode):
+                existing_headers = ensure_hash_column(sh, wks, existing_headers)
+                inplace_cols = [h for h in existing_headers if h in df.columns or h in sys_cols_ip + [SYS_COL_HASH]]
+                skip_pos = [inplace_cols.index(SYS_COL_TIME)] if SYS_COL_TIME in inplace_cols else []
+                span = write_rows_diff(sh, wks, rows_old, FrameRows(df).rows(inplace_cols), inplace_cols.index(SYS_COL_HASH), skip_pos, row_index, row_key)
+                if span: log_container.write(f"✅ Đồng bộ {len(df)} dòng ({span[0]} - {span[1]}), chỉ ghi {span[2]} dòng đổi.")
+            else:
+                inplace_cols = [h for h in existing_headers if h in df.columns or h in sys_cols_ip]
+                span = write_rows_in_place(sh, wks, rows_old, FrameRows(df).rows(inplace_cols), row_index, row_key)
+                if span: log_container.write(f"✅ Đã ghi tại chỗ {len(df)} dòng ({span[0]} - {span[1]}).")
+            if span: inplace_done[row_idx] = (f"{span[0]} - {span[1]}", len(df), src_link, w_mode)
+            else: remaining_tasks.append((df, src_link, row_idx, "Ghi Đè"))
+        # [NEW] Thay tại chỗ trong list (không gán lại) để DataFrame đã ghi xong được giải phóng ngay
+        tasks_list[:] = remaining_tasks; del remaining_tasks
+
         # 3. Chuẩn bị dữ liệu
-        final_df_to_write = pd.DataFrame()
+        # [NEW] Không gộp pd.concat nữa: chỉ gom key cần xóa + tập cột nguồn, dữ liệu được căn cột và ghi dần ở bước 5
         keys_to_delete = set() # Chứa danh sách các key cần xóa (cho Ghi Đè)
-        keys_to_delete = set() 
+        src_cols = set(); metas = []; index_keys = []  # metas: (số dòng, link, row_idx, mode) để trả kết quả sau khi đã nhả DataFrame
 
         for df, src_link, row_idx, w_mode in tasks_list:
-            if df.empty: continue
-            # Convert số liệu
-            for c in df.columns:
-                try: df[c] = pd.to_numeric(df[c])
-                except: pass
-
-            # Luôn gom dữ liệu vào danh sách chờ ghi (Cho cả Ghi Đè và Nối Tiếp)
-            final_df_to_write = pd.concat([final_df_to_write, df], ignore_index=True)
+            metas.append((len(df), src_link, row_idx, w_mode))
+            if df.empty: index_keys.append(None); continue
+            src_cols.update(df.columns)
+            index_keys.append(normalize_row_key(df[SYS_COL_LINK].iloc[0], df[SYS_COL_SHEET].iloc[0], df[SYS_COL_MONTH].iloc[0]))
 
             # LOGIC QUAN TRỌNG TẠI ĐÂY:
-            if w_mode == "Ghi Đè":
-                # Nếu là Ghi Đè -> Thêm key này vào danh sách "Sổ Đen" để xóa dữ liệu cũ đi
-                l_key = str(df[SYS_COL_LINK].iloc[0]).strip()
+            # Nếu là Ghi Đè -> Thêm key này vào danh sách "Sổ Đen" để xóa dữ liệu cũ đi
             mode_clean = str(w_mode).strip().lower()
             if "đè" in mode_clean or "overwrite" in mode_clean:
                 raw_link = str(df[SYS_COL_LINK].iloc[0]).strip()
                 l_id = extract_id(raw_link); l_id = l_id if l_id else raw_link
                 s_key = str(df[SYS_COL_SHEET].iloc[0]).strip()
                 m_key = str(df[SYS_COL_MONTH].iloc[0]).strip()
-                keys_to_delete.add((l_key, s_key, m_key))
-            
-            # Nếu là "Ghi Nối Tiếp" -> Không làm gì cả (Không thêm vào keys_to_delete)
-            # Code sẽ tự động bỏ qua bước xóa và chỉ thực hiện bước Ghi ở dưới.
-                keys_to_delete.add((l_id, s_key, m_key))
+                # [FIX] Cột Src_Link lưu link gốc -> giữ cả key link gốc lẫn key ID để quét cả tab vẫn khớp
+                keys_to_delete.add((raw_link, s_key, m_key)); keys_to_delete.add((l_id, s_key, m_key))
+            # Nếu là "Ghi Nối Tiếp" -> Không thêm vào keys_to_delete, chỉ thực hiện bước Ghi ở dưới.
 
         # 4. Thực hiện XÓA (Chỉ chạy nếu có task Ghi Đè)
-        # Thực hiện Xóa
+        rows_to_del = []
         if keys_to_delete:
-            log_container.write(f"🔍 Đang quét dữ liệu cũ để Ghi Đè...")
             log_container.write(f"🔍 [Ghi Đè] Đang quét dữ liệu cũ để xóa...")
-            rows_to_del = get_rows_to_delete_dynamic(wks, keys_to_delete, log_container)
+            rows_to_del = get_rows_to_delete_dynamic(wks, keys_to_delete, log_container, row_index)
             
             if rows_to_del:
-                log_container.write(f"✂️ Đang xóa {len(rows_to_del)} dòng cũ...")
-                batch_delete_rows(sh, wks.id, rows_to_del, log_container)
-                log_container.write("✅ Đã xóa xong. Dữ liệu cũ đã được đẩy lên.")
-                # Bắt buộc nghỉ để Google cập nhật lại index dòng sau khi xóa
-                log_container.write("✅ Đã xóa xong.")
-                time.sleep(3) 
+                # [NEW] Chưa xóa ngay: ghi dữ liệu mới xong mới xóa (chung 1 lệnh batchUpdate, không cần nghỉ chờ)
+                log_container.write(f"✂️ Sẽ xóa {len(rows_to_del)} dòng cũ ngay sau khi ghi dữ liệu mới...")
             else:
                 log_container.write("ℹ️ Không tìm thấy dữ liệu cũ để xóa (Ghi mới hoàn toàn).")
 
         # 5. Thực hiện GHI (Append xuống dòng cuối cùng)
-        # ... (đoạn trên giữ nguyên) ...
-        # [FIX QUAN TRỌNG] Khởi tạo start_row_idx RA NGOÀI lệnh if
-        # Để đảm bảo biến này luôn tồn tại dù có ghi dữ liệu hay không
-        current_vals = safe_api_call(wks.get_all_values)
-        start_row_idx = len(current_vals) + 1 if current_vals else 1
-
-        if not final_df_to_write.empty:
-            # [FIX QUAN TRỌNG] CHỈ GHI CỘT CÓ TRONG DỮ LIỆU NGUỒN
-            # Code cũ: Lấy toàn bộ header file đích -> Cột nào thiếu thì điền "" -> Mất công thức
-            # Code mới: Chỉ lấy giao điểm (Intersection) giữa Header Đích và Dữ Liệu Nguồn
-            
-            # 1. Xác định các cột hệ thống bắt buộc phải có
-            # Lọc cột an toàn (tránh ghi đè công thức)
-            sys_cols = [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]
-            
-            # 2. Lọc ra các cột cần ghi: Phải tồn tại trong file đích VÀ (có trong file nguồn HOẶC là cột hệ thống)
-            cols_to_write = []
-            for h in existing_headers:
-                if h in final_df_to_write.columns or h in sys_cols:
-                    cols_to_write.append(h)
-
-            # 3. Chỉ tạo dataframe với các cột cho phép này
-            # Các cột thừa (như AA, AB chứa công thức) sẽ không có mặt trong df_aligned
-            df_aligned = pd.DataFrame()
-            for col in cols_to_write:
-                # Nếu cột có trong data nguồn thì lấy, nếu là cột hệ thống mà chưa có thì để trống (sau này fillna)
-                if col in final_df_to_write.columns:
-                    df_aligned[col] = final_df_to_write[col]
-                else:
-                    df_aligned[col] = "" 
-                if col in final_df_to_write.columns: df_aligned[col] = final_df_to_write[col]
-                else: df_aligned[col] = "" 
+        # [NEW] Vị trí dòng lấy từ phản hồi append (updates.updatedRange), không đọc lại cả sheet đích
+        start_row_idx = None
+        total_new = sum(m[0] for m in metas)
+
+        # [FIX QUAN TRỌNG] CHỈ GHI CỘT CÓ TRONG DỮ LIỆU NGUỒN
+        # Chỉ lấy giao điểm giữa Header Đích và Dữ Liệu Nguồn (+ cột hệ thống) -> cột công thức (AA, AB...) không bị ghi đè
+        sys_cols = [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME] + ([SYS_COL_HASH] if need_hash else [])
+        cols_to_write = [h for h in existing_headers if h in src_cols or h in sys_cols]
+
+        def stream_rows():
+            """[NEW] Căn cột từng task, từng phần WRITE_STREAM_ROWS dòng; task ghi xong thì nhả DataFrame."""
+            for k in range(len(tasks_list)):
+                df = tasks_list[k][0]
+                if df.empty: continue
+                # Convert số liệu [NEW] theo schema đoán từ mẫu / cache theo nguồn, mỗi cột 1 lượt
+                raw_link = str(df[SYS_COL_LINK].iloc[0]).strip()
+                apply_schema(df, extract_id(raw_link) or raw_link, str(df[SYS_COL_SHEET].iloc[0]).strip(), schema_cache)
+                protect_text_codes(df)  # [FIX] mã "001" / số dài ở cột chữ thêm ' để USER_ENTERED giữ là chữ
+                yield from hash_rows(FrameRows(df).iter_rows(cols_to_write, WRITE_STREAM_ROWS), cols_to_write, [SYS_COL_TIME])
+                tasks_list[k] = None; del df
 
-            # ... (đoạn log giữ nguyên) ...
-            
-            log_container.write(f"🚀 Đang ghi {len(df_aligned)} dòng mới...")
-
-            # 4. Ghi dữ liệu
-            # Vì df_aligned bây giờ ngắn hơn (chỉ A:Z), nên gspread chỉ ghi đè A:Z
-            # Cột AA trở đi nằm ngoài vùng ghi -> An toàn tuyệt đối
-            new_vals = df_aligned.fillna('').values.tolist()
-            chunk_size = 5000
-            for i in range(0, len(new_vals), chunk_size):
-                safe_api_call(wks.append_rows, new_vals[i:i+chunk_size], value_input_option='USER_ENTERED')
-                time.sleep(1)
+        if total_new: log_container.write(f"🚀 Đang ghi {total_new} dòng mới...")
+
+        # [NEW] Kế hoạch ghi: nối dữ liệu mới rồi 1 lệnh batchUpdate (tiêu đề + xóa dòng cũ), không còn sleep cố định
+        if total_new or rows_to_del or header_change:
+            start_row_idx = apply_target_write(sh, wks, stream_rows(), rows_to_del, header_change, safe_api_call, WRITE_STREAM_ROWS, total_new)
+            if rows_to_del:
+                if row_index: row_index.delete_rows(rows_to_del)
+                log_container.write(f"✅ Đã xóa xong {len(rows_to_del)} dòng cũ.")
+            if total_new and start_row_idx is None:
+                # Phản hồi không có vị trí (append lỗi) -> đếm lại như cũ
+                current_vals = safe_api_call(wks.get_all_values)
+                start_row_idx = max(len(current_vals or []) - total_new, 0) + 1
+        if start_row_idx is None: start_row_idx = 1
+
+        # [NEW] Cập nhật chỉ mục vị trí dòng theo đúng thứ tự đã nối
+        if row_index:
+            cursor = int(start_row_idx)
+            for (count, src_link, row_idx, w_mode), row_key in zip(metas, index_keys):
+                if not count: continue
+                row_index.add_rows(row_key, cursor, cursor + count - 1); cursor += count
+            row_index.flush()
         
         # Tính toán Log kết quả trả về
         current_cursor = int(start_row_idx)
-        for df, src_link, row_idx, w_mode in tasks_list:
-            count = len(df)
+        for count, src_link, row_idx, w_mode in metas:
             if count > 0:
                 end = current_cursor + count - 1
                 rng_str = f"{current_cursor} - {end}"
@@ -780,8 +703,7 @@ def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, bot_creds,
 
             # Tính toán log trả về cho giao diện
             current_cursor = int(start_row_idx)
-            for df, src_link, row_idx, w_mode in tasks_list:
-                count = len(df)
+            for count, src_link, row_idx, w_mode in metas:
                 if count > 0:
                     end = current_cursor + count - 1
                     rng_str = f"{current_cursor} - {end}"
@@ -794,6 +716,10 @@ def write_strict_sync_v2(tasks_list, target_link, target_sheet_name, bot_creds,
             result_map[row_idx] = ("Thành công", rng_str, count)
             debug_data.append({"File": src_link[-10:], "Mode": w_mode})
 
+        for row_idx, (rng_str, count, src_link, w_mode) in inplace_done.items():
+            result_map[row_idx] = ("Thành công", rng_str, count)
+            debug_data.append({"File": src_link[-10:], "Mode": w_mode})
+
         return True, "Hoàn tất", result_map, debug_data
 
     except Exception as e: 
@@ -829,7 +755,27 @@ def check_permissions_ui(rows, creds, container, user_id):
     else: container.warning(f"⚠️ {err_count} link thiếu quyền.")
     log_user_action_buffered(creds, user_id, "Quét Quyền", f"Lỗi: {err_count}", force_flush=True)
 
-def process_pipeline_mixed(rows_to_run, user_id, block_name_run, status_container, forced_bot=None):
+PIPELINE_FETCH_WORKERS = 4   # số nguồn tải song song của 1 bot
+PIPELINE_LOOKAHEAD = 2        # số sheet đích được tải trước trong lúc đang ghi sheet đích hiện tại
+
+class UIProxy:
+    """Gọi st.* (write/info/success/error...) từ luồng phụ: chỉ đẩy vào hàng đợi, luồng chính vẽ bằng pump_ui()."""
+    def __init__(self, q, target): self.q = q; self.target = target
+    def __getattr__(self, name): return lambda *a, **kw: self.q.put((self.target, name, a, kw))
+
+def pump_ui(q, futures):
+    """Vẽ các lệnh UI trong hàng đợi cho tới khi mọi future xong (chạy ở luồng chính)."""
+    while True:
+        done = all(f.done() for f in futures)
+        try:
+            while True:
+                target, name, a, kw = q.get(timeout=0.1 if not done else 0)
+                try: getattr(target, name)(*a, **kw)
+                except: pass
+        except queue.Empty: pass
+        if done: return
+
+def process_pipeline_mixed(rows_to_run, user_id, block_name_run, status_container, forced_bot=None, skip_unchanged=True, source_cache=None, engine=ENGINE_PANDAS):
     master_creds = get_master_creds()
     if not acquire_lock(master_creds, user_id): st.error("⚠️ Hệ thống bận!"); return False, {}, 0
 
@@ -842,54 +788,118 @@ def process_pipeline_mixed(rows_to_run, user_id, block_name_run, status_containe
             st.error(f"❌ Không tìm thấy key cho {assigned_bot_email}. Check Secrets!"); return False, {}, 0
 
         grouped = defaultdict(list)
+        if source_cache is None: source_cache = SourceCache()
         for r in rows_to_run:
             if str(r.get(COL_STATUS, '')).strip() == "Chưa chốt & đang cập nhật":
                 key = (str(r.get(COL_TGT_LINK, '')).strip(), str(r.get(COL_TGT_SHEET, '')).strip())
                 grouped[key].append(r)
+                sid_r = extract_id(str(r.get(COL_SRC_LINK, '')).strip())
+                if sid_r: source_cache.expect(source_key(sid_r, str(r.get(COL_SRC_SHEET, '')).strip(), r.get(COL_DATA_RANGE, '')))
 
         final_res_map = {}; all_ok = True; total_rows = 0; log_ents = []
         all_debug_data = [] 
         tz = pytz.timezone('Asia/Ho_Chi_Minh'); now = datetime.now(tz).strftime("%d/%m/%Y %H:%M:%S")
 
-        for idx, ((t_link, t_sheet), group_rows) in enumerate(grouped.items()):
+        # [NEW] Bỏ qua dòng Ghi Đè có file nguồn không đổi từ lần đồng bộ trước
+        freshness = None; gc_bot = get_client(bot_creds)
+        if skip_unchanged:
+            try: freshness = SourceFreshness(open_history_sheet())
+            except: freshness = None
+        # [NEW] Schema kiểu cột đã đoán theo nguồn (dùng lại giữa các lần chạy)
+        try: schema_cache = SchemaCache(open_history_sheet())
+        except: schema_cache = None
+
+        # [NEW] Pipeline: nguồn tải song song (pool), đích nào đủ nguồn thì luồng ghi ghi ngay trong lúc các đích sau
+        # vẫn đang tải (tối đa PIPELINE_LOOKAHEAD đích chờ sẵn để giới hạn RAM). Luồng phụ không gọi st.* mà đẩy vào
+        # hàng đợi UI, luồng chính vẽ.
+        ui_q = queue.Queue()
+        plans = []
+        for (t_link, t_sheet), group_rows in grouped.items():
             with status_container.expander(f"🤖 [{assigned_bot_email}] -> {t_sheet}", expanded=True):
-                target_headers = []
-                try:
-                    tid = extract_id(t_link)
-                    if tid:
-                        sh_t = get_sh_with_retry(bot_creds, tid)
-                        if t_sheet in [s.title for s in safe_api_call(sh_t.worksheets)]:
-                            target_headers = safe_api_call(sh_t.worksheet(t_sheet).row_values, 1)
-                except: pass
+                msgs = [st.empty() for _ in group_rows]; log_box = st.container()
+            plans.append({"t_link": t_link, "t_sheet": t_sheet, "rows": group_rows, "msgs": [UIProxy(ui_q, m) for m in msgs],
+                          "box": log_box, "log": UIProxy(ui_q, log_box), "fetch": []})
 
-                tasks = []
-                for i, r in enumerate(group_rows):
-                    lnk = r.get(COL_SRC_LINK, ''); lbl = r.get(COL_SRC_SHEET, ''); row_idx = r.get('_index', -1)
-                    w_mode = str(r.get(COL_WRITE_MODE, 'Ghi Đè')).strip()
-                    if w_mode not in ["Ghi Đè", "Ghi Nối Tiếp"]: w_mode = "Ghi Đè"
-
-                    msg = st.empty(); msg.write(f"⏳ Tải: {lnk[-10:]} ({lbl})...")
-                    df, sid, m = fetch_data_v4(r, bot_creds, target_headers, status_container=msg)
-                    time.sleep(0.5) # [V108] Reduced delay for speed
-
-                    if df is not None: 
-                        count = len(df); msg.success(f"✅ OK: {count} dòng"); tasks.append((df, lnk, row_idx, w_mode)); total_rows += len(df)
-                    else: 
-                        msg.error(f"❌ Lỗi: {m}"); final_res_map[row_idx] = ("Lỗi tải", "", 0)
-                    del df; gc.collect()
-
-                if tasks:
-                    ok, m, batch_res, batch_db = write_strict_sync_v2(tasks, t_link, t_sheet, bot_creds, st)
-                    if not ok: st.error(m); all_ok = False
-                    else: st.success(m)
-                    final_res_map.update(batch_res); all_debug_data.extend(batch_db)
-                    del tasks; gc.collect()
-
-                for r in group_rows:
-                    row_idx = r.get('_index', -1)
-                    res_status, res_range, res_count = final_res_map.get(row_idx, ("Lỗi", "", 0))
-                    log_ents.append([now, r.get(COL_DATA_RANGE), r.get(COL_MONTH), user_id, r.get(COL_SRC_LINK), t_link, t_sheet, r.get(COL_SRC_SHEET), res_status, res_count, res_range, block_name_run])
+        def load_target_headers(t_link, t_sheet):
+            try:
+                tid = extract_id(t_link)
+                if tid:
+                    sh_t = get_sh_with_retry(bot_creds, tid)
+                    if t_sheet in [s.title for s in safe_api_call(sh_t.worksheets)]:
+                        return header_row(sh_t.worksheet(t_sheet), safe_api_call)
+            except: pass
+            return []
 
+        def fetch_row(r, msg, headers_future, t_link, t_sheet):
+            """Chạy ở pool: bỏ qua nếu nguồn không đổi, không thì tải + lọc. Trả về (row_idx, w_mode, kết quả, dấu đồng bộ)."""
+            lnk = r.get(COL_SRC_LINK, ''); lbl = r.get(COL_SRC_SHEET, ''); row_idx = r.get('_index', -1)
+            w_mode = str(r.get(COL_WRITE_MODE, 'Ghi Đè')).strip()
+            if w_mode not in ["Ghi Đè", "Ghi Nối Tiếp", WRITE_MODE_INPLACE, WRITE_MODE_DIFF]: w_mode = "Ghi Đè"
+
+            sid_chk = extract_id(str(lnk).strip()); mark = None
+            if freshness and sid_chk and w_mode in ["Ghi Đè", WRITE_MODE_INPLACE, WRITE_MODE_DIFF]:
+                fp = source_fingerprint(sid_chk, lbl, r.get(COL_DATA_RANGE, ''), r.get(COL_FILTER, ''), normalize_month(r.get(COL_MONTH, '')),
+                                        r.get(COL_HEADER, ''), t_link, str(t_sheet).strip() or "Tong_Hop_Data")
+                ver = freshness.current_version(gc_bot, sid_chk)
+                if freshness.is_unchanged(fp, ver):
+                    msg.info(f"⏭️ {STATUS_UNCHANGED}: {lnk[-10:]} ({lbl})")
+                    source_cache.expect(source_key(sid_chk, str(lbl).strip(), r.get(COL_DATA_RANGE, '')), -1)
+                    return row_idx, w_mode, (STATUS_UNCHANGED, str(r.get(COL_LOG_ROW, '') or ''), 0), None
+                mark = (fp, sid_chk, ver)
+
+            msg.write(f"⏳ Tải: {lnk[-10:]} ({lbl})...")
+            df, sid, m = fetch_data_v4(r, bot_creds, headers_future.result(), status_container=msg, source_cache=source_cache, engine=engine)
+            if df is None: msg.error(f"❌ Lỗi: {m}"); return row_idx, w_mode, ("Lỗi tải", "", 0), None
+            msg.success(f"✅ OK: {len(df)} dòng")
+            return row_idx, w_mode, df, mark
+
+        def submit_target(p):
+            headers_future = fetch_pool.submit(load_target_headers, p["t_link"], p["t_sheet"])
+            p["fetch"] = [fetch_pool.submit(fetch_row, r, msg, headers_future, p["t_link"], p["t_sheet"]) for r, msg in zip(p["rows"], p["msgs"])]
+
+        def finish_write(p, write_future):
+            nonlocal all_ok
+            ok, m, batch_res, batch_db = write_future.result()
+            with p["box"]:
+                if not ok: st.error(m); all_ok = False
+                else:
+                    st.success(m)
+                    for row_idx, (fp, sid_chk, ver) in p["marks"].items():
+                        if row_idx in batch_res and freshness: freshness.mark_synced(fp, sid_chk, ver)
+            final_res_map.update(batch_res); all_debug_data.extend(batch_db)
+
+        def log_target(p):
+            for r in p["rows"]:
+                row_idx = r.get('_index', -1)
+                res_status, res_range, res_count = final_res_map.get(row_idx, ("Lỗi", "", 0))
+                log_ents.append([now, r.get(COL_DATA_RANGE), r.get(COL_MONTH), user_id, r.get(COL_SRC_LINK), p["t_link"], p["t_sheet"], r.get(COL_SRC_SHEET), res_status, res_count, res_range, block_name_run])
+
+        fetch_pool = ThreadPoolExecutor(max_workers=PIPELINE_FETCH_WORKERS); writer = ThreadPoolExecutor(max_workers=1)
+        try:
+            submitted = 0; pending = None  # (plan, future ghi) đang chạy ở luồng ghi
+            for k, p in enumerate(plans):
+                while submitted < min(len(plans), k + 1 + PIPELINE_LOOKAHEAD): submit_target(plans[submitted]); submitted += 1
+                pump_ui(ui_q, p["fetch"])
+
+                tasks = []; p["marks"] = {}
+                for r, f in zip(p["rows"], p["fetch"]):
+                    try: row_idx, w_mode, res, mark = f.result()
+                    except Exception: final_res_map[r.get('_index', -1)] = ("Lỗi tải", "", 0); continue
+                    if isinstance(res, tuple): final_res_map[row_idx] = res; continue
+                    tasks.append((res, r.get(COL_SRC_LINK, ''), row_idx, w_mode)); total_rows += len(res)
+                    if mark: p["marks"][row_idx] = mark
+                p["fetch"] = []
+
+                if pending: pump_ui(ui_q, [pending[1]]); finish_write(*pending); log_target(pending[0]); pending = None
+                if tasks: pending = (p, writer.submit(write_strict_sync_v2, tasks, p["t_link"], p["t_sheet"], bot_creds, p["log"], schema_cache))
+                else: log_target(p)
+                del tasks; gc.collect()
+            if pending: pump_ui(ui_q, [pending[1]]); finish_write(*pending); log_target(pending[0])
+        finally:
+            fetch_pool.shutdown(wait=True); writer.shutdown(wait=True); pump_ui(ui_q, [])
+
+        if freshness: freshness.flush()
+        if schema_cache: schema_cache.flush()
         write_detailed_log(master_creds, log_ents)
         if all_debug_data: st.dataframe(pd.DataFrame(all_debug_data))
         return all_ok, final_res_map, total_rows
@@ -991,6 +1001,7 @@ def rename_block_action(old, new, creds, uid):
         df = safe_get_as_dataframe(wks, evaluate_formulas=True, dtype=str)
         df.loc[df[COL_BLOCK_NAME] == old, COL_BLOCK_NAME] = new
         wks.clear(); safe_set_with_dataframe(wks, df, row=1, col=1)
+        inherit_bot_for_block(new, old)
         log_user_action_buffered(creds, uid, "Rename", f"{old}->{new}", force_flush=True)
         return True
     finally: release_lock(creds, uid)
@@ -1010,7 +1021,6 @@ def delete_block_direct(blk, creds, uid):
 # ==========================================
 # --- [ĐOẠN CODE MAIN_UI ĐÃ SỬA LỖI & LOGIC] ---
 def main_ui():
-    init_log_buffer()
     if not check_login(): return
     uid = st.session_state['current_user_id']; master_creds = get_master_creds()
 
@@ -1021,12 +1031,25 @@ def main_ui():
 
     with st.sidebar:
         if st.button("🔄 Reload"): st.cache_data.clear(); st.session_state['df_full_config'] = load_full_config(master_creds); st.rerun()
+        with st.expander("📡 Kết nối Google API", expanded=False):
+            for email, stt in get_client_stats(get_client_registry()).items():
+                st.caption(f"{email}: {stt['requests']} request / {stt['connections']} kết nối (x{stt['reuse_ratio']}), dùng lại client {stt['reused']} lần, pool {stt['pool_size']}")
+            mc = META_CACHE.stats(); st.caption(f"Cache metadata: {mc['hits']} lần dùng lại / {mc['misses']} lần đọc, {mc['spreadsheets']} file")
+        with st.expander("⚖️ Cân tải bot", expanded=False):
+            # Bot mới chưa được share file nguồn / đích của block -> share trước rồi mới áp dụng
+            if st.button("Tính đề xuất"): st.session_state['bot_moves'] = plan_bot_rebalance(blks)
+            moves = st.session_state.get('bot_moves')
+            if moves is not None:
+                if not moves: st.caption("Tải các bot đã cân, không cần chuyển.")
+                for blk, old_bot, new_bot in moves: st.caption(f"{blk}: {old_bot} → {new_bot}")
+                if moves and st.button("Áp dụng (đã share file cho bot mới)"):
+                    st.success(f"Đã chuyển {apply_bot_rebalance(moves)} block."); st.session_state['bot_moves'] = None
         if 'target_block_display' not in st.session_state: st.session_state['target_block_display'] = blks[0]
         sel_blk = st.selectbox("Chọn Khối:", blks, index=blks.index(st.session_state['target_block_display']) if st.session_state['target_block_display'] in blks else 0)
         st.session_state['target_block_display'] = sel_blk
 
         if st.button("©️ Copy Block"):
-             new_b = f"{sel_blk}_copy"
+             new_b = f"{sel_blk}_copy"; inherit_bot_for_block(new_b, sel_blk)
              bd = df_cfg[df_cfg[COL_BLOCK_NAME] == sel_blk].copy(); bd[COL_BLOCK_NAME] = new_b
              st.session_state['df_full_config'] = pd.concat([df_cfg, bd], ignore_index=True)
              save_block_config_to_sheet(bd, new_b, master_creds, uid); st.session_state['target_block_display'] = new_b; st.rerun()
@@ -1108,7 +1131,7 @@ def main_ui():
         column_order=[COL_COPY_FLAG, "STT", COL_STATUS, COL_WRITE_MODE, COL_DATA_RANGE, COL_MONTH, COL_SRC_LINK, COL_SRC_SHEET, COL_TGT_LINK, COL_TGT_SHEET, COL_FILTER, COL_HEADER, COL_RESULT, COL_LOG_ROW],
         column_config={
             COL_STATUS: st.column_config.SelectboxColumn("Trạng thái", options=["Chưa chốt & đang cập nhật", "Đã chốt"], required=True),
-            COL_WRITE_MODE: st.column_config.SelectboxColumn("Cách ghi", options=["Ghi Đè", "Ghi Nối Tiếp"], default="Ghi Đè", required=True),
+            COL_WRITE_MODE: st.column_config.SelectboxColumn("Cách ghi", options=["Ghi Đè", "Ghi Nối Tiếp", WRITE_MODE_INPLACE, WRITE_MODE_DIFF], default="Ghi Đè", required=True),
             COL_SRC_LINK: st.column_config.LinkColumn("Link nguồn", width="medium"),
             COL_TGT_LINK: st.column_config.LinkColumn("Link đích", width="medium"),
             COL_HEADER: st.column_config.CheckboxColumn("Lấy Header?", default=False, width="small"),
@@ -1126,6 +1149,13 @@ def main_ui():
         st.session_state['df_full_config'] = pd.concat([st.session_state['df_full_config'][st.session_state['df_full_config'][COL_BLOCK_NAME] != sel_blk], pd.DataFrame(nw)], ignore_index=True)
         st.rerun()
 
+    o1, o2 = st.columns([3, 1])
+    with o1:
+        skip_unchanged = st.checkbox("⏭️ Bỏ qua nguồn không đổi (chỉ áp dụng Ghi Đè)", value=True, key="skip_unchanged",
+                                     help="Dựa vào thời điểm sửa file nguồn trên Drive. Bỏ tick để bắt buộc tải lại toàn bộ.")
+    with o2:
+        engines = ENGINES if pl is not None else [ENGINE_PANDAS]
+        run_engine = st.selectbox("Engine xử lý", engines, index=0, key="run_engine", help="polars: nhanh & nhẹ RAM hơn với nguồn lớn, kết quả giống hệt pandas.")
     c1, c2, c3, c4 = st.columns(4)
     with c1:
         if st.button("▶️ RUN BLOCK", type="primary", use_container_width=True):
@@ -1136,7 +1166,7 @@ def main_ui():
                     r_dict = r.to_dict(); r_dict['_index'] = i; rows.append(r_dict)
             if not rows: st.warning("Không có dòng nào để chạy."); st.stop()
             st_cont = st.status(f"🚀 Đang chạy {sel_blk} (Bot: {assigned_bot})...", expanded=True)
-            ok, res, tot = process_pipeline_mixed(rows, uid, sel_blk, st_cont, forced_bot=assigned_bot)
+            ok, res, tot = process_pipeline_mixed(rows, uid, sel_blk, st_cont, forced_bot=assigned_bot, skip_unchanged=skip_unchanged, engine=run_engine)
             if isinstance(res, dict):
                 for i, r in edt_df.iterrows():
                     if i in res: edt_df.at[i, COL_RESULT] = res[i][0]; edt_df.at[i, COL_LOG_ROW] = res[i][1]
@@ -1153,6 +1183,7 @@ def main_ui():
 
             main_st = st.status("🚀 Chạy toàn bộ...", expanded=True)
             total = 0
+            run_caches = defaultdict(SourceCache) # Mỗi bot 1 cache nguồn dùng chung cho các khối của bot đó
 
             # --- [ĐOẠN CỐT LÕI ĐƯỢC CẢI TIẾN] ---
             for idx, blk in enumerate(all_blocks):
@@ -1169,7 +1200,7 @@ def main_ui():
 
                 if rows_to_run:
                     # 3. Chạy xử lý
-                    ok, res, tot = process_pipeline_mixed(rows_to_run, uid, blk, main_st, forced_bot=blk_bot)
+                    ok, res, tot = process_pipeline_mixed(rows_to_run, uid, blk, main_st, forced_bot=blk_bot, skip_unchanged=skip_unchanged, source_cache=run_caches[blk_bot], engine=run_engine)
                     total += len(rows_to_run)
 
                     # 4. Lưu kết quả ngay lập tức
@@ -1226,8 +1257,6 @@ def main_ui():
             st.rerun()
 
     # --- PHẦN HIỂN THỊ LOG Ở CUỐI TRANG ---
-    # Đảm bảo flush những log còn sót lại trong buffer (nếu có)
-    flush_logs(master_creds, force=False) 
 
     st.divider()
     st.caption("Logs hành vi hệ thống")
@@ -6,11 +6,23 @@ import time
 import requests 
 import traceback 
 import re
+import threading
+import heapq
+import sys
+import signal
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import pytz
 from google.oauth2 import service_account
 from gspread_dataframe import get_as_dataframe
-import warnings
+from kinkin_core import (authorize, get_client_stats, is_quota_error, get_quota_status, get_bot_assigner, hash_bot_for_block,
+                         SourceFreshness, source_fingerprint, STATUS_UNCHANGED, SourceCache, source_key, make_source_loader,
+                         normalize_row_key, locate_overwrite_rows, TargetRowIndex, is_inplace_mode, write_rows_in_place,
+                         is_diff_mode, ensure_hash_column, write_rows_diff, hash_rows, SYS_COL_HASH, apply_target_write, WRITE_STREAM_ROWS,
+                         apply_compiled_filter, ENGINE_POLARS, resolve_engine, pl, pl_frame_from_values,
+                         pl_apply_filter, FrameRows,
+                         SchemaCache, apply_schema, protect_text_codes, BlockRunState, LogSink, header_row, META_CACHE)
 
 # ==========================================
 # 0. CẤU HÌNH MÔI TRƯỜNG & HẰNG SỐ
@@ -54,6 +66,24 @@ MY_BOT_LIST = [
     "kinkingetdulieu5@kinkin5.iam.gserviceaccount.com"
 ]
 
+# [NEW] Bỏ qua dòng Ghi Đè có file nguồn không đổi từ lần đồng bộ trước (đặt 0 để luôn chạy lại)
+SKIP_UNCHANGED = os.environ.get("AUTO_SKIP_UNCHANGED", "1").strip() not in ("0", "false", "False", "")
+
+# [NEW] Engine xử lý bảng: "pandas" (mặc định) hoặc "polars" (nhanh & nhẹ RAM hơn với nguồn lớn)
+ENGINE = resolve_engine(os.environ.get("KINKIN_ENGINE", "pandas"))
+
+# [NEW] Số luồng chạy song song cho MỖI bot (mỗi bot có quota riêng)
+try: WORKERS_PER_BOT = max(1, int(os.environ.get("AUTO_WORKERS_PER_BOT", "1")))
+except: WORKERS_PER_BOT = 1
+
+# Khóa theo (file đích, sheet đích): 2 block khác bot cùng ghi 1 sheet thì phải chờ nhau,
+# nếu không lệnh xóa dòng của block này sẽ làm lệch index dòng của block kia
+_TARGET_LOCKS = defaultdict(threading.Lock)
+_TARGET_LOCKS_GUARD = threading.Lock()
+
+def get_target_lock(tid, sheet_name):
+    with _TARGET_LOCKS_GUARD: return _TARGET_LOCKS[(tid, sheet_name)]
+
 # ==========================================
 # 1. CÁC HÀM TIỆN ÍCH (UTILS)
 # ==========================================
@@ -81,18 +111,20 @@ def get_bot_creds_by_email(target_email):
         return get_bot_creds_by_index(0)
     except: return get_bot_creds_by_index(0)
 
-def assign_bot_to_block(block_name):
+def assign_bot_to_block(block_name, gc_master=None):
+    # [NEW] Gán bot theo tải lịch sử + giữ cố định (sys_bot_assign), dùng chung logic với app
     valid_bots = [b for b in MY_BOT_LIST if b.strip()]
     if not valid_bots: return MY_BOT_LIST[0]
-    hash_val = sum(ord(c) for c in block_name)
-    return valid_bots[hash_val % len(valid_bots)]
+    if not gc_master or not SHEET_ID: return hash_bot_for_block(block_name, valid_bots)
+    return get_bot_assigner(valid_bots).assign(block_name, lambda: gc_master.open_by_key(SHEET_ID))
 
 def safe_api_call(func, *args, **kwargs):
+    # [NEW] 429/quota đã được rate limiter của bot xử lý (chờ theo Retry-After) -> ở đây chỉ retry lỗi tạm thời khác
     for i in range(3):
         try: return func(*args, **kwargs)
         except Exception as e:
-            if "429" in str(e): time.sleep((i+2)*2)
-            else: time.sleep(1)
+            if is_quota_error(e): return None
+            time.sleep(1)
     return None
 
 def extract_id(url):
@@ -105,28 +137,44 @@ def col_name_to_index(col):
     for c in col: idx = idx*26 + (ord(c)-ord('A'))+1
     return idx-1
 
+# [NEW] Log ghi nền: hàng đợi + 1 luồng gom dòng theo tab (kinkin_core.LogSink), mở file lịch sử 1 lần
+_LOG_SINK = None
+_LOG_SINK_GUARD = threading.Lock()
+
+def get_log_sink(gc):
+    global _LOG_SINK
+    with _LOG_SINK_GUARD:
+        if _LOG_SINK is None: _LOG_SINK = LogSink(lambda: gc.open_by_key(SHEET_ID), call=safe_api_call,
+                                                    on_error=lambda tab, n, e: print(f"⚠️ Bỏ {n} dòng log tab {tab}: {e}"))
+        return _LOG_SINK
+
+def log_cell(v):
+    """Giá trị 1 ô log: None / NaN -> "", còn lại -> chuỗi"""
+    return "" if v is None or (isinstance(v, float) and v != v) else str(v)
+
 def write_behavior_log(gc, action, target, detail, status="Completed"):
-    try:
-        sh = gc.open_by_key(SHEET_ID)
-        try: wks = sh.worksheet(SHEET_BEHAVE_NAME)
-        except: wks = sh.add_worksheet(SHEET_BEHAVE_NAME, 1000, 10)
-        # [FIX] Thêm dấu ' vào log hành vi luôn
-        now_str = "'" + datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")
-        wks.append_row([now_str, "Auto_Runner", action, target, detail, status])
-    except: pass
+    # [FIX] Thêm dấu ' vào log hành vi luôn
+    now_str = "'" + datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")
+    get_log_sink(gc).log(SHEET_BEHAVE_NAME, [now_str, "Auto_Runner", action, target, detail, status])
 
-def update_config_result(wks_config, row_idx, status_text, range_text):
-    """Cập nhật trực tiếp kết quả vào sheet Config để App hiển thị"""
+def flush_config_results(wks_config, headers, results):
+    """
+    [NEW] Ghi kết quả cả block vào sheet Config để App hiển thị: 1 lệnh values.batchUpdate cho 2 cột
+    "Kết quả" + "Dòng dữ liệu" (vị trí cột lấy 1 lần từ tiêu đề đã đọc). results: [(row_idx, trạng thái, vùng dòng)]
+    """
+    if not results: return
     try:
-        headers = wks_config.row_values(1)
-        try:
-            col_res = headers.index(COL_RESULT) + 1
-            col_row = headers.index(COL_LOG_ROW) + 1
-            sheet_row = row_idx + 2 
-            wks_config.update_cell(sheet_row, col_res, status_text)
-            wks_config.update_cell(sheet_row, col_row, range_text)
-        except: pass
-    except: pass
+        headers = list(headers)
+        col_res = headers.index(COL_RESULT) + 1
+        col_row = headers.index(COL_LOG_ROW) + 1
+    except ValueError: return
+    data = []
+    for row_idx, status_text, range_text in results:
+        sheet_row = row_idx + 2 
+        data.append({"range": gspread.utils.rowcol_to_a1(sheet_row, col_res), "values": [[status_text]]})
+        data.append({"range": gspread.utils.rowcol_to_a1(sheet_row, col_row), "values": [[range_text]]})
+    try: safe_api_call(wks_config.batch_update, data, value_input_option="USER_ENTERED")
+    except Exception as e: print(f"⚠️ Lỗi ghi kết quả vào {SHEET_CONFIG_NAME}: {e}")
 
 # --- [QUAN TRỌNG] HÀM ĐỌC NGÀY THÁNG ĐA NĂNG ---
 def parse_log_date(date_str):
@@ -154,156 +202,172 @@ def parse_log_date(date_str):
 # ==========================================
 # 2. XỬ LÝ NGÀY ĐỘNG & BỘ LỌC
 # ==========================================
-def parse_dynamic_date(val_str):
-    if not isinstance(val_str, str): return val_str
-    val_upper = val_str.strip().upper().replace(" ", "").replace("'", "").replace('"', "")
-    now = datetime.now(TZ_VN).replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    if "TODAY" in val_upper:
-        calc_part = val_upper.replace("TODAY()", "").replace("TODAY", "")
-        if not calc_part: return now
-        try:
-            days = int(calc_part)
-            return now + timedelta(days=days)
-        except: pass
-
-    if val_upper == "YESTERDAY": return now - timedelta(days=1)
-    return val_str
-
 def apply_smart_filter_auto(df, filter_str):
-    if not filter_str or str(filter_str).strip().lower() in ['nan', 'none', 'null', '']: return df
-    conditions = str(filter_str).split(';')
-    current_df = df.copy()
-    
-    for cond in conditions:
-        fs = cond.strip()
-        if not fs: continue 
-        op_list = [" contains ", "==", "!=", ">=", "<=", ">", "<", "="]
-        op = next((o for o in op_list if o in fs), None)
-        if not op: continue 
-        
-        parts = fs.split(op, 1)
-        col_raw = parts[0].strip().replace("`", "").replace("'", "").replace('"', "")
-        val_raw = parts[1].strip()
-        
-        val_resolved = parse_dynamic_date(val_raw)
-        val_clean = val_raw[1:-1] if (isinstance(val_raw, str) and (val_raw.startswith("'") or val_raw.startswith('"'))) else val_raw
-        
-        real_col = next((c for c in current_df.columns if str(c).lower() == col_raw.lower()), None)
-        if not real_col: continue 
-        
-        try:
-            series = current_df[real_col]
-            if op == " contains ": 
-                current_df = current_df[series.astype(str).str.contains(val_clean, case=False, na=False)]
-            else:
-                is_dt = False; v_dt = None
-                if isinstance(val_resolved, datetime):
-                    is_dt = True; v_dt = pd.to_datetime(val_resolved).tz_localize(None)
-                else:
-                    try: 
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("ignore")
-                            s_dt = pd.to_datetime(series, dayfirst=True, errors='coerce')
-                        v_dt_try = pd.to_datetime(val_clean, dayfirst=True)
-                        if s_dt.notna().any() and pd.notna(v_dt_try): is_dt = True; v_dt = v_dt_try
-                    except: pass
-                
-                is_num = False
-                if not is_dt:
-                    try: s_num = pd.to_numeric(series, errors='coerce'); v_num = float(val_clean); is_num = True
-                    except: pass
-                
-                if is_dt:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore")
-                        s_dt = pd.to_datetime(series, dayfirst=True, errors='coerce')
-                    if op==">": current_df=current_df[s_dt>v_dt]
-                    elif op=="<": current_df=current_df[s_dt<v_dt]
-                    elif op==">=": current_df=current_df[s_dt>=v_dt]
-                    elif op=="<=": current_df=current_df[s_dt<=v_dt]
-                    elif op in ["=","=="]: current_df=current_df[s_dt==v_dt]
-                    elif op=="!=": current_df=current_df[s_dt!=v_dt]
-                elif is_num:
-                    if op==">": current_df=current_df[s_num>v_num]
-                    elif op=="<": current_df=current_df[s_num<v_num]
-                    elif op==">=": current_df=current_df[s_num>=v_num]
-                    elif op=="<=": current_df=current_df[s_num<=v_num]
-                    elif op in ["=","=="]: current_df=current_df[s_num==v_num]
-                    elif op=="!=": current_df=current_df[s_num!=v_num]
-                else:
-                    s_str = series.astype(str).str.strip(); val_str_cmp = str(val_clean)
-                    if op==">": current_df=current_df[s_str>val_str_cmp]
-                    elif op=="<": current_df=current_df[s_str<val_str_cmp]
-                    elif op==">=": current_df=current_df[s_str>=val_str_cmp]
-                    elif op=="<=": current_df=current_df[s_str<=val_str_cmp]
-                    elif op in ["=","=="]: current_df=current_df[s_str==val_str_cmp]
-                    elif op=="!=": current_df=current_df[s_str!=val_str_cmp]
-        except: pass
-    return current_df
+    # [NEW] Dùng chung bộ lọc biên dịch của kinkin_core; điều kiện lỗi được bỏ qua như cũ
+    return apply_compiled_filter(df, filter_str, strict=False)[0]
 
 # ==========================================
 # 3. LOGIC GHI & XÓA (DEEP SCAN & ID MATCH)
 # ==========================================
-def get_rows_to_delete_dynamic(wks, keys_to_delete):
+def get_rows_to_delete_dynamic(wks, keys_to_delete, row_index=None):
     try:
-        all_values = safe_api_call(wks.get_all_values)
-        if not all_values or len(all_values) < 2: return []
-        
-        header_row_idx = -1; headers = []
-        for i in range(min(10, len(all_values))):
-            row_lower = [str(c).strip().lower() for c in all_values[i]]
-            if SYS_COL_LINK.lower() in row_lower and SYS_COL_SHEET.lower() in row_lower:
-                header_row_idx = i; headers = row_lower; break
-        
-        if header_row_idx == -1: return []
-
-        idx_link = headers.index(SYS_COL_LINK.lower())
-        idx_sheet = headers.index(SYS_COL_SHEET.lower())
-        idx_month = headers.index(SYS_COL_MONTH.lower())
-
-        rows_to_delete = []
-        
-        normalized_keys = set()
-        for k_id, k_sh, k_mo in keys_to_delete:
-            normalized_keys.add((str(k_id).strip(), str(k_sh).strip().lower(), str(k_mo).strip().lower()))
-
-        for i in range(header_row_idx + 1, len(all_values)):
-            row = all_values[i]
-            if len(row) <= max(idx_link, idx_sheet, idx_month): continue
-            
-            val_link_raw = str(row[idx_link]).strip()
-            val_id = extract_id(val_link_raw)
-            if not val_id: val_id = val_link_raw 
-            
-            val_sheet = str(row[idx_sheet]).strip().lower()
-            val_month = str(row[idx_month]).strip().lower()
-            
-            if (val_id, val_sheet, val_month) in normalized_keys:
-                rows_to_delete.append(i + 1)
-
-        return rows_to_delete
+        # [NEW] Hỏi chỉ mục vị trí dòng trước; chưa có / lệch thì chỉ quét 3 cột khóa cả tab (và dựng lại chỉ mục)
+        normalized_keys = set(normalize_row_key(k_id, k_sh, k_mo) for k_id, k_sh, k_mo in keys_to_delete)
+        rows_to_delete = safe_api_call(locate_overwrite_rows, wks, [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH],
+                                       normalized_keys, lambda vals: normalize_row_key(*vals) in normalized_keys, row_index)
+        return rows_to_delete or []
     except: return []
 
-def batch_delete_rows(sh, sheet_id, row_indices):
-    if not row_indices: return
-    row_indices.sort(reverse=True) 
-    ranges = []
-    if len(row_indices) > 0:
-        start = row_indices[0]; end = start
-        for r in row_indices[1:]:
-            if r == start - 1: start = r
-            else: ranges.append((start, end)); start = r; end = r
-        ranges.append((start, end))
-    requests = [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": s-1, "endIndex": e}}} for s, e in ranges]
-    for i in range(0, len(requests), 100):
-        safe_api_call(sh.batch_update, {'requests': requests[i:i+100]})
-        time.sleep(1)
-
 # ==========================================
 # 4. CORE PIPELINE
 # ==========================================
-def process_single_row_automation(row, bot_creds):
+def write_to_target(gc, tid, tgt_sheet_name, frame, row, sid, src_sheet_name, month_val):
+    """Ghi frame (FrameRows) vào sheet đích (gọi bên trong khóa của sheet đích)"""
+    sh_tgt = safe_api_call(gc.open_by_key, tid)
+    try: ws_tgt = sh_tgt.worksheet(tgt_sheet_name)
+    except: ws_tgt = sh_tgt.add_worksheet(tgt_sheet_name, 1000, 20)
+
+    # [NEW] Chỉ đọc dòng tiêu đề; vị trí dòng ghi lấy từ phản hồi append, không đọc cả sheet đích
+    existing_headers = header_row(ws_tgt, safe_api_call)
+    # [NEW] Chỉ mục (nguồn, tab, tháng) -> đoạn dòng ở tab đích, cập nhật sau mỗi lần xóa / ghi
+    try: row_index = TargetRowIndex(sh_tgt, tgt_sheet_name)
+    except: row_index = None
+    row_key = normalize_row_key(sid, src_sheet_name, month_val)
+
+    if not existing_headers:
+        # [FIX] Đồng Bộ Thay Đổi: tab mới cũng có cột Row_Hash đã điền, lần chạy sau so hash được ngay
+        new_headers = list(frame.columns) + ([SYS_COL_HASH] if is_diff_mode(row.get(COL_WRITE_MODE, '')) else [])
+        ws_tgt.update([new_headers] + list(hash_rows(frame.rows(new_headers), new_headers, [SYS_COL_TIME])))
+        if row_index: row_index.reset(); row_index.add_rows(row_key, 2, len(frame) + 1); row_index.flush()
+        return "Thành công (New)", len(frame), f"1 - {len(frame)}"
+    else:
+        tgt_headers = existing_headers
+        updated_headers = tgt_headers.copy(); added = False
+        for c in [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]:
+            if c not in updated_headers: updated_headers.append(c); added = True
+        # [NEW] Dòng tiêu đề mới được ghi chung 1 lệnh batchUpdate với phần xóa dòng cũ (apply_target_write)
+        header_change = updated_headers if added else None
+        if added: tgt_headers = updated_headers
+
+        w_mode = str(row.get(COL_WRITE_MODE, 'Ghi Đè')).strip()
+        sys_cols = [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]
+        # [NEW] Đồng Bộ Thay Đổi: hash từng dòng nằm ở cột ẩn Row_Hash
+        if is_diff_mode(w_mode):
+            tgt_headers = ensure_hash_column(sh_tgt, ws_tgt, tgt_headers); sys_cols.append(SYS_COL_HASH)
+        cols_to_write = []
+        for h in tgt_headers:
+            if h in frame.columns or h in sys_cols:
+                cols_to_write.append(h)
+
+    if "đè" in w_mode.lower() or "overwrite" in w_mode.lower() or is_diff_mode(w_mode):
+        keys_to_delete = set([(sid, src_sheet_name, month_val)])
+        rows_to_del = get_rows_to_delete_dynamic(ws_tgt, keys_to_delete, row_index)
+        if (is_diff_mode(w_mode) or is_inplace_mode(w_mode)) and rows_to_del and header_change:
+            apply_target_write(sh_tgt, ws_tgt, [], (), header_change, safe_api_call); header_change = None
+        # [NEW] Đồng Bộ Thay Đổi: chỉ chèn / xóa / ghi các dòng có hash khác, dòng không đổi giữ nguyên
+        if is_diff_mode(w_mode) and rows_to_del:
+            skip_pos = [cols_to_write.index(SYS_COL_TIME)] if SYS_COL_TIME in cols_to_write else []
+            span = write_rows_diff(sh_tgt, ws_tgt, rows_to_del, frame.rows(cols_to_write), cols_to_write.index(SYS_COL_HASH), skip_pos, row_index, row_key)
+            if span:
+                if row_index: row_index.flush()
+                return f"Thành công (Đổi {span[2]})", len(frame), f"{span[0]} - {span[1]}"
+        # [NEW] Ghi Đè Tại Chỗ: khối cũ liền nhau -> ghi đè đúng chỗ, chỉ chèn / xóa phần chênh lệch số dòng
+        if is_inplace_mode(w_mode) and rows_to_del:
+            span = write_rows_in_place(sh_tgt, ws_tgt, rows_to_del, frame.rows(cols_to_write), row_index, row_key)
+            if span:
+                if row_index: row_index.flush()
+                return "Thành công (Tại chỗ)", len(frame), f"{span[0]} - {span[1]}"
+    else: rows_to_del = []
+
+    # [NEW] Nối dữ liệu mới rồi 1 lệnh batchUpdate (tiêu đề + xóa dòng cũ), không còn sleep cố định
+    # [NEW] Căn cột + ghi dần từng phần WRITE_STREAM_ROWS dòng, không dựng cả list dòng trong RAM
+    # [FIX] Đồng Bộ Thay Đổi quay về nối (chưa có khối cũ / không liền nhau): điền luôn Row_Hash cho dòng nối
+    stream = hash_rows(frame.iter_rows(cols_to_write), cols_to_write, [SYS_COL_TIME])
+    start_row_idx = apply_target_write(sh_tgt, ws_tgt, stream, rows_to_del or [], header_change, safe_api_call, WRITE_STREAM_ROWS, len(frame))
+    if row_index and rows_to_del: row_index.delete_rows(rows_to_del)
+    if start_row_idx is None:
+        # Phản hồi không có vị trí (append lỗi) -> đếm lại như cũ
+        current_vals = safe_api_call(ws_tgt.get_all_values)
+        start_row_idx = max(len(current_vals or []) - len(frame), 0) + 1
+
+    end_row_idx = start_row_idx + len(frame) - 1
+    rng_str = f"{start_row_idx} - {end_row_idx}"
+    if row_index: row_index.add_rows(row_key, start_row_idx, end_row_idx); row_index.flush()
+    return f"Thành công", len(frame), rng_str
+
+
+def write_group_to_target(gc, tid, tgt_sheet_name, items):
+    """
+    [NEW] Ghi nhiều dòng cấu hình cùng 1 tab đích (gọi bên trong khóa của sheet đích): 1 lần đọc tiêu đề,
+    1 lần quét xóa cho mọi key Ghi Đè, 1 lần ghi (append + batchUpdate) cho cả nhóm.
+    items: [(frame, row, sid, tab nguồn, tháng)]. Trả về list (trạng thái, số dòng, vùng dòng) theo thứ tự items.
+    Ghi Đè Tại Chỗ / Đồng Bộ Thay Đổi ghi theo vị trí từng khối nên vẫn đi từng dòng qua write_to_target.
+    """
+    results = [None] * len(items); plain = []
+    for n, it in enumerate(items):
+        w_mode = str(it[1].get(COL_WRITE_MODE, 'Ghi Đè')).strip()
+        if is_inplace_mode(w_mode) or is_diff_mode(w_mode): results[n] = write_to_target(gc, tid, tgt_sheet_name, *it)
+        else: plain.append(n)
+    if len(plain) == 1: results[plain[0]] = write_to_target(gc, tid, tgt_sheet_name, *items[plain[0]])
+    if len(plain) < 2: return results
+
+    sh_tgt = safe_api_call(gc.open_by_key, tid)
+    try: ws_tgt = sh_tgt.worksheet(tgt_sheet_name)
+    except: ws_tgt = sh_tgt.add_worksheet(tgt_sheet_name, 1000, 20)
+    existing_headers = header_row(ws_tgt, safe_api_call)
+    try: row_index = TargetRowIndex(sh_tgt, tgt_sheet_name)
+    except: row_index = None
+
+    frames = [items[n][0] for n in plain]
+    sys_cols = [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]
+    header_change = None
+    if not existing_headers:
+        # Sheet trắng -> tiêu đề theo dữ liệu đầu tiên (ghi trước để append nối từ dòng 2)
+        tgt_headers = list(frames[0].columns)
+        safe_api_call(ws_tgt.update, range_name="A1", values=[tgt_headers])
+        if row_index: row_index.reset()
+    else:
+        tgt_headers = existing_headers.copy()
+        for c in sys_cols:
+            if c not in tgt_headers: tgt_headers.append(c); header_change = tgt_headers
+    src_cols = set(c for f in frames for c in f.columns)
+    cols_to_write = [h for h in tgt_headers if h in src_cols or h in sys_cols]
+
+    keys_to_delete = set()
+    for n in plain:
+        w_mode = str(items[n][1].get(COL_WRITE_MODE, 'Ghi Đè')).strip().lower()
+        if "đè" in w_mode or "overwrite" in w_mode: keys_to_delete.add(tuple(items[n][2:5]))
+    rows_to_del = get_rows_to_delete_dynamic(ws_tgt, keys_to_delete, row_index) if existing_headers and keys_to_delete else []
+
+    # Căn cột + ghi dần từng phần WRITE_STREAM_ROWS dòng, nối xong mới xóa dòng cũ (chung 1 batchUpdate)
+    total_new = sum(len(f) for f in frames)
+    stream = (r for f in frames for r in f.iter_rows(cols_to_write))
+    start_row_idx = apply_target_write(sh_tgt, ws_tgt, stream, rows_to_del, header_change, safe_api_call, WRITE_STREAM_ROWS, total_new)
+    if row_index and rows_to_del: row_index.delete_rows(rows_to_del)
+    if start_row_idx is None:
+        # Phản hồi không có vị trí (append lỗi) -> đếm lại như cũ
+        current_vals = safe_api_call(ws_tgt.get_all_values)
+        start_row_idx = max(len(current_vals or []) - total_new, 0) + 1
+
+    cursor = start_row_idx
+    for n in plain:
+        frame, _, sid, src_sheet_name, month_val = items[n]
+        if not len(frame): results[n] = ("Thành công", 0, "0 dòng"); continue
+        end = cursor + len(frame) - 1
+        if row_index: row_index.add_rows(normalize_row_key(sid, src_sheet_name, month_val), cursor, end)
+        results[n] = ("Thành công", len(frame), f"{cursor} - {end}"); cursor = end + 1
+    if row_index: row_index.flush()
+    return results
+
+def target_of(row):
+    """(id file đích, tên tab đích) của 1 dòng cấu hình - khóa gom nhóm ghi"""
+    return extract_id(str(row.get(COL_TGT_LINK, '')).strip()), str(row.get(COL_TGT_SHEET, '')).strip() or "Tong_Hop_Data"
+
+def prepare_row(row, gc, freshness=None, source_cache=None, engine=None, schema_cache=None):
+    """
+    Tải + lọc 1 dòng cấu hình (chưa ghi). Trả về (kết quả, None) nếu dòng xong luôn (lỗi / không đổi / lọc hết),
+    ngược lại (None, (frame, sid, tab nguồn, tháng, dấu đồng bộ)) để ghi chung với các dòng cùng tab đích.
+    """
     src_link = str(row.get(COL_SRC_LINK, '')).strip()
     src_sheet_name = str(row.get(COL_SRC_SHEET, '')).strip()
     # [FIX] Chuẩn hóa Tháng: Luôn đảm bảo dạng 01/2026 (2 chữ số cho tháng)
@@ -322,17 +386,30 @@ def process_single_row_automation(row, bot_creds):
     tgt_sheet_name = str(row.get(COL_TGT_SHEET, '')).strip() or "Tong_Hop_Data"
     
     sid = extract_id(src_link); tid = extract_id(tgt_link)
-    if not sid or not tid: return "Lỗi Link", 0, ""
+    if not sid or not tid: return ("Lỗi Link", 0, ""), None
 
     try:
-        gc = gspread.authorize(bot_creds)
-        sh_src = safe_api_call(gc.open_by_key, sid)
-        ws_src = sh_src.worksheet(src_sheet_name) if src_sheet_name else sh_src.sheet1
-        data = safe_api_call(ws_src.get_all_values)
-        if not data: return "Sheet trắng", 0, "0 dòng"
+        # [NEW] File nguồn không đổi kể từ lần Ghi Đè thành công trước -> bỏ qua, không tải
+        fingerprint = None; src_version = None
+        w_mode_chk = str(row.get(COL_WRITE_MODE, 'Ghi Đè')).strip().lower()
+        if freshness and ("đè" in w_mode_chk or "overwrite" in w_mode_chk or is_diff_mode(w_mode_chk)):
+            fingerprint = source_fingerprint(sid, src_sheet_name, row.get(COL_DATA_RANGE, ''), row.get(COL_FILTER, ''),
+                                             month_val, row.get(COL_HEADER, ''), tgt_link, tgt_sheet_name)
+            src_version = freshness.current_version(gc, sid)
+            if freshness.is_unchanged(fingerprint, src_version):
+                if source_cache is not None: source_cache.expect(source_key(sid, src_sheet_name, row.get(COL_DATA_RANGE, '')), -1)
+                old_rng = str(row.get(COL_LOG_ROW, '')).strip()
+                return (STATUS_UNCHANGED, 0, "" if old_rng.lower() in ['nan', 'none'] else old_rng), None
+
+        # [NEW] Nhiều dòng cấu hình cùng 1 nguồn -> chỉ tải 1 lần; các tab/vùng khác cùng file tải gộp 1 lệnh batchGet
+        key = source_key(sid, src_sheet_name, row.get(COL_DATA_RANGE, ''))
+        load_source = make_source_loader(source_cache, key, lambda: gc.open_by_key(sid), safe_api_call)
+        loaded = source_cache.get(key, load_source) if source_cache is not None else load_source()
+        if not loaded or not loaded[1]: return ("Sheet trắng", 0, "0 dòng"), None
+        _, data, col_offset = loaded
 
         data_range = str(row.get(COL_DATA_RANGE, '')).strip().upper()
-        if ":" in data_range and len(data_range) < 10 and "LẤY HẾT" not in data_range:
+        if col_offset is None and ":" in data_range and len(data_range) < 10 and "LẤY HẾT" not in data_range:
             try:
                 s_char, e_char = data_range.split(":")
                 s_idx = col_name_to_index(s_char); e_idx = col_name_to_index(e_char)
@@ -347,81 +424,76 @@ def process_single_row_automation(row, bot_creds):
             if col_str in seen: seen[col_str] += 1; unique_headers.append(f"{col_str}_{seen[col_str]}")
             else: seen[col_str] = 0; unique_headers.append(col_str)
         
-        df = pd.DataFrame(body_rows, columns=unique_headers)
-        for c in df.columns:
-            try: df[c] = pd.to_numeric(df[c])
-            except: pass
-
         filter_cond = str(row.get(COL_FILTER, '')).strip()
-        if filter_cond and filter_cond.lower() not in ['nan', 'none']:
-            df = apply_smart_filter_auto(df, filter_cond)
-        
-        if df.empty: return "Thành công (Lọc hết)", 0, "0 dòng"
-
+        has_filter = filter_cond and filter_cond.lower() not in ['nan', 'none']
         h_val = str(row.get(COL_HEADER, 'FALSE')).strip().upper()
-        if h_val == 'TRUE':
-            header_df = pd.DataFrame([df.columns.tolist()], columns=df.columns)
-            df = pd.concat([header_df, df], ignore_index=True)
+        sys_vals = {
+            SYS_COL_LINK: src_link, SYS_COL_SHEET: src_sheet_name, SYS_COL_MONTH: month_val,
+            # [FIX] Thời gian ghi vào sheet đích cũng nên thêm ' để tránh nhảy định dạng
+            SYS_COL_TIME: "'" + datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S"),
+        }
+
+        # [FIX] Tiêu đề vẫn trùng sau khi đánh số (vd a, a, a_1) -> Polars không nhận cột trùng, đi đường pandas
+        if resolve_engine(engine or ENGINE) == ENGINE_POLARS and len(set(unique_headers)) == len(unique_headers):
+            # [NEW] Engine Polars: dựng bảng, đoán kiểu, lọc, căn cột không qua pandas (kết quả y hệt)
+            df = apply_schema(pl_frame_from_values(unique_headers, body_rows), sid, src_sheet_name, schema_cache)
+            if has_filter: df = pl_apply_filter(df, filter_cond, strict=False)[0]
+            if df.height == 0 or df.width == 0: return ("Thành công (Lọc hết)", 0, "0 dòng"), None
+            df = protect_text_codes(df)
+
+            hmap = {c: c for c in df.columns} if h_val == 'TRUE' else None
+            df = df.with_columns([pl.lit(v).alias(k) for k, v in sys_vals.items()])
+            if hmap is not None: hmap.update(sys_vals)
+            frame = FrameRows(df, [hmap[c] for c in df.columns] if hmap is not None else None)
+        else:
+            df = pd.DataFrame(body_rows, columns=unique_headers)
+            # [NEW] Đoán kiểu cột theo mẫu (cache theo nguồn + tiêu đề), đổi mỗi cột 1 lượt thay cho try/except từng cột
+            apply_schema(df, sid, src_sheet_name, schema_cache)
 
-        df[SYS_COL_LINK] = src_link
-        df[SYS_COL_SHEET] = src_sheet_name
-        df[SYS_COL_MONTH] = month_val
-        
-        # [FIX] Thời gian ghi vào sheet đích cũng nên thêm ' để tránh nhảy định dạng
-        df[SYS_COL_TIME] = "'" + datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")
+            if has_filter: df = apply_smart_filter_auto(df, filter_cond)
+            if df.empty: return ("Thành công (Lọc hết)", 0, "0 dòng"), None
+            # [FIX] Lọc xong mới thêm ' cho mã / số dài ở cột chữ (USER_ENTERED không đổi chúng thành số)
+            protect_text_codes(df)
 
-        sh_tgt = safe_api_call(gc.open_by_key, tid)
-        try: ws_tgt = sh_tgt.worksheet(tgt_sheet_name)
-        except: ws_tgt = sh_tgt.add_worksheet(tgt_sheet_name, 1000, 20)
+            if h_val == 'TRUE':
+                header_df = pd.DataFrame([df.columns.tolist()], columns=df.columns)
+                df = pd.concat([header_df, df], ignore_index=True)
 
-        existing_vals = safe_api_call(ws_tgt.get_all_values)
-        start_row_idx = len(existing_vals) + 1 if existing_vals else 1
+            for k, v in sys_vals.items(): df[k] = v
+            frame = FrameRows(df)
 
-        if not existing_vals:
-            ws_tgt.update([df.columns.tolist()] + df.fillna("").values.tolist())
-            return "Thành công (New)", len(df), f"1 - {len(df)}"
-        else:
-            tgt_headers = existing_vals[0]
-            updated_headers = tgt_headers.copy(); added = False
-            for c in [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]:
-                if c not in updated_headers: updated_headers.append(c); added = True
-            if added:
-                ws_tgt.update(range_name="A1", values=[updated_headers])
-                tgt_headers = updated_headers
-
-            sys_cols = [SYS_COL_LINK, SYS_COL_SHEET, SYS_COL_MONTH, SYS_COL_TIME]
-            cols_to_write = []
-            for h in tgt_headers:
-                if h in df.columns or h in sys_cols:
-                    cols_to_write.append(h)
-            
-            df_aligned = pd.DataFrame()
-            for col in cols_to_write:
-                 if col in df.columns: df_aligned[col] = df[col]
-                 else: df_aligned[col] = "" 
+        mark = (fingerprint, sid, src_version) if fingerprint else None
+        return None, (frame, sid, src_sheet_name, month_val, mark)
 
-        w_mode = str(row.get(COL_WRITE_MODE, 'Ghi Đè')).strip()
-        if "đè" in w_mode.lower() or "overwrite" in w_mode.lower():
-            keys_to_delete = set([(sid, src_sheet_name, month_val)])
-            rows_to_del = get_rows_to_delete_dynamic(ws_tgt, keys_to_delete)
-            if rows_to_del:
-                batch_delete_rows(sh_tgt, ws_tgt.id, rows_to_del)
-                time.sleep(3) 
-                current_vals = safe_api_call(ws_tgt.get_all_values)
-                start_row_idx = len(current_vals) + 1 if current_vals else 1
-
-        chunk_size = 5000
-        new_vals = df_aligned.fillna('').values.tolist()
-        for i in range(0, len(new_vals), chunk_size):
-            safe_api_call(ws_tgt.append_rows, new_vals[i:i+chunk_size], value_input_option='USER_ENTERED')
-            time.sleep(1)
+    except Exception as e:
+        return (f"Lỗi: {str(e)[:50]}", 0, "Error"), None
 
-        end_row_idx = start_row_idx + len(df) - 1
-        rng_str = f"{start_row_idx} - {end_row_idx}"
-        return f"Thành công", len(df), rng_str
+def process_target_group(rows, bot_creds, freshness=None, source_cache=None, engine=None, schema_cache=None):
+    """
+    [NEW] Các dòng cấu hình cùng 1 tab đích: tải từng nguồn, rồi 1 lần quét xóa + 1 lần ghi cho cả nhóm.
+    Trả về list (trạng thái, số dòng, vùng dòng) theo đúng thứ tự rows.
+    """
+    results = [None] * len(rows); ready = []
+    try: gc = authorize(bot_creds)
+    except Exception as e: return [(f"Lỗi: {str(e)[:50]}", 0, "Error")] * len(rows)
+    for n, row in enumerate(rows):
+        res, job = prepare_row(row, gc, freshness, source_cache, engine, schema_cache)
+        if job is None: results[n] = res
+        else: ready.append((n, job))
+    if not ready: return results
+
+    tid, tgt_sheet_name = target_of(rows[ready[0][0]])
+    items = [(frame, rows[n], sid, src_sheet, month) for n, (frame, sid, src_sheet, month, _) in ready]
+    try:
+        # [NEW] Khóa sheet đích trong lúc xóa + ghi để các block chạy song song không đè nhau
+        with get_target_lock(tid, tgt_sheet_name):
+            outs = write_group_to_target(gc, tid, tgt_sheet_name, items)
+    except Exception as e: outs = [(f"Lỗi: {str(e)[:50]}", 0, "Error")] * len(items)
+    for (n, job), out in zip(ready, outs):
+        results[n] = out
+        if job[4] and str(out[0]).startswith("Thành công"): freshness.mark_synced(*job[4])
+    return results
 
-    except Exception as e:
-        return f"Lỗi: {str(e)[:50]}", 0, "Error"
 
 # ==========================================
 # 5. SCHEDULER & MAIN LOOP
@@ -508,30 +580,58 @@ def check_block_due(block_name, sched_df, last_run_time):
 # ==========================================
 # CẬP NHẬT: GET JOBS (Thêm phần in log khi Skip)
 # ==========================================
-def get_jobs(gc_master):
+def load_config_snapshot(sh):
+    """[NEW] Đọc luu_cau_hinh đúng 1 lần cho cả lượt chạy: (wks_cfg, df_cfg) dùng chung cho mọi block"""
+    wks_cfg = sh.worksheet(SHEET_CONFIG_NAME)
+    return wks_cfg, get_as_dataframe(wks_cfg, evaluate_formulas=True, dtype=str)
+
+def get_active_blocks(df_cfg):
+    """Các block còn dòng 'Chưa chốt' ở luu_cau_hinh"""
+    df_active = df_cfg[df_cfg[COL_STATUS].astype(str).str.contains('Chưa chốt', case=False, na=False)]
+    return [b for b in df_active[COL_BLOCK_NAME].unique() if b and str(b).strip() != '']
+
+def read_last_runs(sh):
+    """Block -> lần chạy Auto gần nhất (đọc 2000 dòng log cuối)"""
+    # --- ĐOẠN LOGIC ĐỌC LOG CŨ (Đã Fix lỗi chạy lại) ---
+    last_run_map = {}
+    try:
+        logs = sh.worksheet(SHEET_LOG_NAME).get_all_values()[-2000:]
+        for row in reversed(logs):
+            if len(row) > 11 and row[10] == "Auto": 
+                blk_name = row[11]
+                d_parsed = parse_log_date(row[0])
+                # Chỉ lấy dòng log MỚI NHẤT cho mỗi block
+                if blk_name not in last_run_map and d_parsed:
+                    last_run_map[blk_name] = TZ_VN.localize(d_parsed)
+    except Exception as e: 
+        print(f"Lỗi đọc log: {e}")
+    return last_run_map
+
+def load_block_state(sh):
+    """
+    [NEW] Bảng sys_state (1 dòng / block). Lần đầu (tab trống) nạp từ log_lanthucthi đúng 1 lần,
+    sau đó chỉ đọc tab nhỏ này. None nếu lỗi -> quay về đọc log như cũ.
+    """
+    try:
+        state = BlockRunState(sh)
+        if state.is_empty():
+            for blk, t in read_last_runs(sh).items(): state.mark_run(blk, t, 0, 0, "Nạp từ log")
+            state.flush()
+        return state
+    except Exception as e:
+        print(f"⚠️ Lỗi đọc sys_state: {e} -> đọc log_lanthucthi")
+        return None
+
+def get_jobs(gc_master, block_state=None, cfg=None):
     try:
         sh = gc_master.open_by_key(SHEET_ID)
-        df_cfg = get_as_dataframe(sh.worksheet(SHEET_CONFIG_NAME), evaluate_formulas=True, dtype=str)
-        df_active = df_cfg[df_cfg[COL_STATUS].astype(str).str.contains('Chưa chốt', case=False, na=False)]
-        active_blocks = [b for b in df_active[COL_BLOCK_NAME].unique() if b and str(b).strip() != '']
+        active_blocks = get_active_blocks((cfg or load_config_snapshot(sh))[1])
 
         try: df_sched = get_as_dataframe(sh.worksheet(SHEET_SYS_CONFIG), evaluate_formulas=True, dtype=str)
         except: return []
 
-        # --- ĐOẠN LOGIC ĐỌC LOG CŨ (Đã Fix lỗi chạy lại) ---
-        last_run_map = {}
-        try:
-            logs = sh.worksheet(SHEET_LOG_NAME).get_all_values()[-2000:]
-            for row in reversed(logs):
-                if len(row) > 11 and row[10] == "Auto": 
-                    blk_name = row[11]
-                    d_parsed = parse_log_date(row[0])
-                    # Chỉ lấy dòng log MỚI NHẤT cho mỗi block
-                    if blk_name not in last_run_map and d_parsed:
-                        last_run_map[blk_name] = TZ_VN.localize(d_parsed)
-        except Exception as e: 
-            print(f"Lỗi đọc log: {e}")
-        # ----------------------------------------------------
+        # [NEW] Lần chạy gần nhất lấy từ sys_state (1 dòng / block), không quét log
+        last_run_map = block_state.last_runs() if block_state else read_last_runs(sh)
 
         jobs = []
         print("\n--- 🔍 KIỂM TRA LỊCH TRÌNH ---")
@@ -551,66 +651,256 @@ def get_jobs(gc_master):
         print(f"Lỗi get_jobs: {e}")
         return []
 
+# ==========================================
+# [NEW] CHẾ ĐỘ DAEMON: HÀNG ĐỢI ƯU TIÊN THEO GIỜ ĐẾN HẠN
+# ==========================================
+# Cron chỉ chạy 2 lần / giờ nên block "Chạy theo phút" có thể trễ tới 30 phút. Daemon (AUTO_DAEMON=1 hoặc --daemon)
+# chạy liên tục: heap (giờ đến hạn, block) tính từ Loai_Lich / Thong_So_Chinh / Thong_So_Phu, ngủ tới block sớm nhất,
+# đọc lại tab sys_config (nhỏ) mỗi DAEMON_POLL_SECONDS để nhận lịch mới.
+DAEMON_MODE = os.environ.get("AUTO_DAEMON", "0").strip() in ("1", "true", "True") or "--daemon" in sys.argv
+DAEMON_POLL_SECONDS = int(os.environ.get("AUTO_DAEMON_POLL_SECONDS", "300"))
+DAEMON_LOOKAHEAD_DAYS = 62
+
+def next_due_time(sched_row, last_run_time, now=None):
+    """Thời điểm đến hạn kế tiếp của 1 block (cùng luật với check_block_due). None = tắt / lỗi cấu hình."""
+    now = now or datetime.now(TZ_VN)
+    l_type = str(sched_row.get('Loai_Lich', '')).strip()
+    val1 = str(sched_row.get('Thong_So_Chinh', '')).strip(); val2 = str(sched_row.get('Thong_So_Phu', '')).strip()
+
+    if l_type == "Chạy theo phút":
+        try: interval = int(val1)
+        except: return None
+        return last_run_time + timedelta(minutes=interval) if last_run_time else now
+    if l_type not in ("Hàng ngày", "Hàng tuần", "Hàng tháng"): return None
+
+    try: 
+        target_hour = int(val1.split(':')[0])
+        target_min = int(val1.split(':')[1]) if ':' in val1 else 0
+    except: return None
+    week_days = [parse_weekday(d) for d in val2.split(',')]
+    month_days = [int(d) for d in val2.split(',') if d.strip().isdigit()]
+
+    for k in range(DAEMON_LOOKAHEAD_DAYS):
+        day = (now + timedelta(days=k)).date()
+        if last_run_time and last_run_time.date() >= day: continue  # Ngày này đã chạy rồi
+        if l_type == "Hàng tuần" and day.weekday() not in week_days: continue
+        if l_type == "Hàng tháng" and day.day not in month_days: continue
+        # Hôm nay đã qua giờ mà chưa chạy -> đến hạn ngay (như check_block_due)
+        return TZ_VN.localize(datetime(day.year, day.month, day.day, target_hour, target_min))
+    return None
+
+def run_daemon(gc_master, block_state=None):
+    """Vòng lặp daemon: không bao giờ trả về (Ctrl+C / kill để dừng)."""
+    sh = gc_master.open_by_key(SHEET_ID)
+    last_run_map = block_state.last_runs() if block_state else read_last_runs(sh)
+    sched_rows = {}; sched_snap = None; heap = []; next_poll = 0.0
+
+    def push(blk, now):
+        due = next_due_time(sched_rows[blk], last_run_map.get(blk), now)
+        if due: heapq.heappush(heap, (due, blk))
+
+    while True:
+        now = datetime.now(TZ_VN)
+        if time.time() >= next_poll:
+            next_poll = time.time() + DAEMON_POLL_SECONDS
+            try:
+                df_sched = get_as_dataframe(sh.worksheet(SHEET_SYS_CONFIG), evaluate_formulas=True, dtype=str)
+                snap = df_sched.to_csv(index=False)
+                if snap != sched_snap:
+                    sched_snap = snap; heap = []
+                    sched_rows = {}
+                    for _, r in df_sched.iterrows():
+                        blk = str(r.get('Block_Name', '')).strip()
+                        if blk not in ('', 'nan'): sched_rows.setdefault(blk, r)  # Trùng tên -> lấy dòng đầu như check_block_due
+                    for blk in sched_rows: push(blk, now)
+                    print(f"🔄 Nạp lịch sys_config: {len(heap)} block trong hàng đợi" + (f", sớm nhất {heap[0][1]} lúc {heap[0][0].strftime('%H:%M %d/%m')}" if heap else ""))
+            except Exception as e: print(f"⚠️ Lỗi đọc sys_config: {e} -> giữ lịch cũ")
+
+        due_blocks = []
+        while heap and heap[0][0] <= now: due_blocks.append(heapq.heappop(heap)[1])
+        if due_blocks:
+            try: cfg = load_config_snapshot(sh); active = set(get_active_blocks(cfg[1]))
+            except Exception as e: print(f"⚠️ Lỗi đọc luu_cau_hinh: {e}"); cfg = None; active = set()
+            jobs = [b for b in dict.fromkeys(due_blocks) if b in active]
+            started = datetime.now(TZ_VN)
+            results = {}
+            if jobs:
+                print(f"✅ [ĐẾN HẠN] {', '.join(jobs)}")
+                try: results = run_jobs_and_report(gc_master, jobs, block_state, cfg)
+                except Exception as e: print(traceback.format_exc()); send_telegram(f"❌ <b>Lỗi daemon:</b> {str(e)}", True)
+            for blk in dict.fromkeys(due_blocks):
+                if blk not in sched_rows: continue
+                # [FIX] Chỉ block chạy xong mới lùi mốc chạy; lỗi / không chạy được -> thử lại sau DAEMON_POLL_SECONDS
+                if results.get(blk): last_run_map[blk] = started; push(blk, datetime.now(TZ_VN))
+                # Block lỗi / không còn dòng 'Chưa chốt' -> xem lại ở lượt đọc lịch sau
+                else: heapq.heappush(heap, (datetime.now(TZ_VN) + timedelta(seconds=DAEMON_POLL_SECONDS), blk))
+            continue
+
+        wait = next_poll - time.time()
+        if heap: wait = min(wait, (heap[0][0] - datetime.now(TZ_VN)).total_seconds())
+        time.sleep(max(wait, 1))
+
+# ==========================================
+# 6. CHẠY SONG SONG THEO BOT
+# ==========================================
+def pending_rows(df_cfg, blk):
+    """Các dòng 'Chưa chốt' của 1 block"""
+    return df_cfg[(df_cfg[COL_BLOCK_NAME] == blk) & (df_cfg[COL_STATUS].str.contains('Chưa chốt', na=False))]
+
+def expect_sources(source_cache, rows):
+    """Đăng ký trước số lượt dùng từng nguồn (SourceCache.expect) để nguồn được giữ tới lượt dùng cuối"""
+    for _, r in rows.iterrows():
+        sid_r = extract_id(str(r.get(COL_SRC_LINK, '')).strip())
+        if sid_r: source_cache.expect(source_key(sid_r, str(r.get(COL_SRC_SHEET, '')).strip(), r.get(COL_DATA_RANGE, '')))
+
+def run_block(blk, gc_master, bot_email, freshness=None, source_cache=None, schema_cache=None, block_state=None, cfg=None):
+    """
+    Chạy toàn bộ dòng 'Chưa chốt' của 1 block. Trả về (tổng dòng, log_buffer) hoặc None nếu không có key bot.
+    cfg: (wks_cfg, df_cfg) đã đọc sẵn cho cả lượt chạy (None -> tự đọc như cũ).
+    """
+    print(f"▶️ Processing: {blk}")
+    started = datetime.now(TZ_VN); t0 = time.time()
+    bot_creds = get_bot_creds_by_email(bot_email)
+    if not bot_creds: return None
+
+    wks_cfg, df_cfg = cfg or load_config_snapshot(gc_master.open_by_key(SHEET_ID))
+    
+    rows = pending_rows(df_cfg, blk)
+    
+    total_rows = 0; log_buffer = []
+    
+    # [NEW] Gom dòng theo (file đích, tab đích) như process_pipeline_mixed: mỗi nhóm 1 lần quét xóa + 1 lần ghi
+    groups = defaultdict(list)
+    for i, r in rows.iterrows(): groups[target_of(r)].append((i, r))
+
+    cfg_results = []  # Gom kết quả, ghi 1 lần cuối block
+    for group in groups.values():
+        results = process_target_group([r for _, r in group], bot_creds, freshness, source_cache, schema_cache=schema_cache)
+        for (i, r), (status, count, range_str) in zip(group, results):
+            print(f"  + [{blk}] Row {i}: {status} ({count})")
+            total_rows += count
+            
+            cfg_results.append((i, status, range_str))
+            
+            # [FIX QUAN TRỌNG] Thêm dấu nháy đơn ' vào trước để Google Sheet hiểu là Text
+            time_str = "'" + datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")
+            
+            # [FIX] Ô trống của config (dtype=str) là NaN -> JSON lỗi, làm kẹt cả tab log: đổi hết sang chuỗi
+            log_buffer.append([log_cell(v) for v in [
+                time_str, r.get(COL_DATA_RANGE), r.get(COL_MONTH), "Auto_Runner",
+                r.get(COL_SRC_LINK), r.get(COL_TGT_LINK), r.get(COL_TGT_SHEET), r.get(COL_SRC_SHEET),
+                status, count, "Auto", blk
+            ]])
+    
+    flush_config_results(wks_cfg, df_cfg.columns, cfg_results)
+    write_behavior_log(gc_master, "Chạy Tự Động", blk, f"Xử lý xong {total_rows} dòng", "Completed")
+    # [NEW] Ghi trạng thái block ngay khi xong (sys_state), không chờ cả lượt chạy
+    if block_state: block_state.mark_run(blk, started, time.time() - t0, total_rows); block_state.flush()
+    return total_rows, log_buffer
+
+def run_jobs_concurrently(jobs, gc_master, freshness=None, schema_cache=None, block_state=None, cfg=None):
+    """
+    Mỗi bot có 1 pool riêng (WORKERS_PER_BOT luồng): các block khác bot chạy song song,
+    các block cùng bot xếp hàng trong pool của bot đó. Trả về {block: kết quả run_block}.
+    """
+    jobs_by_bot = defaultdict(list)
+    for blk in jobs: jobs_by_bot[assign_bot_to_block(blk, gc_master)].append(blk)
+
+    pools = {bot: ThreadPoolExecutor(max_workers=WORKERS_PER_BOT, thread_name_prefix=f"bot{i}")
+             for i, bot in enumerate(jobs_by_bot)}
+    # Cache nguồn theo bot: bot nào tải thì chỉ các block của bot đó dùng lại (giữ đúng quyền truy cập)
+    caches = {bot: SourceCache() for bot in jobs_by_bot}
+    # [FIX] Đăng ký lượt dùng nguồn của mọi block cùng bot trước khi chạy (như process_pipeline_mixed):
+    # block trước không nhả nguồn mà block sau trong hàng đợi của bot còn cần
+    cfg = cfg or load_config_snapshot(gc_master.open_by_key(SHEET_ID))
+    for bot, blks in jobs_by_bot.items():
+        for blk in blks: expect_sources(caches[bot], pending_rows(cfg[1], blk))
+    futures = {}
+    for bot, blks in jobs_by_bot.items():
+        print(f"🤖 {bot}: {len(blks)} block ({WORKERS_PER_BOT} luồng)")
+        for blk in blks: futures[pools[bot].submit(run_block, blk, gc_master, bot, freshness, caches[bot], schema_cache, block_state, cfg)] = blk
+
+    results = {}
+    try:
+        for fut in as_completed(futures):
+            blk = futures[fut]
+            try: results[blk] = fut.result()
+            except Exception as e:
+                print(f"❌ [{blk}] Lỗi: {e}")
+                if block_state: block_state.mark_error(blk, e); block_state.flush()
+                results[blk] = None
+    finally:
+        for pool in pools.values(): pool.shutdown(wait=True)
+    return results
+
+def run_jobs_and_report(gc_master, jobs, block_state=None, cfg=None):
+    """Chạy các block đến hạn, ghi log lần thực thi, báo Telegram (dùng chung cho cron và daemon). Trả về {block: kết quả / None}"""
+    freshness = None
+    if SKIP_UNCHANGED:
+        try: freshness = SourceFreshness(gc_master.open_by_key(SHEET_ID))
+        except Exception as e: print(f"⚠️ Lỗi đọc sys_source_state: {e} -> chạy lại toàn bộ nguồn")
+
+    # [NEW] Schema kiểu cột đã đoán theo nguồn, đọc 1 lần / ghi gom 1 lần
+    try: schema_cache = SchemaCache(gc_master.open_by_key(SHEET_ID))
+    except Exception as e: print(f"⚠️ Lỗi đọc sys_schema_state: {e} -> đoán kiểu lại từ đầu"); schema_cache = None
+
+    results = run_jobs_concurrently(jobs, gc_master, freshness, schema_cache, block_state, cfg)
+    if freshness: freshness.flush()
+    if schema_cache: schema_cache.flush()
+
+    # Gộp log & báo cáo theo đúng thứ tự jobs
+    success_msgs = []; all_logs = []
+    for blk in jobs:
+        res = results.get(blk)
+        if not res: continue
+        total_rows, log_buffer = res
+        all_logs.extend(log_buffer)
+        success_msgs.append(f"• <b>{blk}</b>: {total_rows} dòng")
+
+    if all_logs: get_log_sink(gc_master).log_rows(SHEET_LOG_NAME, all_logs)
+
+    for bot, q in get_quota_status().items():
+        print(f"📊 Quota {bot}: {q['calls']} lượt gọi, chờ {q['throttled']} lần ({q['waited']}s) | đọc còn {q['read']['tokens']}, ghi còn {q['write']['tokens']}")
+    for bot, c in get_client_stats().items():
+        print(f"🔌 Client {bot}: {c['requests']} request / {c['connections']} kết nối (x{c['reuse_ratio']}), dùng lại client {c['reused']} lần, pool {c['pool_size']}")
+    mc = META_CACHE.stats(); print(f"🗂️ Cache metadata: {mc['hits']} lần dùng lại / {mc['misses']} lần đọc, {mc['spreadsheets']} file")
+
+    if success_msgs:
+        end_time = datetime.now(TZ_VN).strftime('%H:%M')
+        msg = f"✅ <b>ĐÃ XONG:</b> {end_time}\n{chr(10).join(success_msgs)}"
+        send_telegram(msg)
+    return results
+
 if __name__ == "__main__":
     start_time = datetime.now(TZ_VN).strftime('%H:%M:%S %d/%m')
     print(f"🚀 START AUTO: {start_time}")
-    send_telegram(f"🏁 <b>Kinkin Tool Bắt Đầu Chạy</b>\n🕒 Lúc: {start_time}")
+    send_telegram(f"🏁 <b>Kinkin Tool Bắt Đầu Chạy</b>\n🕒 Lúc: {start_time}" + (" (daemon)" if DAEMON_MODE else ""))
 
     try:
         if not SHEET_ID: exit(0)
         master_creds = get_bot_creds_by_index(0)
-        gc_master = gspread.authorize(master_creds)
+        gc_master = authorize(master_creds)
+
+        # [NEW] Trạng thái lần chạy theo block (sys_state) thay cho quét log_lanthucthi
+        block_state = load_block_state(gc_master.open_by_key(SHEET_ID))
+
+        # [NEW] Daemon: chạy liên tục theo hàng đợi giờ đến hạn thay cho 2 mốc cron mỗi giờ
+        # (SIGTERM -> thoát bình thường để log còn trong hàng đợi được ghi nốt)
+        if DAEMON_MODE:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            run_daemon(gc_master, block_state)
 
-        jobs = get_jobs(gc_master)
+        # [NEW] luu_cau_hinh chỉ tải 1 lần, dùng chung cho get_jobs và mọi block
+        try: cfg = load_config_snapshot(gc_master.open_by_key(SHEET_ID))
+        except Exception as e: print(f"⚠️ Lỗi đọc luu_cau_hinh: {e}"); cfg = None
+
+        jobs = get_jobs(gc_master, block_state, cfg)
         
         if not jobs:
             print("💤 Không có lịch chạy lúc này.")
             exit(0)
 
-        success_msgs = []
-        
-        for blk in jobs:
-            print(f"▶️ Processing: {blk}")
-            bot_email = assign_bot_to_block(blk)
-            bot_creds = get_bot_creds_by_email(bot_email)
-            if not bot_creds: continue
-
-            sh = gc_master.open_by_key(SHEET_ID)
-            wks_cfg = sh.worksheet(SHEET_CONFIG_NAME) 
-            df_cfg = get_as_dataframe(wks_cfg, evaluate_formulas=True, dtype=str)
-            
-            rows = df_cfg[(df_cfg[COL_BLOCK_NAME] == blk) & (df_cfg[COL_STATUS].str.contains('Chưa chốt', na=False))]
-            
-            total_rows = 0; log_buffer = []
-            
-            for i, r in rows.iterrows():
-                status, count, range_str = process_single_row_automation(r, bot_creds)
-                print(f"  + Row {i}: {status} ({count})")
-                total_rows += count
-                
-                update_config_result(wks_cfg, i, status, range_str)
-                
-                # [FIX QUAN TRỌNG] Thêm dấu nháy đơn ' vào trước để Google Sheet hiểu là Text
-                time_str = "'" + datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")
-                
-                log_buffer.append([
-                    time_str, r.get(COL_DATA_RANGE), r.get(COL_MONTH), "Auto_Runner",
-                    r.get(COL_SRC_LINK), r.get(COL_TGT_LINK), r.get(COL_TGT_SHEET), r.get(COL_SRC_SHEET),
-                    status, count, "Auto", blk
-                ])
-            
-            if log_buffer:
-                try: sh.worksheet(SHEET_LOG_NAME).append_rows(log_buffer)
-                except: pass
-            
-            write_behavior_log(gc_master, "Chạy Tự Động", blk, f"Xử lý xong {total_rows} dòng", "Completed")
-            success_msgs.append(f"• <b>{blk}</b>: {total_rows} dòng")
-            time.sleep(5)
-
-        if success_msgs:
-            end_time = datetime.now(TZ_VN).strftime('%H:%M')
-            msg = f"✅ <b>ĐÃ XONG:</b> {end_time}\n{chr(10).join(success_msgs)}"
-            send_telegram(msg)
+        run_jobs_and_report(gc_master, jobs, block_state, cfg)
 
     except Exception as e:
         print(traceback.format_exc())
@@ -0,0 +1,1499 @@
+"""
+KINKIN CORE - Thành phần dùng chung cho app.py (Streamlit) và auto_job.py (Auto Runner).
+Không import streamlit trong file này để auto_job chạy được trên GitHub Actions.
+"""
+import os
+import re
+import copy
+import queue
+import atexit
+import hashlib
+import time
+import random
+import threading
+import warnings
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
+from collections import namedtuple, defaultdict
+from functools import lru_cache
+from datetime import datetime, timedelta
+import pytz
+import pandas as pd
+import gspread
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import absolute_range_name, fill_gaps
+from gspread.http_client import HTTPClient
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout as RequestsTimeout
+
+TZ_VN = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# ==========================================
+# 1. RATE LIMITER (TOKEN BUCKET THEO TỪNG BOT)
+# ==========================================
+# Quota Sheets API tính theo từng service account: mặc định 60 lượt đọc + 60 lượt ghi / phút.
+# Bucket cho phép "nổ" tối đa 10% quota, phần còn lại rải đều để cả phút không vượt QUOTA_SAFETY.
+QUOTA_READ_PER_MIN = int(os.environ.get("KINKIN_QUOTA_READ_PER_MIN", "60"))
+QUOTA_WRITE_PER_MIN = int(os.environ.get("KINKIN_QUOTA_WRITE_PER_MIN", "60"))
+QUOTA_SAFETY = 0.9
+QUOTA_MAX_RETRY = 5
+QUOTA_MAX_BACKOFF = 64
+
+class TokenBucket:
+    """Token bucket an toàn đa luồng. acquire() chờ tới khi đủ token (hoặc hết thời gian phạt 429)."""
+    def __init__(self, per_minute):
+        self.capacity = max(1, int(per_minute * 0.1))
+        self.rate = max(per_minute * QUOTA_SAFETY - self.capacity, 1) / 60.0 # token / giây
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _wait_time(self, now, n=1):
+        if self.blocked_until > now: return self.blocked_until - now
+        if self.tokens >= n: return 0.0
+        return (n - self.tokens) / self.rate
+
+    def acquire(self, n=1):
+        """Lấy n token, trả về số giây đã phải chờ"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic(); self._refill(now)
+                wait = self._wait_time(now, n)
+                if wait <= 0:
+                    self.tokens -= n
+                    return waited
+            # Jitter để các luồng cùng bot không cùng thức dậy 1 lúc
+            wait += random.uniform(0, min(1.0, wait * 0.1))
+            time.sleep(wait); waited += wait
+
+    def penalize(self, seconds):
+        """Bị 429: xả hết token và khóa bucket trong `seconds` giây"""
+        with self.lock:
+            now = time.monotonic(); self._refill(now)
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic(); self._refill(now)
+            return {"tokens": round(self.tokens, 2), "capacity": self.capacity, "wait": round(self._wait_time(now), 2)}
+
+class BotRateLimiter:
+    """2 bucket (đọc / ghi) cho 1 service account"""
+    def __init__(self, email):
+        self.email = email
+        self.buckets = {"read": TokenBucket(QUOTA_READ_PER_MIN), "write": TokenBucket(QUOTA_WRITE_PER_MIN)}
+        self.stats = {"calls": 0, "throttled": 0, "waited": 0.0}
+        self.lock = threading.Lock()
+
+    def acquire(self, kind):
+        waited = self.buckets[kind].acquire()
+        with self.lock:
+            self.stats["calls"] += 1
+            if waited > 0: self.stats["throttled"] += 1; self.stats["waited"] += waited
+
+    def penalize(self, kind, seconds):
+        self.buckets[kind].penalize(seconds)
+
+    def snapshot(self):
+        snap = {k: b.snapshot() for k, b in self.buckets.items()}
+        with self.lock: snap.update({"calls": self.stats["calls"], "throttled": self.stats["throttled"], "waited": round(self.stats["waited"], 1)})
+        return snap
+
+_LIMITERS = {}
+_LIMITERS_GUARD = threading.Lock()
+
+def get_rate_limiter(email):
+    email = str(email or "default").strip().lower()
+    with _LIMITERS_GUARD:
+        if email not in _LIMITERS: _LIMITERS[email] = BotRateLimiter(email)
+        return _LIMITERS[email]
+
+def get_quota_status():
+    """Budget hiện tại & thời gian phải chờ của mọi bot: {email: {"read": {...}, "write": {...}, ...}}"""
+    with _LIMITERS_GUARD: limiters = list(_LIMITERS.values())
+    return {lm.email: lm.snapshot() for lm in limiters}
+
+def is_quota_error(e):
+    if isinstance(e, APIError):
+        if e.code == 429: return True
+        try:
+            reasons = [str(x.get("reason", "")) for x in e.error.get("errors", [])]
+            if e.code == 403 and any(r in ("rateLimitExceeded", "userRateLimitExceeded") for r in reasons): return True
+        except: pass
+        return str(e.error.get("status", "")) == "RESOURCE_EXHAUSTED"
+    return "429" in str(e) or "quota" in str(e).lower()
+
+def is_transient_error(e):
+    """Lỗi tạm thời, gọi lại có thể qua: quota / 5xx / mất kết nối"""
+    if is_quota_error(e): return True
+    if isinstance(e, APIError): return e.code >= 500
+    return isinstance(e, (RequestsConnectionError, RequestsTimeout))
+
+def get_retry_after(e, attempt):
+    """Số giây phải chờ: ưu tiên header Retry-After, không có thì backoff lũy thừa"""
+    try:
+        val = e.response.headers.get("Retry-After")
+        if val: return min(float(val), QUOTA_MAX_BACKOFF) + random.uniform(0, 1)
+    except: pass
+    return min(2 ** (attempt + 1), QUOTA_MAX_BACKOFF) + random.uniform(0, 1)
+
+# [NEW] Cache metadata spreadsheet (tab, sheetId, tên, kích thước lưới) + dòng tiêu đề từng tab, sống META_CACHE_TTL giây.
+# open_by_key / worksheets() / worksheet() đều đọc metadata qua fetch_sheet_metadata -> lấy từ cache nếu còn hạn.
+# Mọi lệnh ghi (không phải GET) của chính mình vào 1 spreadsheet -> xóa cache của spreadsheet đó (mọi bot).
+# Khóa theo (bot, spreadsheet) để bot không có quyền không đọc được metadata do bot khác lấy về.
+META_CACHE_TTL = float(os.environ.get("KINKIN_META_TTL", "60"))
+_RE_SPREADSHEET_ID = re.compile(r"/spreadsheets/([a-zA-Z0-9_-]+)")
+
+class MetadataCache:
+    def __init__(self, ttl=META_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = defaultdict(dict)  # spreadsheet id -> {(loại, bot, khóa phụ): (thời điểm, dữ liệu)}
+        self.gen = defaultdict(int)       # tăng mỗi lần xóa -> bỏ kết quả đọc đang dở từ trước lúc xóa
+        self.hits = 0; self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, sid, key, fetch):
+        with self.lock:
+            ent = self.entries[sid].get(key); gen = self.gen[sid]
+            if ent and time.time() - ent[0] < self.ttl: self.hits += 1; return copy.deepcopy(ent[1])
+            self.misses += 1
+        data = fetch()
+        if data is not None:
+            with self.lock:
+                if self.gen[sid] == gen: self.entries[sid][key] = (time.time(), copy.deepcopy(data))
+        return data
+
+    def invalidate(self, sid):
+        with self.lock: self.entries.pop(sid, None); self.gen[sid] += 1
+
+    def invalidate_url(self, url):
+        m = _RE_SPREADSHEET_ID.search(str(url))
+        if m: self.invalidate(m.group(1))
+
+    def stats(self):
+        with self.lock: return {"hits": self.hits, "misses": self.misses, "spreadsheets": len(self.entries)}
+
+META_CACHE = MetadataCache()
+
+def header_row(ws, call=None):
+    """Dòng 1 của tab (qua META_CACHE). call(f, *args): bọc retry của app / auto."""
+    call = call or (lambda f, *a, **kw: f(*a, **kw))
+    key = ("header", getattr(ws.client, "account", None), ws.id)
+    return list(META_CACHE.get(ws.spreadsheet_id, key, lambda: call(ws.row_values, 1)) or [])
+
+class RateLimitedHTTPClient(HTTPClient):
+    """
+    HTTPClient của gspread, mọi request đều đi qua bucket của bot:
+    GET tính vào quota đọc, còn lại tính vào quota ghi. Gặp 429 thì khóa bucket theo Retry-After rồi gọi lại.
+    """
+    def __init__(self, auth, session=None):
+        super().__init__(auth, session)
+        self.account = getattr(auth, "service_account_email", None)
+        self.limiter = get_rate_limiter(self.account)
+
+    def request(self, method, endpoint, *args, **kwargs):
+        kind = "read" if str(method).upper() == "GET" else "write"
+        try:
+            for attempt in range(QUOTA_MAX_RETRY):
+                self.limiter.acquire(kind)
+                try: return super().request(method, endpoint, *args, **kwargs)
+                except APIError as e:
+                    if not is_quota_error(e) or attempt == QUOTA_MAX_RETRY - 1: raise
+                    self.limiter.penalize(kind, get_retry_after(e, attempt))
+        finally:
+            if kind == "write": META_CACHE.invalidate_url(endpoint)
+
+    def fetch_sheet_metadata(self, id, params=None):
+        if params is not None: return super().fetch_sheet_metadata(id, params)
+        return META_CACHE.get(id, ("meta", self.account), lambda: super(RateLimitedHTTPClient, self).fetch_sheet_metadata(id))
+
+# [NEW] Mỗi service account 1 client gspread dùng chung (1 session keep-alive, pool CLIENT_POOL_SIZE kết nối)
+# thay vì authorize mới mỗi lần gọi -> không lặp lại bắt tay TLS + lấy token cho từng dòng cấu hình.
+CLIENT_POOL_SIZE = int(os.environ.get("KINKIN_CLIENT_POOL_SIZE", "16"))
+
+class ClientRegistry:
+    """Sổ client theo email service account. Streamlit giữ 1 sổ trong st.cache_resource, auto_job dùng sổ mặc định."""
+    def __init__(self, pool_size=CLIENT_POOL_SIZE):
+        self.pool_size = pool_size
+        self.clients = {}; self.hits = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get(self, creds):
+        key = getattr(creds, "service_account_email", None) or id(creds)
+        with self.lock:
+            gc = self.clients.get(key)
+            if gc is not None: self.hits[key] += 1; return gc
+            gc = gspread.authorize(creds, http_client=RateLimitedHTTPClient)
+            gc.http_client.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size))
+            self.clients[key] = gc
+            return gc
+
+    def stats(self):
+        """{email: lượt dùng lại client, số request, số kết nối đã mở, request / kết nối, cỡ pool}"""
+        out = {}
+        with self.lock: items = list(self.clients.items())
+        for key, gc in items:
+            pools = gc.http_client.session.get_adapter("https://").poolmanager.pools
+            conns = [pools[k] for k in pools.keys()]
+            n_req = sum(getattr(c, "num_requests", 0) for c in conns); n_conn = sum(getattr(c, "num_connections", 0) for c in conns)
+            out[str(key)] = {"reused": self.hits[key], "requests": n_req, "connections": n_conn,
+                             "reuse_ratio": round(n_req / n_conn, 1) if n_conn else 0.0, "pool_size": self.pool_size}
+        return out
+
+_CLIENT_REGISTRY = ClientRegistry()
+
+def authorize(creds, registry=None):
+    """gspread.authorize nhưng đi qua rate limiter của bot sở hữu creds, client lấy từ sổ dùng chung"""
+    return (registry or _CLIENT_REGISTRY).get(creds)
+
+def get_client_stats(registry=None):
+    return (registry or _CLIENT_REGISTRY).stats()
+
+# ==========================================
+# 2. PHÂN BỔ BOT THEO TẢI (STICKY)
+# ==========================================
+# Block đã được gán bot thì giữ nguyên bot đó mãi (file nguồn/đích đã share cho email bot).
+# Block mới được gán cho bot đang gánh ít tải nhất, tính từ log_lanthucthi (số lượt chạy ~ số lượt gọi API + số dòng).
+# Block cũ nặng dồn chung 1 bot không tự chuyển: cân lại chủ động bằng plan_rebalance + apply_moves (phải share file trước).
+SHEET_BOT_ASSIGN = "sys_bot_assign"
+BOT_ASSIGN_COLS = ["Block_Name", "Bot_Email", "Thời điểm gán"]
+SHEET_RUN_LOG = "log_lanthucthi"
+LOG_IDX_COUNT = 9; LOG_IDX_BLOCK = 11 # Vị trí cột "Số Dòng" & "Block" trong log_lanthucthi
+LOG_SCAN_RANGE = "J:L"; LOG_SCAN_FIRST_IDX = 9 # Chỉ đọc 3 cột cần thiết (Số Dòng, Range/Auto, Block)
+LOAD_CALLS_PER_ROW_RUN = 6            # Mỗi dòng cấu hình chạy ~6 lượt gọi API (mở nguồn, đọc, mở đích, quét, ghi...)
+LOAD_ROWS_PER_CALL = 5000             # 5000 dòng dữ liệu ~ 1 lượt gọi ghi
+BOT_ASSIGN_TTL = 300
+
+def hash_bot_for_block(block_name, bots):
+    """Cách gán cũ (tổng mã ký tự) - dùng làm fallback"""
+    return bots[sum(ord(c) for c in str(block_name)) % len(bots)]
+
+class BotAssigner:
+    def __init__(self, bots):
+        self.bots = list(bots)
+        self.assigned = {}   # block -> bot (đọc từ sys_bot_assign)
+        self.block_load = {} # block -> tải lịch sử
+        self.loaded_at = 0
+        self.wks = None
+        self.lock = threading.Lock()
+
+    def _load(self, sh):
+        assigned = {}
+        try: wks = sh.worksheet(SHEET_BOT_ASSIGN)
+        except: wks = sh.add_worksheet(SHEET_BOT_ASSIGN, 100, len(BOT_ASSIGN_COLS)); wks.append_row(BOT_ASSIGN_COLS)
+        # Dòng sau ghi đè dòng trước (inherit / rebalance chỉ nối thêm dòng mới)
+        for r in wks.get_all_values()[1:]:
+            if len(r) >= 2 and r[0].strip() and r[1].strip() in self.bots: assigned[r[0].strip()] = r[1].strip()
+
+        block_load = {}
+        try:
+            rows = sh.values_get(f"'{SHEET_RUN_LOG}'!{LOG_SCAN_RANGE}").get("values", [])[1:]
+            i_cnt = LOG_IDX_COUNT - LOG_SCAN_FIRST_IDX; i_blk = LOG_IDX_BLOCK - LOG_SCAN_FIRST_IDX
+            for r in rows:
+                if len(r) <= i_blk or not str(r[i_blk]).strip(): continue
+                try: cnt = float(str(r[i_cnt]).replace(",", "") or 0)
+                except: cnt = 0
+                blk = str(r[i_blk]).strip()
+                block_load[blk] = block_load.get(blk, 0) + LOAD_CALLS_PER_ROW_RUN + cnt / LOAD_ROWS_PER_CALL
+        except: pass
+
+        self.assigned = assigned; self.block_load = block_load
+        self.wks = wks; self.loaded_at = time.time()
+
+    def bot_loads(self):
+        loads = {b: 0.0 for b in self.bots}
+        # Block chưa có lịch sử tính tải trung bình, để các block mới không dồn hết vào 1 bot
+        avg = sum(self.block_load.values()) / len(self.block_load) if self.block_load else 1.0
+        blocks = set(self.block_load) | set(self.assigned)
+        for blk in blocks:
+            bot = self.assigned.get(blk) or hash_bot_for_block(blk, self.bots)
+            loads[bot] = loads.get(bot, 0.0) + self.block_load.get(blk, avg)
+        return loads
+
+    def assign(self, block_name, open_history):
+        """open_history: hàm trả về Spreadsheet lịch sử (chỉ được gọi khi cần tải lại / ghi)"""
+        blk = str(block_name).strip()
+        with self.lock:
+            if blk in self.assigned: return self.assigned[blk]
+            try:
+                if time.time() - self.loaded_at > BOT_ASSIGN_TTL or self.wks is None: self._load(open_history())
+                if blk in self.assigned: return self.assigned[blk]
+
+                # Block đã từng chạy -> các file đã share cho bot cũ (theo hash) -> giữ nguyên
+                if blk in self.block_load: bot = hash_bot_for_block(blk, self.bots)
+                else:
+                    loads = self.bot_loads()
+                    bot = min(self.bots, key=lambda b: (loads.get(b, 0.0), self.bots.index(b)))
+                self.wks.append_row([blk, bot, datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")])
+                self.assigned[blk] = bot
+                return bot
+            except: return hash_bot_for_block(blk, self.bots)
+
+    def plan_rebalance(self, open_history, blocks=None, max_moves=None):
+        """
+        assign() chỉ rải block MỚI; block cũ dồn chung 1 bot thì phải cân lại bằng tay qua đây.
+        Trả về [(block, bot cũ, bot mới)]: chuyển dần block nặng nhất (nhẹ hơn độ chênh) từ bot tải cao nhất
+        sang bot tải thấp nhất tới khi không giảm được nữa. blocks: chỉ xét các block này (vd block còn trong cấu hình).
+        Chưa ghi gì - áp dụng bằng apply_moves sau khi đã share file nguồn / đích cho bot mới.
+        """
+        with self.lock:
+            if time.time() - self.loaded_at > BOT_ASSIGN_TTL or self.wks is None: self._load(open_history())
+            loads = self.bot_loads()
+            avg = sum(self.block_load.values()) / len(self.block_load) if self.block_load else 1.0
+            pool = set(self.block_load) | set(self.assigned)
+            if blocks is not None: pool &= set(str(b).strip() for b in blocks)
+            owner = {blk: self.assigned.get(blk) or hash_bot_for_block(blk, self.bots) for blk in pool}
+        moves = []
+        while not max_moves or len(moves) < max_moves:
+            hi = max(self.bots, key=lambda b: loads[b]); lo = min(self.bots, key=lambda b: loads[b])
+            gap = loads[hi] - loads[lo]
+            cands = [(self.block_load.get(blk, avg), blk) for blk, bot in owner.items() if bot == hi and self.block_load.get(blk, avg) < gap]
+            if not cands: break
+            w, blk = max(cands)
+            owner[blk] = lo; loads[hi] -= w; loads[lo] += w
+            moves.append((blk, hi, lo))
+        return moves
+
+    def apply_moves(self, moves, open_history):
+        """Ghi các lượt chuyển (block, bot cũ, bot mới) vào sys_bot_assign (1 lệnh). Trả về số block đã chuyển."""
+        moves = [(str(blk).strip(), new) for blk, _, new in moves if new in self.bots]
+        if not moves: return 0
+        with self.lock:
+            if self.wks is None: self._load(open_history())
+            now = datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")
+            self.wks.append_rows([[blk, bot, now] for blk, bot in moves])
+            for blk, bot in moves: self.assigned[blk] = bot
+        return len(moves)
+
+    def inherit(self, new, old, open_history):
+        """Block đổi tên / copy từ block cũ thì dùng luôn bot của block cũ (quyền share file vẫn đúng)"""
+        with self.lock:
+            try:
+                if self.wks is None: self._load(open_history())
+                bot = self.assigned.get(old) or hash_bot_for_block(old, self.bots)
+                self.wks.append_row([str(new).strip(), bot, datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")])
+                self.assigned[str(new).strip()] = bot
+            except: pass
+
+_ASSIGNERS = {}
+_ASSIGNERS_GUARD = threading.Lock()
+
+def get_bot_assigner(bots):
+    key = tuple(bots)
+    with _ASSIGNERS_GUARD:
+        if key not in _ASSIGNERS: _ASSIGNERS[key] = BotAssigner(bots)
+        return _ASSIGNERS[key]
+
+# ==========================================
+# 3. BẢNG TRẠNG THÁI (TAB NHỎ TRONG FILE LỊCH SỬ)
+# ==========================================
+class StateTable:
+    """
+    Tab dạng key -> 1 dòng, đọc 1 lần khi khởi tạo, ghi gom 1 lần khi flush()
+    (dòng cũ đổi giá trị -> 1 lệnh values.batchUpdate, dòng mới -> 1 lệnh append_rows).
+    """
+    def __init__(self, sh, tab_name, columns, hidden=False):
+        self.columns = list(columns)
+        self.rows = {}      # key -> list giá trị
+        self.row_no = {}    # key -> số dòng trên sheet
+        self.dirty = set()
+        self.lock = threading.Lock()
+        try: self.wks = sh.worksheet(tab_name)
+        except:
+            self.wks = sh.add_worksheet(tab_name, 100, len(self.columns))
+            self.wks.update(range_name="A1", values=[self.columns])
+            if hidden:
+                try: self.wks.hide()
+                except: pass
+        for i, r in enumerate(self.wks.get_all_values()[1:], start=2):
+            if r and str(r[0]).strip():
+                self.rows[str(r[0]).strip()] = (list(r) + [""] * len(self.columns))[:len(self.columns)]
+                self.row_no[str(r[0]).strip()] = i
+
+    def get(self, key):
+        with self.lock:
+            r = self.rows.get(str(key))
+            return dict(zip(self.columns, r)) if r else None
+
+    def set(self, key, values):
+        """values: dict {tên cột: giá trị} (không cần cột key)"""
+        key = str(key)
+        with self.lock:
+            r = self.rows.get(key, [key] + [""] * (len(self.columns) - 1))
+            for c, v in values.items():
+                if c in self.columns: r[self.columns.index(c)] = "" if v is None else str(v)
+            self.rows[key] = r; self.dirty.add(key)
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty: return
+            updates = [{"range": f"A{self.row_no[k]}", "values": [self.rows[k]]} for k in self.dirty if k in self.row_no]
+            new_keys = [k for k in self.dirty if k not in self.row_no]
+            if updates: self.wks.batch_update(updates, value_input_option="RAW")
+            if new_keys:
+                resp = self.wks.append_rows([self.rows[k] for k in new_keys], value_input_option="RAW")
+                # [FIX] Số dòng thật lấy từ updates.updatedRange (Sheets có thể nối sau khoảng trống / dòng của tiến trình khác);
+                # phản hồi không có vị trí -> đọc lại cột key
+                start = appended_start_row(resp)
+                if start is not None:
+                    for i, k in enumerate(new_keys): self.row_no[k] = start + i
+                else:
+                    for i, v in enumerate(self.wks.col_values(1)[1:], start=2):
+                        if str(v).strip() in self.rows: self.row_no[str(v).strip()] = i
+            self.dirty = set()
+
+# ==========================================
+# 4. BỎ QUA NGUỒN KHÔNG ĐỔI (DRIVE modifiedTime)
+# ==========================================
+# Mỗi dòng cấu hình (nguồn + vùng + lọc + tháng + đích) có 1 "dấu vân tay". Nếu lần đồng bộ thành công trước
+# đã ghi đúng phiên bản file nguồn hiện tại (modifiedTime + version của Drive) thì không cần tải lại.
+SHEET_SOURCE_STATE = "sys_source_state"
+SOURCE_STATE_COLS = ["Fingerprint", "Src_Id", "Modified_Time", "Thời điểm đồng bộ"]
+STATUS_UNCHANGED = "Không đổi"
+DRIVE_FILE_URL = "https://www.googleapis.com/drive/v3/files/{}"
+DYNAMIC_FILTER_WORDS = ("TODAY", "YESTERDAY")
+
+def get_drive_version(gc, file_id):
+    """modifiedTime|version của file trên Drive (1 lượt gọi nhẹ, không tải dữ liệu)"""
+    res = gc.http_client.request("get", DRIVE_FILE_URL.format(file_id),
+                                 params={"fields": "modifiedTime,version", "supportsAllDrives": True})
+    meta = res.json()
+    return f"{meta.get('modifiedTime', '')}|{meta.get('version', '')}"
+
+def _clean_cfg(val):
+    val = str(val).strip()
+    return "" if val.lower() in ['nan', 'none', 'null', 'lấy hết'] else val
+
+def source_fingerprint(src_id, src_sheet, data_range, filter_str, month, include_header, tgt_link, tgt_sheet):
+    # App (bool, ô trống) và auto_job (chuỗi 'TRUE', 'nan') phải ra cùng 1 dấu vân tay
+    header_flag = "TRUE" if str(include_header).strip().upper() == "TRUE" else "FALSE"
+    parts = [_clean_cfg(p) for p in [src_id, src_sheet, data_range, filter_str, month, tgt_link, tgt_sheet]] + [header_flag]
+    # Bộ lọc theo ngày động (TODAY-1...) cho kết quả khác nhau mỗi ngày dù nguồn không đổi
+    if any(w in str(filter_str).upper() for w in DYNAMIC_FILTER_WORDS): parts.append(datetime.now(TZ_VN).strftime("%Y-%m-%d"))
+    return hashlib.md5("||".join(parts).encode("utf-8")).hexdigest()
+
+class SourceFreshness:
+    """Chỉ áp dụng cho chế độ Ghi Đè: ghi lại y hệt dữ liệu cũ thì bỏ qua được. Ghi Nối Tiếp luôn chạy."""
+    def __init__(self, sh_history):
+        self.table = StateTable(sh_history, SHEET_SOURCE_STATE, SOURCE_STATE_COLS)
+        self.versions = {}  # src_id -> version (cache trong 1 lần chạy)
+        self.lock = threading.Lock()
+
+    def current_version(self, gc, src_id):
+        with self.lock:
+            if src_id in self.versions: return self.versions[src_id]
+        try: ver = get_drive_version(gc, src_id)
+        except: ver = None
+        with self.lock: self.versions[src_id] = ver
+        return ver
+
+    def is_unchanged(self, fingerprint, version):
+        if not version: return False
+        rec = self.table.get(fingerprint)
+        return bool(rec) and rec.get("Modified_Time") == version
+
+    def mark_synced(self, fingerprint, src_id, version):
+        if version: self.table.set(fingerprint, {"Src_Id": src_id, "Modified_Time": version, "Thời điểm đồng bộ": datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")})
+
+    def flush(self):
+        try: self.table.flush()
+        except: pass
+
+# ==========================================
+# 5. ĐỌC NGUỒN THEO VÙNG CỘT + CACHE TRONG 1 LẦN CHẠY
+# ==========================================
+def source_key(src_id, src_sheet, data_range):
+    return (str(src_id).strip(), str(src_sheet).strip(), _clean_cfg(data_range).upper().replace(" ", ""))
+
+class SourceCache:
+    """
+    Mỗi nguồn (id, sheet, vùng) chỉ tải 1 lần trong 1 lần chạy rồi chia cho mọi dòng cấu hình dùng nó.
+    Nhiều luồng cùng xin 1 key thì chỉ 1 luồng tải, các luồng khác chờ kết quả đó.
+    Đăng ký trước số lượt dùng bằng expect() thì key được nhả khỏi RAM ngay sau lượt dùng cuối.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.expected = {}
+        self.stats = {"hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+    def expect(self, key, n=1):
+        with self.lock:
+            self.expected[key] = self.expected.get(key, 0) + n
+            if self.expected[key] <= 0: self.expected.pop(key); self.entries.pop(key, None)
+
+    def claim_siblings(self, key):
+        """
+        Giữ chỗ các key cùng file nguồn với key đang chờ dùng (đã expect) mà chưa ai tải,
+        để người gọi đọc gộp 1 lệnh batchGet rồi trả kết quả bằng resolve().
+        """
+        with self.lock:
+            out = [k for k, n in self.expected.items() if n > 0 and k != key and k[0] == key[0] and k not in self.entries]
+            for k in out: self.entries[k] = {"done": threading.Event(), "value": None, "error": None}
+        return out
+
+    def resolve(self, key, value=None, error=None):
+        with self.lock: ent = self.entries.get(key)
+        if ent is None: return
+        ent["value"], ent["error"] = value, error
+        if error is not None or value is None:
+            with self.lock: self.entries.pop(key, None)
+        ent["done"].set()
+
+    def get(self, key, loader):
+        with self.lock:
+            ent = self.entries.get(key); owner = ent is None
+            if owner:
+                ent = {"done": threading.Event(), "value": None, "error": None}
+                self.entries[key] = ent; self.stats["misses"] += 1
+            else: self.stats["hits"] += 1
+        if owner:
+            try: ent["value"] = loader()
+            except Exception as e: ent["error"] = e
+            finally:
+                # Lỗi / không có dữ liệu thì không giữ lại, lượt sau được tải lại
+                if ent["error"] is not None or ent["value"] is None:
+                    with self.lock: self.entries.pop(key, None)
+                ent["done"].set()
+        else: ent["done"].wait()
+
+        with self.lock:
+            if key in self.expected:
+                self.expected[key] -= 1
+                if self.expected[key] <= 0: self.expected.pop(key); self.entries.pop(key, None)
+        if ent["error"] is not None: raise ent["error"]
+        return ent["value"]
+
+def col_to_index(col):
+    idx = 0
+    for c in col.upper().strip(): idx = idx * 26 + (ord(c) - ord('A')) + 1
+    return idx - 1
+
+def index_to_col(idx):
+    col = ""; idx += 1
+    while idx > 0: idx, r = divmod(idx - 1, 26); col = chr(65 + r) + col
+    return col
+
+def parse_col_range(data_range):
+    """'B:D' -> (1, 3). Lấy hết / không phải dạng CỘT:CỘT -> None (đọc cả sheet như cũ)."""
+    rng = _clean_cfg(data_range).upper().replace(" ", "")
+    if rng.count(":") != 1: return None
+    s, e = rng.split(":")
+    if not (s.isalpha() and e.isalpha() and s.isascii() and e.isascii() and len(s) <= 3 and len(e) <= 3): return None
+    s_idx, e_idx = col_to_index(s), col_to_index(e)
+    return (s_idx, e_idx) if s_idx <= e_idx else None
+
+def _source_plan(ws, data_range):
+    """Các range cần đọc cho 1 nguồn: (ranges tương đối trong tab, offset cột). offset None = cả sheet."""
+    col_rng = parse_col_range(data_range)
+    # Vùng vượt quá số cột của sheet thì API báo lỗi -> chặn theo col_count (có sẵn trong metadata)
+    if col_rng and col_rng[0] < ws.col_count:
+        s_idx, e_idx = col_rng[0], min(col_rng[1], ws.col_count - 1)
+        return ["1:1", f"{index_to_col(s_idx)}2:{index_to_col(e_idx)}"], s_idx, e_idx
+    return [None], None, None
+
+def _source_from_ranges(values, offset, e_idx):
+    """Ghép kết quả đọc về dạng (header_full, rows, offset) - rows pad đều như get_all_values."""
+    if offset is None:
+        rows = fill_gaps(values[0])
+        return (rows[0] if rows else []), rows, None
+    header_full = list(values[0][0]) if values[0] else []
+    body = [list(r) for r in values[1]]
+    if not header_full and not body: return [], [], offset
+    width = max([min(e_idx + 1, len(header_full)) - offset] + [len(r) for r in body])
+    rows = [header_full[offset : e_idx + 1]] + body
+    return header_full, [r + [""] * (width - len(r)) for r in rows], offset
+
+def read_sources_batch(sh, items):
+    """
+    Đọc nhiều (tab, vùng) của cùng 1 file nguồn bằng 1 lệnh values.batchGet rồi tách lại theo từng mục.
+    Có vùng cột (vd B:D) thì chỉ lấy dòng 1 + các cột đó, không tải cả sheet.
+    items: list (tab, vùng) - tab rỗng = sheet đầu tiên.
+    Trả về list (header_full, rows, offset) theo thứ tự items; rows gồm dòng 1 + thân bảng;
+    offset = index cột bắt đầu nếu đã cắt sẵn, None nếu đọc cả sheet (người gọi tự cắt như cũ).
+    Tab không tồn tại -> WorksheetNotFound ở đúng vị trí đó.
+    """
+    wss = sh.worksheets(); by_title = {w.title: w for w in wss}
+    plans, ranges = [], {}
+    for tab, rng in items:
+        ws = by_title.get(tab) if tab else (wss[0] if wss else None)
+        if ws is None: plans.append(WorksheetNotFound(tab)); continue
+        sub, offset, e_idx = _source_plan(ws, rng)
+        # Range trùng nhau (vd cùng dòng 1 của 1 tab) chỉ xin 1 lần
+        plans.append(([ranges.setdefault(absolute_range_name(ws.title, r), len(ranges)) for r in sub], offset, e_idx))
+    vrs = sh.values_batch_get(list(ranges)).get("valueRanges", []) if ranges else []
+    out = []
+    for p in plans:
+        if isinstance(p, Exception): out.append(p); continue
+        idxs, offset, e_idx = p
+        out.append(_source_from_ranges([vrs[i].get("values", []) for i in idxs], offset, e_idx))
+    return out
+
+def make_source_loader(cache, key, open_sh, call):
+    """
+    Loader cho cache.get(key, ...): mở file nguồn rồi đọc key cùng mọi key khác của file đó đang chờ dùng
+    trong 1 lệnh batchGet, chia kết quả cho từng key. open_sh(): mở spreadsheet; call(f, *args): bọc retry của app/auto.
+    """
+    def load():
+        sh = call(open_sh)
+        if sh is None: return None
+        siblings = cache.claim_siblings(key) if cache is not None else []
+        try: results = call(read_sources_batch, sh, [(k[1], k[2]) for k in [key] + siblings])
+        except Exception as e:
+            for k in siblings: cache.resolve(k, error=e)
+            raise
+        if results is None: results = [None] * (len(siblings) + 1)
+        for k, res in zip(siblings, results[1:]):
+            if isinstance(res, Exception): cache.resolve(k, error=res)
+            else: cache.resolve(k, res)
+        if isinstance(results[0], Exception): raise results[0]
+        return results[0]
+    return load
+
+# ==========================================
+# 6. BỘ LỌC Dieu_Kien_Loc (BIÊN DỊCH 1 LẦN, LỌC 1 LẦN)
+# ==========================================
+FILTER_OPS = [" contains ", "==", "!=", ">=", "<=", ">", "<", "="]
+FilterCond = namedtuple("FilterCond", ["text", "op", "col", "val_raw", "val_clean"])
+
+def parse_dynamic_date(val_str):
+    """Biến đổi TODAY, TODAY-1, TODAY()+3, YESTERDAY thành ngày cụ thể (0h, giờ VN)"""
+    if not isinstance(val_str, str): return val_str
+    val_upper = val_str.strip().upper().replace(" ", "").replace("'", "").replace('"', "")
+    now = datetime.now(TZ_VN).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if "TODAY" in val_upper:
+        calc_part = val_upper.replace("TODAY()", "").replace("TODAY", "")
+        if not calc_part: return now
+        try: return now + timedelta(days=int(calc_part))
+        except: pass
+
+    if val_upper == "YESTERDAY": return now - timedelta(days=1)
+    return val_str
+
+def is_empty_filter(filter_str):
+    return not filter_str or str(filter_str).strip().lower() in ['nan', 'none', 'null', '']
+
+@lru_cache(maxsize=512)
+def compile_filter(filter_str):
+    """
+    'A > 1; B contains x' -> tuple FilterCond (nối với nhau bằng VÀ). Cache theo nguyên văn chuỗi lọc.
+    Điều kiện không có toán tử vẫn giữ lại với op=None để bộ đánh giá báo lỗi cú pháp.
+    Ngày động (TODAY...) KHÔNG tính ở đây mà tính lúc lọc, để cache không bị cũ qua ngày.
+    """
+    conds = []
+    for cond in str(filter_str).split(';'):
+        fs = cond.strip()
+        if not fs: continue
+        op = next((o for o in FILTER_OPS if o in fs), None)
+        if not op: conds.append(FilterCond(fs, None, None, None, None)); continue
+        col_part, val_part = fs.split(op, 1)
+        col_raw = col_part.strip().replace("`", "").replace("'", "").replace('"', "")
+        val_raw = val_part.strip()
+        val_clean = val_raw[1:-1] if (val_raw.startswith("'") or val_raw.startswith('"')) else val_raw
+        conds.append(FilterCond(fs, op, col_raw, val_raw, val_clean))
+    return tuple(conds)
+
+def _compare(series, op, value):
+    if op == ">": return series > value
+    if op == "<": return series < value
+    if op == ">=": return series >= value
+    if op == "<=": return series <= value
+    if op in ["=", "=="]: return series == value
+    return series != value
+
+def _cond_mask(df, real_col, cond, col_cache):
+    """Mask boolean cho 1 điều kiện. col_cache giữ cột đã chuyển kiểu (1 cột dùng cho nhiều điều kiện chỉ chuyển 1 lần)"""
+    def cached(kind, fn):
+        if (real_col, kind) not in col_cache: col_cache[(real_col, kind)] = fn()
+        return col_cache[(real_col, kind)]
+
+    series = df[real_col]
+    if cond.op == " contains ":
+        return cached("str", lambda: series.astype(str)).str.contains(cond.val_clean, case=False, na=False)
+
+    def to_dt():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return pd.to_datetime(series, dayfirst=True, errors='coerce')
+
+    val_resolved = parse_dynamic_date(cond.val_raw)
+    v_dt = None
+    if isinstance(val_resolved, datetime):
+        v_dt = pd.to_datetime(val_resolved).tz_localize(None)
+    else:
+        try:
+            s_dt = cached("dt", to_dt)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                v_dt_try = pd.to_datetime(cond.val_clean, dayfirst=True)
+            if s_dt.notna().any() and pd.notna(v_dt_try): v_dt = v_dt_try
+        except: pass
+    if v_dt is not None: return _compare(cached("dt", to_dt), cond.op, v_dt)
+
+    try: v_num = float(cond.val_clean)
+    except: v_num = None
+    if v_num is not None:
+        return _compare(cached("num", lambda: pd.to_numeric(series, errors='coerce')), cond.op, v_num)
+
+    return _compare(cached("str_strip", lambda: series.astype(str).str.strip()), cond.op, str(cond.val_clean))
+
+def compiled_filter_mask(df, filter_str, strict=True, debug_container=None):
+    """Mask boolean (theo index của df) cho cả chuỗi lọc. Trả về (mask, lỗi)."""
+    if debug_container: debug_container.markdown(f"**🔍 Lọc: {len(df)} dòng gốc**")
+    mask = pd.Series(True, index=df.index); col_cache = {}
+    for cond in compile_filter(str(filter_str)):
+        if cond.op is None:
+            if strict: return None, f"Lỗi cú pháp: '{cond.text}'"
+            continue
+        real_col = next((c for c in df.columns if str(c).lower() == cond.col.lower()), None)
+        if not real_col:
+            if strict: return None, f"Không tìm thấy cột '{cond.col}'"
+            continue
+        try: mask &= _cond_mask(df, real_col, cond, col_cache).fillna(False).astype(bool)
+        except Exception as e:
+            if strict: return None, f"Lỗi '{cond.text}': {e}"
+            continue
+        if debug_container: debug_container.caption(f"👉 Lọc '{cond.val_clean}' ({cond.op}) -> Còn {int(mask.sum())}")
+    return mask, None
+
+def filter_columns(columns, filter_str):
+    """Các cột thực sự được bộ lọc dùng tới"""
+    wanted = {c.col.lower() for c in compile_filter(str(filter_str)) if c.op}
+    return [c for c in columns if str(c).lower() in wanted]
+
+def apply_compiled_filter(df, filter_str, strict=True, debug_container=None):
+    """
+    Lọc df theo Dieu_Kien_Loc: gộp mọi điều kiện thành 1 mask rồi cắt df đúng 1 lần.
+    strict=True (app): gặp lỗi trả về (None, thông báo lỗi). strict=False (auto): bỏ qua điều kiện lỗi.
+    """
+    if is_empty_filter(filter_str): return df, None
+    mask, err = compiled_filter_mask(df, filter_str, strict, debug_container)
+    if err: return None, err
+    return df[mask], None
+
+# ==========================================
+# 7. ENGINE POLARS (TÙY CHỌN)
+# ==========================================
+# Dựng bảng từ get_all_values, đoán kiểu số, lọc và căn cột đích bằng Polars thay cho pandas.
+# Kết quả ghi ra phải y hệt engine pandas nên:
+#   - Đoán kiểu số bám theo pd.to_numeric: cột chắc chắn là số/chữ thì Polars tự xử lý, cột mập mờ
+#     (khoảng trắng, inf...) thì chuyển riêng cột đó cho pd.to_numeric quyết định.
+#   - Bộ lọc dùng chung compiled_filter_mask, chỉ chuyển sang pandas đúng các cột mà bộ lọc nhắc tới.
+try: import polars as pl
+except ImportError: pl = None
+
+ENGINE_PANDAS = "pandas"; ENGINE_POLARS = "polars"
+ENGINES = [ENGINE_PANDAS, ENGINE_POLARS]
+_RE_INT = r"^[+-]?\d+$"
+_RE_FLOAT = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+_RE_NOT_NUMBER = r"[^0-9+\-.eE \tiInNfFtTyYaA]" # Có ký tự này thì chắc chắn không phải số
+
+def resolve_engine(name):
+    name = str(name or "").strip().lower()
+    return ENGINE_POLARS if name == ENGINE_POLARS and pl is not None else ENGINE_PANDAS
+
+def pl_frame_from_values(header_row, body_rows):
+    """Bảng Polars toàn chuỗi. header_row đã được làm duy nhất (như pandas path)."""
+    width = len(header_row)
+    body = [list(r[:width]) + [""] * (width - len(r)) if len(r) != width else r for r in body_rows]
+    return pl.DataFrame(body, schema=[(h, pl.Utf8) for h in header_row], orient="row")
+
+def _pl_numeric_column(s):
+    """Giống pd.to_numeric(series) (lỗi -> giữ nguyên cột)"""
+    non_empty = s.filter(s != "")
+    if non_empty.len() and non_empty.str.contains(_RE_NOT_NUMBER).any(): return s
+    has_empty = non_empty.len() < s.len()
+    if non_empty.str.contains(_RE_INT).all():
+        as_int = non_empty.cast(pl.Int64, strict=False)
+        if as_int.null_count() == 0:
+            return s.replace("", None).cast(pl.Float64) if has_empty else s.cast(pl.Int64)
+    elif non_empty.str.contains(_RE_FLOAT).all():
+        return s.replace("", None).cast(pl.Float64)
+    # Cột mập mờ -> để pandas quyết định
+    try: res = pd.to_numeric(pd.Series(s.to_list()))
+    except: return s
+    if res.dtype == object: return pl.Series(s.name, res.tolist(), dtype=pl.Object)
+    return pl.Series(s.name, res.tolist())
+
+def pl_to_numeric(df):
+    return df.with_columns([_pl_numeric_column(df[c]) for c in df.columns]) if df.width else df
+
+def pl_apply_filter(df, filter_str, strict=True, debug_container=None):
+    if is_empty_filter(filter_str): return df, None
+    cols = filter_columns(df.columns, filter_str)
+    small = pd.DataFrame({c: df[c].to_list() for c in cols}, index=pd.RangeIndex(df.height), columns=cols)
+    mask, err = compiled_filter_mask(small, filter_str, strict, debug_container)
+    if err: return None, err
+    return df.filter(pl.Series(mask.to_numpy(dtype=bool))), None
+
+# Số dòng mỗi lần căn cột + ghi khi ghi kiểu luồng (RAM đỉnh ~ 1 phần, không phụ thuộc độ lớn khối)
+WRITE_STREAM_ROWS = int(os.environ.get("KINKIN_WRITE_STREAM_ROWS", "5000"))
+
+class FrameRows:
+    """
+    Bọc DataFrame (pandas hoặc Polars) cho phần ghi: danh sách cột, số dòng, và rows(cột đích) trả về
+    list các dòng đã căn theo cột đích (cột không có -> "", ô trống -> "").
+    header: 1 dòng tiêu đề (cùng thứ tự df.columns) được đặt lên đầu - dùng cho Polars khi Lay_Header = TRUE.
+    """
+    def __init__(self, df, header=None):
+        self.df = df; self.header = header
+        self.is_polars = pl is not None and isinstance(df, pl.DataFrame)
+        self.columns = list(df.columns)
+
+    def __len__(self):
+        return (self.df.height if self.is_polars else len(self.df)) + (1 if self.header else 0)
+
+    def rows(self, columns=None):
+        columns = self.columns if columns is None else list(columns)
+        if not self.is_polars:
+            df_aligned = pd.DataFrame()
+            for col in columns:
+                if col in self.df.columns: df_aligned[col] = self.df[col]
+                else: df_aligned[col] = ""
+            return df_aligned.fillna('').values.tolist()
+        out = []
+        if self.header:
+            hmap = dict(zip(self.columns, self.header))
+            out.append([hmap.get(c, "") for c in columns])
+        have = [c for c in columns if c in self.columns]
+        pos = [have.index(c) if c in self.columns else -1 for c in columns]
+        for r in self.df.select(have).iter_rows():
+            out.append(["" if i < 0 or r[i] is None or (isinstance(r[i], float) and r[i] != r[i]) else r[i] for i in pos])
+        return out
+
+    def iter_rows(self, columns=None, size=WRITE_STREAM_ROWS):
+        """Như rows() nhưng căn cột từng phần size dòng rồi trả dần - không dựng cả list dòng một lúc."""
+        if self.header and self.is_polars: yield from FrameRows(self.df.head(0), self.header).rows(columns)
+        n = self.df.height if self.is_polars else len(self.df)
+        for i in range(0, n, max(int(size), 1)):
+            part = self.df.slice(i, size) if self.is_polars else self.df.iloc[i : i + size]
+            yield from FrameRows(part).rows(columns)
+
+# ==========================================
+# 8. QUÉT CỘT KHÓA Ở SHEET ĐÍCH (GHI ĐÈ)
+# ==========================================
+KEY_HEADER_SCAN_ROWS = 10
+
+def find_key_columns(wks, key_cols, header_scan_rows=KEY_HEADER_SCAN_ROWS):
+    """
+    Đọc vài dòng đầu để tìm dòng tiêu đề = dòng đầu tiên chứa key_cols[0] và key_cols[1] (không phân biệt hoa thường).
+    Trả về (index dòng tiêu đề, [index cột của từng key_cols]); None nếu không thấy tiêu đề; cột khóa thiếu -> index None.
+    """
+    for i, r in enumerate(wks.get_values(f"1:{header_scan_rows}")):
+        row_lower = [str(c).strip().lower() for c in r]
+        if key_cols[0].lower() in row_lower and key_cols[1].lower() in row_lower:
+            return i, [row_lower.index(c.lower()) if c.lower() in row_lower else None for c in key_cols]
+    return None
+
+def read_key_cells(wks, col_idxs, spans):
+    """Đọc các cột khóa trên từng đoạn dòng (s, e) (e None = tới cuối) trong 1 lệnh batchGet -> [(số dòng, (giá trị...)), ...]"""
+    ranges = [f"{index_to_col(j)}{s}:{index_to_col(j)}{'' if e is None else e}" for s, e in spans for j in col_idxs]
+    vrs = wks.batch_get(ranges, major_dimension="COLUMNS") if ranges else []
+    out = []
+    for k, (s, e) in enumerate(spans):
+        cols = [list(vr[0]) if vr else [] for vr in vrs[k * len(col_idxs) : (k + 1) * len(col_idxs)]]
+        n = max(len(c) for c in cols) if e is None else e - s + 1
+        cols = [c + [""] * (n - len(c)) for c in cols]
+        out += [(s + i, vals) for i, vals in enumerate(zip(*cols))]
+    return out
+
+def read_key_columns(wks, key_cols, header_scan_rows=KEY_HEADER_SCAN_ROWS):
+    """
+    Đọc riêng các cột khóa (Src_Link, Src_Sheet, Month...) của sheet đích thay vì get_all_values cả sheet:
+    1 lệnh đọc vài dòng đầu để tìm dòng tiêu đề + 1 lệnh batchGet chỉ các cột khóa.
+    Trả về [(số dòng trên sheet, (giá trị các cột khóa)), ...] cho mọi dòng sau tiêu đề;
+    None nếu không thấy dòng tiêu đề; [] nếu thiếu cột khóa khác.
+    """
+    found = find_key_columns(wks, key_cols, header_scan_rows)
+    if found is None: return None
+    hdr_idx, idxs = found
+    if None in idxs: return []
+    return read_key_cells(wks, idxs, [(hdr_idx + 2, None)])
+
+def appended_start_row(response):
+    """Dòng bắt đầu của 1 lần append_rows, lấy từ updates.updatedRange trong phản hồi ('Tab'!A120:K180 -> 120); None nếu không có."""
+    try:
+        a1 = response["updates"]["updatedRange"].split("!")[-1].split(":")[0]
+        return int("".join(ch for ch in a1 if ch.isdigit()))
+    except: return None
+
+# ==========================================
+# 9. CHỈ MỤC VỊ TRÍ DÒNG Ở SHEET ĐÍCH
+# ==========================================
+# Tab ẩn trong file đích: mỗi dòng = 1 key (tab đích | id nguồn | tab nguồn | tháng) -> các đoạn dòng đang chiếm.
+# Dòng "<tab>|*" đánh dấu tab đó đã có chỉ mục đầy đủ (dựng từ 1 lần quét cả tab).
+SHEET_ROW_INDEX = "_kinkin_index"
+ROW_INDEX_COLS = ["Key", "Ranges", "Thời điểm ghi"]
+
+def normalize_row_key(link, src_sheet, month):
+    """(link hoặc id nguồn, tab nguồn, tháng) -> key so khớp của chỉ mục"""
+    raw = str(link).strip()
+    try: sid = raw.split("/d/")[1].split("/")[0]
+    except: sid = raw
+    return (sid or raw, str(src_sheet).strip().lower(), str(month).strip().lower())
+
+def _to_spans(rows):
+    """[3, 4, 5, 9] -> [(3, 5), (9, 9)]"""
+    spans = []
+    for r in sorted(set(rows)):
+        if spans and r == spans[-1][1] + 1: spans[-1] = (spans[-1][0], r)
+        else: spans.append((r, r))
+    return spans
+
+def _shift_spans(spans, deleted):
+    """Các đoạn dòng sau khi xóa các dòng deleted (tăng dần): dòng bị xóa mất đi, dòng bên dưới dồn lên."""
+    out = []
+    for s, e in spans:
+        cur = s
+        for d in deleted[bisect_left(deleted, s) : bisect_right(deleted, e)] + [e + 1]:
+            if cur <= d - 1: out.append((cur, d - 1))
+            cur = d + 1
+    shifted = [(a - bisect_left(deleted, a), b - bisect_left(deleted, a)) for a, b in out]
+    merged = []
+    for a, b in shifted:
+        if merged and a == merged[-1][1] + 1: merged[-1] = (merged[-1][0], b)
+        else: merged.append((a, b))
+    return merged
+
+class TargetRowIndex:
+    """
+    Chỉ mục key -> đoạn dòng cho 1 tab đích, lưu ở tab ẩn _kinkin_index của file đích. Gọi trong khóa của tab đích.
+    Ghi Đè hỏi chỉ mục để biết ngay dòng cần xóa, chỉ đọc lại cột khóa đúng các dòng đó để kiểm tra;
+    tab chưa có chỉ mục, tổng số dòng chỉ mục khác số ô có link (dòng dán tay / writer khác), key chưa có
+    trong chỉ mục hoặc kiểm tra lệch -> quét cột khóa cả tab như cũ và dựng lại chỉ mục (tự chữa).
+    Mọi lần xóa / nối thêm dòng đều cập nhật chỉ mục, flush() ghi 1 lần.
+    """
+    def __init__(self, sh, tab):
+        self.tab = str(tab).strip()
+        self.table = StateTable(sh, SHEET_ROW_INDEX, ROW_INDEX_COLS, hidden=True)
+        self.spans = None  # key -> [(s, e)]; None = tab chưa có chỉ mục đáng tin
+        if self.table.get(self._name("*")) is not None:
+            prefix = self._name("")
+            with self.table.lock:
+                items = [(k, r[1]) for k, r in self.table.rows.items() if k.startswith(prefix) and k != self._name("*")]
+            self.spans = {}
+            for k, rng in items:
+                spans = [tuple(int(x) for x in p.split("-")) for p in str(rng).split(";") if "-" in p]
+                sid, rest = k[len(prefix):].split("|", 1)
+                if spans: self.spans[(sid,) + tuple(rest.rsplit("|", 1))] = spans
+
+    def _name(self, key):
+        return f"{self.tab}|{key if isinstance(key, str) else '|'.join(key)}"
+
+    @property
+    def trusted(self): return self.spans is not None
+
+    def rows_for(self, keys):
+        return sorted(r for k in set(keys) for s, e in self.spans.get(k, []) for r in range(s, e + 1))
+
+    def row_count(self):
+        """Tổng số dòng chỉ mục đang giữ (mọi key) - so với số ô có link ở tab để biết chỉ mục còn đủ không"""
+        return sum(e - s + 1 for spans in self.spans.values() for s, e in spans)
+
+    def reset(self, key_rows=()):
+        """Dựng lại chỉ mục của tab từ [(số dòng, key đã chuẩn hóa)] (kết quả quét cả tab) - tab trắng thì để trống."""
+        grouped = {}
+        for row_no, key in key_rows:
+            if key[0]: grouped.setdefault(key, []).append(row_no)  # Chỉ dòng có link (khớp cách đếm ở locate_overwrite_rows)
+        old = set(self.spans or {})
+        self.spans = {k: _to_spans(v) for k, v in grouped.items()}
+        for k in old - set(self.spans): self.table.set(self._name(k), {"Ranges": ""})
+        for k in self.spans: self._save(k)
+        self.table.set(self._name("*"), {"Thời điểm ghi": datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")})
+
+    def delete_rows(self, rows):
+        if not self.trusted or not rows: return
+        deleted = sorted(set(rows))
+        for k in list(self.spans):
+            new = _shift_spans(self.spans[k], deleted)
+            if new != self.spans[k]: self.spans[k] = new; self._save(k)
+
+    def insert_rows(self, after_row, count, key=None):
+        """Chèn count dòng ngay sau after_row: dòng bên dưới dồn xuống, các dòng chèn thuộc về key."""
+        if not self.trusted or count <= 0: return
+        for k in list(self.spans):
+            new = []
+            for a, b in self.spans[k]:
+                if a > after_row: new.append((a + count, b + count))
+                elif b > after_row: new += [(a, after_row), (after_row + 1 + count, b + count)]
+                else: new.append((a, b))
+            if new != self.spans[k]: self.spans[k] = new; self._save(k)
+        if key is not None: self.add_rows(key, after_row + 1, after_row + count)
+
+    def add_rows(self, key, start, end):
+        if not self.trusted or end < start: return
+        self.spans[key] = _to_spans([r for s, e in self.spans.get(key, []) for r in range(s, e + 1)] + list(range(start, end + 1)))
+        self._save(key)
+
+    def _save(self, key):
+        self.table.set(self._name(key), {"Ranges": ";".join(f"{s}-{e}" for s, e in self.spans.get(key, [])),
+                                         "Thời điểm ghi": datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")})
+
+    def flush(self):
+        try: self.table.flush()
+        except: pass
+
+def locate_overwrite_rows(wks, key_cols, keys, match, index=None):
+    """
+    Số dòng cần xóa cho Ghi Đè. keys: key đã chuẩn hóa (normalize_row_key) để hỏi chỉ mục;
+    match(giá trị cột khóa): luật so khớp khi quét cả tab (giữ nguyên luật riêng của app / auto).
+    Trả về None nếu không thấy dòng tiêu đề hệ thống.
+    """
+    found = find_key_columns(wks, key_cols)
+    if found is None: return None
+    hdr_idx, idxs = found
+    if None in idxs: return []
+
+    if index is not None and index.trusted:
+        rows = index.rows_for(keys)
+        # Kiểm tra rẻ trước khi tin chỉ mục: số ô có link (1 cột) phải bằng tổng số dòng chỉ mục đang giữ
+        links = read_key_cells(wks, [idxs[0]], [(hdr_idx + 2, None)]) if rows else []
+        if rows and sum(1 for _, v in links if str(v[0]).strip()) == index.row_count():
+            cells = read_key_cells(wks, idxs, _to_spans(rows))
+            if all(r > hdr_idx + 1 and match(vals) for r, vals in cells): return rows
+
+    key_rows = read_key_cells(wks, idxs, [(hdr_idx + 2, None)])
+    if index is not None: index.reset([(r, normalize_row_key(*vals)) for r, vals in key_rows])
+    return [r for r, vals in key_rows if match(vals)]
+
+# ==========================================
+# 10. GHI ĐÈ TẠI CHỖ
+# ==========================================
+WRITE_MODE_INPLACE = "Ghi Đè Tại Chỗ"
+
+def is_inplace_mode(w_mode):
+    m = str(w_mode).strip().lower()
+    return "tại chỗ" in m or "in-place" in m or "inplace" in m
+
+def write_rows_in_place(sh, wks, rows_old, values, index=None, key=None):
+    """
+    Ghi Đè Tại Chỗ: rows_old = các dòng hiện có của key, values = dòng mới (đã căn cột, ghi từ cột A).
+    Khối cũ liền nhau -> chỉ chèn / xóa phần chênh lệch số dòng ở cuối khối rồi ghi đè cả khối bằng 1 lệnh values.update,
+    dữ liệu không bị dời chỗ nên công thức tham chiếu theo dòng vẫn đúng.
+    Trả về (dòng đầu, dòng cuối); None nếu không có khối liền nhau (người gọi quay về xóa + nối như Ghi Đè).
+    """
+    if not rows_old or not values or rows_old != list(range(rows_old[0], rows_old[-1] + 1)): return None
+    s, e = rows_old[0], rows_old[-1]; n_old = e - s + 1; n_new = len(values)
+    if n_new > n_old:
+        sh.batch_update({"requests": [{"insertDimension": {"range": {"sheetId": wks.id, "dimension": "ROWS", "startIndex": e, "endIndex": e + n_new - n_old}, "inheritFromBefore": True}}]})
+        if index: index.insert_rows(e, n_new - n_old, key)
+    elif n_new < n_old:
+        sh.batch_update({"requests": [{"deleteDimension": {"range": {"sheetId": wks.id, "dimension": "ROWS", "startIndex": s - 1 + n_new, "endIndex": e}}}]})
+        if index: index.delete_rows(list(range(s + n_new, e + 1)))
+    wks.update(range_name=f"A{s}", values=values, value_input_option="USER_ENTERED")
+    return s, s + n_new - 1
+
+# ==========================================
+# 11. ĐỒNG BỘ THAY ĐỔI (SO HASH TỪNG DÒNG)
+# ==========================================
+# Hash mỗi dòng nằm ở cột ẩn Row_Hash ngay trong tab đích -> tự đi theo dòng khi chèn / xóa / sắp xếp.
+WRITE_MODE_DIFF = "Đồng Bộ Thay Đổi"
+SYS_COL_HASH = "Row_Hash"
+
+def is_diff_mode(w_mode):
+    m = str(w_mode).strip().lower()
+    return "thay đổi" in m or "diff" in m
+
+def ensure_hash_column(sh, wks, headers):
+    """Thêm cột Row_Hash (ẩn) vào cuối dòng tiêu đề nếu chưa có. Trả về dòng tiêu đề mới."""
+    if SYS_COL_HASH in headers: return list(headers)
+    headers = list(headers) + [SYS_COL_HASH]; idx = len(headers) - 1
+    if idx >= wks.col_count: wks.add_cols(idx + 1 - wks.col_count)
+    wks.update(range_name=f"{index_to_col(idx)}1", values=[[SYS_COL_HASH]])
+    sh.batch_update({"requests": [{"updateDimensionProperties": {"range": {"sheetId": wks.id, "dimension": "COLUMNS", "startIndex": idx, "endIndex": idx + 1},
+                                                                 "properties": {"hiddenByUser": True}, "fields": "hiddenByUser"}}]})
+    return headers
+
+def row_hash(values):
+    return hashlib.md5("\x1f".join("" if v is None else str(v) for v in values).encode("utf-8")).hexdigest()[:16]
+
+def hash_rows(rows, columns, skip_cols=()):
+    """
+    Điền Row_Hash cho các dòng ghi kiểu nối (generator, giữ luồng) - cùng cách hash như write_rows_diff
+    (bỏ cột Row_Hash + skip_cols, vd Thời điểm ghi) để khối vừa nối so được ngay ở lần Đồng Bộ sau.
+    Không có cột Row_Hash trong columns -> trả nguyên các dòng.
+    """
+    columns = list(columns)
+    if SYS_COL_HASH not in columns: yield from rows; return
+    hash_pos = columns.index(SYS_COL_HASH)
+    skip = {hash_pos} | {columns.index(c) for c in skip_cols if c in columns}
+    for r in rows:
+        r[hash_pos] = row_hash([v for i, v in enumerate(r) if i not in skip])
+        yield r
+
+def write_rows_diff(sh, wks, rows_old, values, hash_pos, skip_pos=(), index=None, key=None):
+    """
+    Đồng Bộ Thay Đổi: rows_old = các dòng hiện có của key (phải liền nhau), values = dòng mới đã căn cột (ghi từ cột A).
+    Hash từng dòng mới (bỏ qua các cột skip_pos, vd Thời điểm ghi) vào vị trí hash_pos, so với hash đang nằm ở cột Row_Hash,
+    rồi chỉ chèn / xóa / ghi các dòng khác nhau: dòng không đổi giữ nguyên cả Thời điểm ghi.
+    Trả về (dòng đầu, dòng cuối, số dòng đã ghi); None nếu không có khối liền nhau (người gọi quay về Ghi Đè).
+    """
+    if not rows_old or not values or rows_old != list(range(rows_old[0], rows_old[-1] + 1)): return None
+    s, e = rows_old[0], rows_old[-1]
+    skip = set(skip_pos) | {hash_pos}
+    for r in values: r[hash_pos] = row_hash([v for i, v in enumerate(r) if i not in skip])
+    old = [str(v[0]).strip() for _, v in read_key_cells(wks, [hash_pos], [(s, e)])]
+    new = [r[hash_pos] for r in values]
+
+    # Cắt phần đầu / đuôi trùng nhau trước khi so (trường hợp hay gặp: sửa vài dòng hoặc thêm dòng cuối)
+    pre = 0
+    while pre < min(len(old), len(new)) and old[pre] == new[pre]: pre += 1
+    suf = 0
+    while suf < min(len(old), len(new)) - pre and old[-1 - suf] == new[-1 - suf]: suf += 1
+    ops = [(t, i1 + pre, i2 + pre, j1 + pre, j2 + pre) for t, i1, i2, j1, j2 in
+           SequenceMatcher(None, old[pre:len(old) - suf], new[pre:len(new) - suf], autojunk=False).get_opcodes() if t != "equal"]
+
+    # Chèn / xóa dòng từ dưới lên để số dòng của các đoạn phía trên không bị lệch
+    requests = []; changed = []
+    for t, i1, i2, j1, j2 in reversed(ops):
+        n_old, n_new = i2 - i1, j2 - j1
+        if n_new > n_old:
+            at = s - 1 + i2
+            requests.append({"insertDimension": {"range": {"sheetId": wks.id, "dimension": "ROWS", "startIndex": at, "endIndex": at + n_new - n_old}, "inheritFromBefore": i2 > 0}})
+            if index: index.insert_rows(at, n_new - n_old, key)
+        elif n_new < n_old:
+            requests.append({"deleteDimension": {"range": {"sheetId": wks.id, "dimension": "ROWS", "startIndex": s - 1 + i1 + n_new, "endIndex": s - 1 + i2}}})
+            if index: index.delete_rows(list(range(s + i1 + n_new, s + i2)))
+        changed += range(j1, j2)
+    if requests: sh.batch_update({"requests": requests})
+
+    # Ghi các dòng đổi (theo vị trí mới) trong 1 lệnh values.batchUpdate
+    spans = _to_spans(changed)
+    if spans: wks.batch_update([{"range": f"A{s + a}", "values": values[a : b + 1]} for a, b in spans], value_input_option="USER_ENTERED")
+    return s, s + len(values) - 1, len(changed)
+
+# ==========================================
+# 12. KẾ HOẠCH GHI 1 TAB ĐÍCH
+# ==========================================
+# Giới hạn payload 1 request (ước lượng theo số ký tự); chỉ chia nhỏ khi vượt mức này.
+WRITE_PAYLOAD_LIMIT = int(os.environ.get("KINKIN_WRITE_PAYLOAD_LIMIT", str(8 * 1024 * 1024)))
+# Giới hạn ô của 1 file Google Sheets (cộng mọi tab)
+SHEET_CELL_LIMIT = 10_000_000
+
+def split_by_payload(items, limit=WRITE_PAYLOAD_LIMIT, size=lambda x: len(str(x)), max_count=None):
+    """
+    Chia dần (generator) thành các phần có tổng kích thước ước lượng <= limit và tối đa max_count phần tử
+    (mỗi phần ít nhất 1 phần tử). items có thể là generator - chỉ giữ 1 phần trong RAM.
+    """
+    cur, cur_size = [], 0
+    for it in items:
+        n = size(it)
+        if cur and (cur_size + n > limit or (max_count and len(cur) >= max_count)): yield cur; cur, cur_size = [], 0
+        cur.append(it); cur_size += n
+    if cur: yield cur
+
+def _row_size(row):
+    return sum(len(str(v)) + 4 for v in row) + 2
+
+def header_requests(wks, headers):
+    """Request ghi dòng tiêu đề (thêm cột lưới nếu thiếu) cho spreadsheets.batchUpdate."""
+    reqs = []
+    if len(headers) > wks.col_count:
+        reqs.append({"appendDimension": {"sheetId": wks.id, "dimension": "COLUMNS", "length": len(headers) - wks.col_count}})
+    reqs.append({"updateCells": {"start": {"sheetId": wks.id, "rowIndex": 0, "columnIndex": 0}, "fields": "userEnteredValue",
+                                 "rows": [{"values": [{"userEnteredValue": {"stringValue": str(h)}} for h in headers]}]}})
+    return reqs
+
+def delete_row_requests(sheet_id, rows):
+    """Request xóa các dòng (gom thành đoạn liền nhau, từ dưới lên để chỉ số không lệch)."""
+    return [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": s - 1, "endIndex": e}}}
+            for s, e in reversed(_to_spans(rows))]
+
+def spreadsheet_cells(sh):
+    """Tổng số ô lưới của cả file (mọi tab) - theo metadata, không đọc dữ liệu."""
+    return sum(w.row_count * w.col_count for w in sh.worksheets())
+
+def apply_target_write(sh, wks, values, rows_to_del=(), headers=None, call=None, stream_rows=None, total_rows=None):
+    """
+    Ghi 1 tab đích theo kế hoạch, không còn sleep cố định:
+      1. Nối dữ liệu mới xuống cuối (values.append USER_ENTERED - giữ cách Sheets tự hiểu ngày / số theo locale),
+         chia lệnh khi payload vượt WRITE_PAYLOAD_LIMIT. values là list hoặc generator dòng (ghi kiểu luồng,
+         mỗi lần tối đa stream_rows dòng).
+      2. 1 lệnh spreadsheets.batchUpdate gồm đổi dòng tiêu đề + mọi đoạn deleteDimension của dòng cũ.
+    Nối trước rồi mới xóa: lỗi giữa chừng thì dữ liệu cũ vẫn còn, không bao giờ mất trắng. Riêng khi nối trước
+    làm file vượt SHEET_CELL_LIMIT (hoặc không biết total_rows - số dòng mới của generator) thì xóa trước rồi mới nối.
+    Lệnh nào lỗi (call trả None) -> raise, không báo thành công với vị trí dòng sai.
+    Trả về dòng bắt đầu của dữ liệu mới sau khi đã xóa (từ updates.updatedRange), None nếu không đọc được.
+    call(f, *args, **kw): bọc retry của app / auto.
+    """
+    call = call or (lambda f, *a, **kw: f(*a, **kw))
+    if total_rows is None and isinstance(values, (list, tuple)): total_rows = len(values)
+    reqs = (header_requests(wks, headers) if headers else []) + delete_row_requests(wks.id, rows_to_del)
+    delete_first = bool(rows_to_del)
+    if delete_first and total_rows is not None:
+        cells = call(spreadsheet_cells, sh)
+        delete_first = cells is None or cells + total_rows * wks.col_count > SHEET_CELL_LIMIT
+
+    def run_batch():
+        for part in split_by_payload(reqs):
+            if call(sh.batch_update, {"requests": part}) is None: raise RuntimeError("batchUpdate (tiêu đề / xóa dòng cũ) lỗi")
+
+    if delete_first: run_batch()
+    start = None
+    for i, chunk in enumerate(split_by_payload(values, size=_row_size, max_count=stream_rows)):
+        resp = call(wks.append_rows, chunk, value_input_option="USER_ENTERED")
+        if resp is None: raise RuntimeError(f"Nối dữ liệu lỗi ở phần {i + 1}")
+        if i == 0: start = appended_start_row(resp)
+    if not delete_first:
+        run_batch()
+        if start is not None: start -= sum(1 for r in rows_to_del if r < start)
+    return start
+
+# ==========================================
+# 13. ĐOÁN KIỂU CỘT THEO MẪU + CACHE SCHEMA THEO NGUỒN
+# ==========================================
+# Thay cho pd.to_numeric từng cột trong try/except: lấy mẫu mỗi cột 1 lần để quyết định kiểu
+# (i = số nguyên, f = số thực, t = chữ), lưu theo (nguồn, tab, dấu vân tay dòng tiêu đề) ở tab sys_schema_state
+# để lần sau dùng lại, rồi đổi cả cột 1 lượt. Mã có số 0 ở đầu ("001") / số nguyên quá 15 chữ số giữ là chữ
+# (protect_text_codes thêm ' ở đầu lúc ghi để Sheets không tự đổi lại thành số).
+SHEET_SCHEMA_STATE = "sys_schema_state"
+SCHEMA_STATE_COLS = ["Schema_Key", "Types", "Thời điểm"]
+SCHEMA_SAMPLE_ROWS = int(os.environ.get("KINKIN_SCHEMA_SAMPLE_ROWS", "200"))
+TYPE_INT = "i"; TYPE_FLOAT = "f"; TYPE_TEXT = "t"
+_RE_CODE = r"^[+-]?0\d"  # "001", "-01.5" -> mã, không phải số
+_MAX_INT_DIGITS = 15     # Sheets chỉ giữ 15 chữ số -> mã dài (CCCD, số tài khoản...) phải giữ là chữ
+_re_int = re.compile(_RE_INT); _re_float = re.compile(_RE_FLOAT); _re_code = re.compile(_RE_CODE)
+
+def schema_key(src_id, src_sheet, columns):
+    header_fp = hashlib.md5("\x1f".join(str(c) for c in columns).encode("utf-8")).hexdigest()
+    return f"{str(src_id).strip()}|{str(src_sheet).strip().lower()}|{header_fp}"
+
+def infer_column_type(sample):
+    """Kiểu của 1 cột từ mẫu giá trị (bỏ ô trống). Không có mẫu -> chữ."""
+    vals = [str(v) for v in sample if v is not None and str(v) != ""]
+    if not vals or any(_re_code.match(v) for v in vals): return TYPE_TEXT
+    if all(_re_int.match(v) for v in vals):
+        return TYPE_TEXT if any(len(v.lstrip("+-")) > _MAX_INT_DIGITS for v in vals) else TYPE_INT
+    return TYPE_FLOAT if all(_re_float.match(v) for v in vals) else TYPE_TEXT
+
+def _column_sample(values, n=SCHEMA_SAMPLE_ROWS):
+    """Tối đa n giá trị khác rỗng rải đều cả cột (luôn có giá trị cuối)."""
+    if len(values) <= n: return values
+    step = len(values) / n
+    return [values[int(i * step)] for i in range(n)] + [values[-1]]
+
+def infer_schema(df):
+    """Chuỗi kiểu theo thứ tự cột (pandas hoặc Polars)."""
+    if pl is not None and isinstance(df, pl.DataFrame):
+        return "".join(infer_column_type(_column_sample(df[c].filter(df[c] != "").to_list())) for c in df.columns)
+    return "".join(infer_column_type(_column_sample(df.iloc[:, i][df.iloc[:, i] != ""].tolist())) for i in range(df.shape[1]))
+
+def _convert_pd(series, t):
+    """Đổi 1 cột pandas sang số (1 lượt). None nếu có giá trị ngoài mẫu không hợp kiểu."""
+    num = pd.to_numeric(series, errors="coerce")
+    text = series.astype(str)
+    filled = series.notna() & (text != "")
+    if (num.isna() & filled).any() or text.str.match(_RE_CODE).any(): return None
+    if t == TYPE_INT and (text.str.lstrip("+-").str.len() > _MAX_INT_DIGITS).any(): return None
+    return num
+
+def _convert_pl(s, t):
+    """Như _convert_pd cho Polars: nguyên có ô trống -> Float64 (giống pandas)."""
+    empties = int((s == "").sum())
+    num = s.replace("", None).cast(pl.Float64 if t == TYPE_FLOAT or empties else pl.Int64, strict=False)
+    if num.null_count() != empties + s.null_count() or s.str.contains(_RE_CODE).any(): return None
+    if t == TYPE_INT and (s.str.strip_chars("+-").str.len_chars() > _MAX_INT_DIGITS).any(): return None
+    return num
+
+class SchemaCache:
+    """Schema đã đoán theo nguồn (tab sys_schema_state trong file lịch sử): đọc 1 lần, ghi gom 1 lần."""
+    def __init__(self, sh_history):
+        self.table = StateTable(sh_history, SHEET_SCHEMA_STATE, SCHEMA_STATE_COLS, hidden=True)
+
+    def get(self, key, width):
+        rec = self.table.get(key); types = rec.get("Types", "") if rec else ""
+        return types if len(types) == width and set(types) <= {TYPE_INT, TYPE_FLOAT, TYPE_TEXT} else None
+
+    def put(self, key, types):
+        self.table.set(key, {"Types": types, "Thời điểm": datetime.now(TZ_VN).strftime("%d/%m/%Y %H:%M:%S")})
+
+    def flush(self):
+        try: self.table.flush()
+        except: pass
+
+def _text_guard_pd(series):
+    """Cột chữ pandas: giá trị trông như số mà Sheets sẽ làm hỏng ("001", > 15 chữ số) -> thêm ' để giữ là chữ."""
+    if not pd.api.types.is_string_dtype(series): return None
+    text = series.astype(str)
+    mask = text.str.match(_RE_FLOAT) & (text.str.match(_RE_CODE) | (text.str.count(r"\d") > _MAX_INT_DIGITS))
+    return ("'" + text).where(mask, series) if mask.any() else None
+
+def _text_guard_pl(s):
+    """Như _text_guard_pd cho Polars."""
+    if s.dtype != pl.Utf8: return None
+    mask = s.str.contains(_RE_FLOAT) & (s.str.contains(_RE_CODE) | (s.str.count_matches(r"\d") > _MAX_INT_DIGITS))
+    return pl.when(mask).then(pl.lit("'") + s).otherwise(s).alias(s.name) if mask.any() else None
+
+def protect_text_codes(df):
+    """
+    Gọi ngay trước khi ghi (sau lọc): mọi lệnh ghi dùng USER_ENTERED nên Sheets tự đổi "001" -> 1 và làm tròn số
+    dài -> các giá trị đó trong cột chữ được thêm ' ở đầu để giữ nguyên là chữ. pandas đổi ngay trên df;
+    Polars trả về DataFrame mới. Luôn trả về df.
+    """
+    if pl is not None and isinstance(df, pl.DataFrame):
+        guarded = [g for g in (_text_guard_pl(df[c]) for c in df.columns) if g is not None]
+        return df.with_columns(guarded) if guarded else df
+    for i in range(df.shape[1]):
+        g = _text_guard_pd(df.iloc[:, i])
+        if g is not None: df.isetitem(i, g)
+    return df
+
+def apply_schema(df, src_id="", src_sheet="", cache=None):
+    """
+    Đổi kiểu các cột số theo schema (lấy từ cache, không có thì đoán theo mẫu), mỗi cột 1 lượt.
+    Cột có giá trị ngoài mẫu không hợp kiểu -> giữ chữ và cập nhật lại schema. pandas đổi ngay trên df;
+    Polars trả về DataFrame mới. Luôn trả về df.
+    """
+    is_polars = pl is not None and isinstance(df, pl.DataFrame)
+    if not len(df.columns): return df
+    key = schema_key(src_id, src_sheet, df.columns)
+    cached = cache.get(key, len(df.columns)) if cache else None
+    types = list(cached or infer_schema(df))
+    converted = []
+    for i, t in enumerate(types):
+        if t == TYPE_TEXT: continue
+        num = _convert_pl(df[df.columns[i]], t) if is_polars else _convert_pd(df.iloc[:, i], t)
+        if num is None: types[i] = TYPE_TEXT
+        elif is_polars: converted.append(num)
+        else: df.isetitem(i, num)
+    if is_polars and converted: df = df.with_columns(converted)
+    if cache and "".join(types) != cached: cache.put(key, "".join(types))
+    return df
+
+
+# ==========================================
+# 14. TRẠNG THÁI LẦN CHẠY THEO BLOCK (TAB sys_state)
+# ==========================================
+# Mỗi block 1 dòng: lần chạy Auto gần nhất, trạng thái, thời gian chạy, số dòng. Auto Runner đọc tab nhỏ này
+# để biết block nào đến hạn thay cho việc tải + parse cả log_lanthucthi -> chi phí khởi động không tăng theo log.
+SHEET_SYS_STATE = "sys_state"
+BLOCK_STATE_COLS = ["Block_Name", "Last_Run", "Status", "Duration_s", "Rows"]
+BLOCK_STATE_TIME_FMT = "%d/%m/%Y %H:%M:%S"
+
+class BlockRunState:
+    """Bảng trạng thái chạy theo block (StateTable trên tab sys_state của file lịch sử)."""
+    def __init__(self, sh):
+        self.table = StateTable(sh, SHEET_SYS_STATE, BLOCK_STATE_COLS)
+
+    def is_empty(self):
+        return not self.table.rows
+
+    def last_runs(self):
+        """{block: datetime (giờ VN)} của lần chạy thành công gần nhất"""
+        out = {}
+        with self.table.lock: items = list(self.table.rows.items())
+        for blk, r in items:
+            try: out[blk] = TZ_VN.localize(datetime.strptime(r[1].strip().lstrip("'"), BLOCK_STATE_TIME_FMT))
+            except: pass
+        return out
+
+    def mark_run(self, block, started, duration_s, rows, status="Hoàn tất"):
+        self.table.set(block, {"Last_Run": started.strftime(BLOCK_STATE_TIME_FMT), "Status": status,
+                               "Duration_s": round(duration_s, 1), "Rows": rows})
+
+    def mark_error(self, block, error, duration_s=0):
+        """Lỗi không ghi Last_Run -> lần sau block vẫn được chạy lại như trước"""
+        self.table.set(block, {"Status": f"Lỗi: {str(error)[:100]}", "Duration_s": round(duration_s, 1)})
+
+    def flush(self):
+        try: self.table.flush()
+        except: pass
+
+# ==========================================
+# 15. GHI LOG NỀN (HÀNG ĐỢI + LUỒNG GHI GOM THEO TAB)
+# ==========================================
+# Ghi log không nằm trên đường chạy của block: log() chỉ bỏ dòng vào hàng đợi có giới hạn, 1 luồng nền gom dòng
+# theo tab và ghi mỗi tab 1 lệnh append_rows khi đủ batch_rows dòng hoặc sau flush_seconds giây.
+# File lịch sử được mở 1 lần, worksheet của từng tab được nhớ lại. Thoát chương trình -> tự flush (atexit).
+LOG_QUEUE_MAX = 10000
+LOG_BATCH_ROWS = int(os.environ.get("KINKIN_LOG_BATCH_ROWS", "200"))
+LOG_FLUSH_SECONDS = float(os.environ.get("KINKIN_LOG_FLUSH_SECONDS", "10"))
+
+class LogSink:
+    """
+    open_sh(): trả về Spreadsheet chứa các tab log (gọi lười, 1 lần). headers: {tab: dòng tiêu đề khi phải tạo tab}.
+    call(f, *args): bọc retry của app / auto (dùng khi mở / tạo tab). Hàng đợi đầy -> bỏ dòng mới và đếm ở self.dropped (không chặn).
+    Ghi lỗi tạm thời (429 / 5xx / mạng) -> giữ lô để ghi lại; lỗi khác (dữ liệu hỏng...) -> bỏ lô, đếm ở self.failed,
+    báo qua on_error(tab, số dòng, lỗi) để 1 dòng hỏng không chặn mãi cả tab.
+    """
+    def __init__(self, open_sh, headers=None, call=None, batch_rows=LOG_BATCH_ROWS, flush_seconds=LOG_FLUSH_SECONDS, maxsize=LOG_QUEUE_MAX, on_error=None):
+        self.open_sh = open_sh; self.headers = headers or {}
+        self.call = call or (lambda f, *a, **kw: f(*a, **kw))
+        self.on_error = on_error; self.failed = 0; self.last_error = None
+        self.batch_rows = batch_rows; self.flush_seconds = flush_seconds; self.maxsize = maxsize
+        self.q = queue.Queue(maxsize=maxsize); self.dropped = 0
+        self._sh = None; self._wks = {}; self._buf = defaultdict(list); self._closed = False
+        self._thread = threading.Thread(target=self._run, name="kinkin-log-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, tab, row):
+        self.log_rows(tab, [row])
+
+    def log_rows(self, tab, rows):
+        for r in rows:
+            try: self.q.put_nowait((tab, list(r)))
+            except queue.Full: self.dropped += 1
+
+    def flush(self, wait=True, timeout=30):
+        """Ghi ngay mọi dòng đang chờ. wait=False: chỉ báo luồng nền ghi, không đợi."""
+        done = threading.Event()
+        try: self.q.put((None, done), timeout=timeout)
+        except queue.Full: return False
+        return done.wait(timeout) if wait else True
+
+    def close(self, timeout=30):
+        if self._closed: return
+        self.flush(wait=True, timeout=timeout); self._closed = True
+
+    def _worksheet(self, tab):
+        if tab not in self._wks:
+            if self._sh is None: self._sh = self.open_sh()
+            try: wks = self._sh.worksheet(tab)
+            except WorksheetNotFound:
+                hdr = self.headers.get(tab)
+                wks = self._sh.add_worksheet(tab, 1000, max(len(hdr or []), 10))
+                if hdr: self.call(wks.append_row, hdr)
+            self._wks[tab] = wks
+        return self._wks[tab]
+
+    def _write(self, tabs):
+        for tab in tabs:
+            rows = self._buf.get(tab)
+            if not rows: continue
+            try:
+                # Gọi thẳng (429 đã được rate limiter của client chờ & gọi lại) để phân biệt được loại lỗi
+                self._worksheet(tab).append_rows(rows)
+                del self._buf[tab]
+            except Exception as e:
+                self.last_error = e
+                if is_transient_error(e):
+                    # Lỗi tạm thời -> giữ lại để lần sau ghi tiếp (cắt bớt dòng cũ nhất nếu dồn quá nhiều)
+                    if len(rows) > self.maxsize: del rows[: len(rows) - self.maxsize]
+                    continue
+                del self._buf[tab]; self.failed += len(rows)
+                if self.on_error:
+                    try: self.on_error(tab, len(rows), e)
+                    except Exception: pass
+
+    def _run(self):
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try: tab, row = self.q.get(timeout=timeout)
+            except queue.Empty:
+                self._write(list(self._buf)); deadline = time.time() + self.flush_seconds if self._buf else None; continue
+            if tab is None:
+                self._write(list(self._buf)); deadline = time.time() + self.flush_seconds if self._buf else None
+                row.set(); continue
+            self._buf[tab].append(row)
+            if len(self._buf[tab]) >= self.batch_rows: self._write([tab])
+            if deadline is None and self._buf: deadline = time.time() + self.flush_seconds